@@ -0,0 +1,90 @@
+#------------------------------------------------------------------------------
+# Bluetooth adapter discovery and load balancing
+#------------------------------------------------------------------------------
+
+import asyncio
+import os
+import re
+import subprocess
+
+SYSFS_BLUETOOTH = '/sys/class/bluetooth'
+
+#------------------------------------------------------------------------------
+# Names of the local HCI adapters (hci0, hci1, ...), sorted by index
+#------------------------------------------------------------------------------
+def list_adapters():
+    try:
+        names = os.listdir(SYSFS_BLUETOOTH)
+    except OSError:
+        return []
+
+    # Entries like "hci0:64" are connections, not adapters
+    names = [name for name in names if re.match('^hci[0-9]+$', name)]
+    return sorted(names, key=lambda name: int(name[3:]))
+
+def adapter_present(name):
+    return os.path.exists(os.path.join(SYSFS_BLUETOOTH, name))
+
+#------------------------------------------------------------------------------
+# Bluetooth address of an adapter, as reported by hciconfig
+#------------------------------------------------------------------------------
+def adapter_address(name):
+    try:
+        output = subprocess.check_output(['hciconfig', name]).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        raise Exception("Adapter not found: {}".format(name))
+
+    match = re.search('BD Address: (([0-9A-F]{2}:){5}[0-9A-F]{2})', output)
+    if not match:
+        raise Exception("Adapter not found: {}".format(name))
+
+    return match.group(1)
+
+#------------------------------------------------------------------------------
+# Hands out adapters to sessions, each adapter running at most `budget`
+# connections. acquire() picks the least loaded adapter and waits while all
+# of them are at their budget.
+#------------------------------------------------------------------------------
+class AdapterPool(object):
+
+    def __init__(self, adapters, budget=4):
+        self.load = dict((name, 0) for name in adapters)
+        self.budget = max(1, budget)
+        self.changed = asyncio.Condition()
+
+    def adapters(self):
+        return sorted(self.load.keys())
+
+    def capacity(self):
+        return len(self.load) * self.budget
+
+    # --------------------------------------------------------------------------
+    #  Returns an adapter name. Raises if no adapter is left.
+    # --------------------------------------------------------------------------
+    async def acquire(self):
+        async with self.changed:
+            while True:
+                if not self.load:
+                    raise Exception("No Bluetooth adapter available")
+
+                name = min(self.load, key=lambda name: (self.load[name], name))
+                if self.load[name] < self.budget:
+                    self.load[name] += 1
+                    return name
+
+                await self.changed.wait()
+
+    async def release(self, name):
+        async with self.changed:
+            if name in self.load:
+                self.load[name] -= 1
+            self.changed.notify_all()
+
+    # --------------------------------------------------------------------------
+    #  Drop an adapter that disappeared. Returns True if it was in the pool.
+    # --------------------------------------------------------------------------
+    async def remove(self, name):
+        async with self.changed:
+            found = self.load.pop(name, None) is not None
+            self.changed.notify_all()
+        return found
@@ -0,0 +1,795 @@
+#------------------------------------------------------------------------------
+# asyncio DFU engine
+#
+# Asynchronous versions of the secure and legacy controllers, running the
+# same protocol steps (see steps.py) over coroutine transports. Every session
+# runs as a task on one event loop, so a single process can drive many
+# transfers concurrently. Each session can be cancelled or given a timeout.
+#
+# Requires Python 3.10 or later.
+#------------------------------------------------------------------------------
+
+import asyncio
+import binascii
+import collections
+import errno
+import inspect
+import os
+import re
+import socket
+import struct
+import time
+
+import pexpect
+
+from abc import ABCMeta, abstractmethod
+
+from transport import Att, Characteristic, Notification, BDADDR_LE_PUBLIC, BDADDR_LE_RANDOM, \
+                      AF_BLUETOOTH, BTPROTO_L2CAP, sockaddr_l2, sockaddr_call, uuid_from_bytes, uuid_to_bytes, \
+                      as_buffer, advance_parts, IOV_MAX, GATTTOOL_ECHO, parse_notification
+from phases import PhaseTimer
+from metrics import Metrics
+from adapters import adapter_address
+
+from nrf_ble_dfu_controller import NrfBleDfuController
+
+import ble_secure_dfu_controller as secure
+import ble_legacy_dfu_controller as legacy
+
+verbose = False
+
+#------------------------------------------------------------------------------
+# Notifications received by an async transport, with their arrival time.
+#
+# The event loop reads notifications as they arrive, also while a session is
+# sending a window of data packets, so the async engine needs no
+# NotificationReader thread; the arrival time kept here stands in for the
+# one the reader records. As with the blocking transports, waiting for one
+# handle leaves the notifications for other handles queued. A lost link
+# (queued as an exception) ends any wait.
+#------------------------------------------------------------------------------
+class NotificationInbox(object):
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.changed = asyncio.Event()
+
+    def put_nowait(self, item):
+        self.items.append((time.time(), item))
+        self.changed.set()
+
+    # --------------------------------------------------------------------------
+    #  Returns (arrival time, notification or exception), or None on timeout
+    # --------------------------------------------------------------------------
+    async def get(self, timeout, handle=None):
+        deadline = time.time() + timeout
+
+        while True:
+            for entry in self.items:
+                item = entry[1]
+                if handle is None or isinstance(item, Exception) or item.handle == handle:
+                    self.items.remove(entry)
+                    return entry
+
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), max(0, deadline - time.time()))
+            except asyncio.TimeoutError:
+                return None
+
+#------------------------------------------------------------------------------
+# Async transport interface. Same operations as transport.BleTransport, as
+# coroutines; see there for what each one does.
+#------------------------------------------------------------------------------
+class AsyncBleTransport(object):
+    __metaclass__ = ABCMeta
+
+    def __init__(self, target_mac, adapter=None):
+        self.target_mac = target_mac
+        self.adapter = adapter
+        self.notifications = NotificationInbox()
+
+        # Arrival time of the notification last returned
+        self.notify_time = None
+
+    @abstractmethod
+    async def connect(self, timeout=30):
+        pass
+
+    @abstractmethod
+    async def disconnect(self):
+        pass
+
+    async def set_target(self, target_mac):
+        await self.disconnect()
+        self.target_mac = target_mac
+
+        # Whatever the old link left queued does not belong to the new one
+        self.notifications = NotificationInbox()
+
+    @abstractmethod
+    async def discover(self, uuids=None, timeout=10):
+        pass
+
+    @abstractmethod
+    async def exchange_mtu(self, mtu, timeout=10):
+        pass
+
+    @abstractmethod
+    async def write_cmd(self, handle, data):
+        pass
+
+    @abstractmethod
+    async def write_req(self, handle, data, wait=True, timeout=10):
+        pass
+
+    @abstractmethod
+    async def read_by_uuid(self, uuid, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Wait for the next notification, for handle if given; those for other
+    #  handles stay queued. Returns a Notification, or None on timeout.
+    #  Raises if the link was lost.
+    # --------------------------------------------------------------------------
+    async def wait_for_notification(self, timeout=30, handle=None):
+        entry = await self.notifications.get(timeout, handle)
+        if entry is None:
+            return None
+
+        (self.notify_time, notify) = entry
+        if isinstance(notify, Exception):
+            raise notify
+
+        return notify
+
+    payload_encoding = 'raw'
+
+    def encode_payload(self, data):
+        return as_buffer(data)
+
+    async def write_cmd_slice(self, handle, payload, offset, num_bytes):
+        await self.write_cmd(handle, memoryview(payload)[offset:offset + num_bytes])
+
+    async def write_cmd_burst(self, handle, payload, offset, end, packet_size):
+        for i in range(offset, end, packet_size):
+            await self.write_cmd_slice(handle, payload, i, min(packet_size, end - i))
+
+#------------------------------------------------------------------------------
+# gatttool backend
+#
+# The pty output is read by the event loop and split into lines. Notification
+# lines go to the notification queue, every other line is offered to the
+# listeners registered by pending commands.
+#------------------------------------------------------------------------------
+class AsyncGatttoolTransport(AsyncBleTransport):
+
+    CHARACTERISTIC = re.compile(b'handle: (0x[0-9a-f]{4}), char properties: (0x[0-9a-f]{2}), char value handle: (0x[0-9a-f]{4}), uuid: ([0-9a-f-]{36})')
+
+    def __init__(self, target_mac, adapter=None, command='gatttool', pool=None):
+        AsyncBleTransport.__init__(self, target_mac, adapter)
+        self.command = command
+        self.pool = pool
+        self.cmd_prefix = {}
+        self.ble_conn = None
+        self.listeners = []
+        self.buffer = b''
+        self.connected = False
+
+    def _spawn(self):
+        if self.pool is not None:
+            (self.ble_conn, fresh) = self.pool.acquire(self.adapter)
+        else:
+            cmd = "%s -b '%s' -t random --interactive" % (self.command, self.target_mac)
+            if self.adapter:
+                cmd += " -i %s" % self.adapter
+
+            (self.ble_conn, fresh) = (pexpect.spawn(cmd), True)
+
+        self.fd = self.ble_conn.child_fd
+        os.set_blocking(self.fd, False)
+        self.buffer = b''
+        self.connected = False
+        self.started = not fresh
+        asyncio.get_event_loop().add_reader(self.fd, self._on_readable)
+
+    def _close(self):
+        if self.ble_conn is not None:
+            asyncio.get_event_loop().remove_reader(self.fd)
+            if self.pool is not None:
+                os.set_blocking(self.fd, True)
+                self.pool.release(self.ble_conn, self.adapter)
+            else:
+                self.ble_conn.close(force=True)
+            self.ble_conn = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            # gatttool exited
+            asyncio.get_event_loop().remove_reader(self.fd)
+            self._lost()
+            return
+
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            self._dispatch(line)
+
+        # Prompts are not newline terminated
+        if self.buffer and self._offer(self.buffer):
+            self.buffer = b''
+
+        # The prompt shows '[   ]' once the link is gone. Checked after the
+        # lines above, so notifications sent just before are not lost.
+        if self.connected and b'[   ]' in data:
+            self._lost()
+
+    def _dispatch(self, line):
+        notify = parse_notification(line)
+        if notify is not None:
+            self.notifications.put_nowait(notify)
+            return
+
+        # Echo of data packets, most of the lines while an image is streamed
+        line = GATTTOOL_ECHO.sub(b'', line)
+        if not line.strip():
+            return
+
+        self._offer(line)
+
+    def _offer(self, line):
+        for listener in list(self.listeners):
+            if listener(line):
+                return True
+        return False
+
+    def _lost(self):
+        if self.connected:
+            print('Connection lost! ')
+        self.connected = False
+        self.notifications.put_nowait(Exception('Connection Lost'))
+
+    # --------------------------------------------------------------------------
+    #  Wait for a line matching one of patterns. Returns (index, match) or
+    #  None on timeout.
+    # --------------------------------------------------------------------------
+    async def _expect(self, patterns, timeout):
+        future = asyncio.get_event_loop().create_future()
+
+        def listener(line):
+            for (index, pattern) in enumerate(patterns):
+                match = re.search(pattern, line)
+                if match and not future.done():
+                    future.set_result((index, match))
+                    return True
+            return False
+
+        self.listeners.append(listener)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.listeners.remove(listener)
+
+    async def _sendline(self, line):
+        if isinstance(line, str):
+            line = line.encode('ascii')
+        await self._write_parts([line, b'\n'])
+
+    # --------------------------------------------------------------------------
+    #  Write buffers, gathered by the kernel IOV_MAX at a time. The read loop
+    #  keeps draining gatttool's output meanwhile, so it never stops reading
+    #  its input for want of room for its echo.
+    # --------------------------------------------------------------------------
+    async def _write_parts(self, parts):
+        while parts:
+            try:
+                parts = advance_parts(parts, os.writev(self.fd, parts[:IOV_MAX]))
+            except BlockingIOError:
+                writable = asyncio.get_event_loop().create_future()
+                asyncio.get_event_loop().add_writer(self.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    asyncio.get_event_loop().remove_writer(self.fd)
+
+    async def connect(self, timeout=30):
+        if self.ble_conn is None:
+            self._spawn()
+
+        # gatttool accepts commands once it shows its first prompt
+        if not self.started:
+            if await self._expect([b'\\[LE\\]>'], timeout) is None:
+                return False
+            self.started = True
+
+        self.notifications = NotificationInbox()
+        await self._sendline('connect %s' % self.target_mac)
+
+        res = await self._expect([b'Connection successful', b'Error: '], timeout)
+        if res is None or res[0] != 0:
+            return False
+
+        self.connected = True
+        return True
+
+    async def disconnect(self):
+        if self.ble_conn is not None and self.pool is None:
+            await self._sendline('exit')
+        self.connected = False
+        self._close()
+
+    async def set_target(self, target_mac):
+        # The process stays, the next connect names the new address
+        if self.ble_conn is not None:
+            self.connected = False
+            await self._sendline('disconnect')
+
+        self.target_mac = target_mac
+        self.notifications = NotificationInbox()
+
+    async def discover(self, uuids=None, timeout=10):
+        pending = set(uuids or [])
+        chars = []
+        found = asyncio.Event()
+
+        def listener(line):
+            match = self.CHARACTERISTIC.search(line)
+            if not match:
+                return False
+            (handle, properties, value_handle, uuid) = [m.decode('utf-8') for m in match.groups()]
+            chars.append(Characteristic(int(handle, 16), int(properties, 16), int(value_handle, 16), uuid))
+            pending.discard(uuid)
+            found.set()
+            return True
+
+        self.listeners.append(listener)
+        try:
+            await self._sendline('characteristics')
+            deadline = time.time() + timeout
+
+            # Stop when all requested UUIDs were seen or the listing went quiet
+            while time.time() < deadline and (pending or not uuids):
+                found.clear()
+                try:
+                    await asyncio.wait_for(found.wait(), min(deadline - time.time(), 0.5) if chars else deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self.listeners.remove(listener)
+
+        return chars
+
+    async def exchange_mtu(self, mtu, timeout=10):
+        await self._sendline('mtu %d' % mtu)
+
+        res = await self._expect([b'MTU was exchanged successfully: ([0-9]+)', b'Error: '], timeout)
+        if res is None or res[0] != 0:
+            return Att.DEFAULT_MTU
+
+        return int(res[1].group(1))
+
+    async def write_cmd(self, handle, data):
+        await self._sendline('char-write-cmd 0x%04x %s' % (handle, bytes(bytearray(data)).hex()))
+
+    async def write_req(self, handle, data, wait=True, timeout=10):
+        await self._sendline('char-write-req 0x%04x %s' % (handle, bytes(bytearray(data)).hex()))
+
+        if not wait:
+            return True
+
+        res = await self._expect([b'Characteristic value was written successfully', b'Error: '], timeout)
+        return res is not None and res[0] == 0
+
+    async def read_by_uuid(self, uuid, timeout=10):
+        await self._sendline('char-read-uuid %s' % uuid)
+
+        res = await self._expect([b'handle: 0x[0-9a-f]{4}\\s+value: ([0-9a-f ]+)', b'Error: '], timeout)
+        if res is None or res[0] != 0:
+            return None
+
+        return bytearray(bytes.fromhex(res[1].group(1).decode('ascii')))
+
+    async def wait_for_notification(self, timeout=30, handle=None):
+        notify = await AsyncBleTransport.wait_for_notification(self, timeout, handle)
+
+        if notify is None and self.ble_conn is not None:
+            # Have gatttool redraw its prompt, '[   ]' there means link loss
+            await self._sendline('')
+
+        return notify
+
+    payload_encoding = 'hex'
+
+    def encode_payload(self, data):
+        return binascii.hexlify(as_buffer(data))
+
+    async def write_cmd_slice(self, handle, payload, offset, num_bytes):
+        await self.write_cmd_burst(handle, payload, offset, offset + num_bytes, num_bytes)
+
+    # --------------------------------------------------------------------------
+    #  All command lines of the packets in one write, see
+    #  transport.GatttoolTransport.write_cmd_burst()
+    # --------------------------------------------------------------------------
+    async def write_cmd_burst(self, handle, payload, offset, end, packet_size):
+        if handle not in self.cmd_prefix:
+            self.cmd_prefix[handle] = ('char-write-cmd 0x%04x ' % handle).encode('ascii')
+
+        prefix = self.cmd_prefix[handle]
+        view = memoryview(payload)
+
+        parts = []
+        for i in range(offset, end, packet_size):
+            parts += (prefix, view[2*i:2*min(i + packet_size, end)], b'\n')
+
+        await self._write_parts(parts)
+
+#------------------------------------------------------------------------------
+# Native ATT over an L2CAP LE socket
+#------------------------------------------------------------------------------
+class AsyncAttSocketTransport(AsyncBleTransport):
+
+    def __init__(self, target_mac, adapter=None, addr_type=BDADDR_LE_RANDOM):
+        AsyncBleTransport.__init__(self, target_mac, adapter)
+        self.addr_type = addr_type
+        self.sock = None
+        self.reader = None
+        self.response = None
+        self.request_lock = asyncio.Lock()
+        self.mtu = Att.DEFAULT_MTU
+
+    async def connect(self, timeout=30):
+        await self.disconnect()
+
+        self.sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+
+        local_address = adapter_address(self.adapter) if self.adapter else '00:00:00:00:00:00'
+        err = sockaddr_call('bind', self.sock, sockaddr_l2(local_address, Att.CID, BDADDR_LE_PUBLIC))
+        if err:
+            raise Exception("bind failed: {}".format(os.strerror(err)))
+
+        self.sock.setblocking(False)
+        err = sockaddr_call('connect', self.sock, sockaddr_l2(self.target_mac, Att.CID, self.addr_type))
+        if err not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            await self.disconnect()
+            return False
+
+        loop = asyncio.get_event_loop()
+        writable = loop.create_future()
+        loop.add_writer(self.sock.fileno(), writable.set_result, None)
+        try:
+            await asyncio.wait_for(writable, timeout)
+        except asyncio.TimeoutError:
+            await self.disconnect()
+            return False
+        finally:
+            loop.remove_writer(self.sock.fileno())
+
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            await self.disconnect()
+            return False
+
+        self.mtu = Att.DEFAULT_MTU
+        self.notifications = NotificationInbox()
+        self.reader = asyncio.ensure_future(self._read_loop())
+        return True
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    async def _send(self, pdu):
+        await asyncio.get_event_loop().sock_sendall(self.sock, pdu)
+
+    async def _read_loop(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                pdu = bytearray(await loop.sock_recv(self.sock, 1024))
+            except OSError:
+                pdu = None
+
+            if not pdu:
+                print('Connection lost! ')
+                lost = Exception('Connection Lost')
+                self.notifications.put_nowait(lost)
+                if self.response is not None and not self.response.done():
+                    self.response.set_exception(lost)
+                return
+
+            opcode = pdu[0]
+
+            if opcode in (Att.NOTIFICATION, Att.INDICATION):
+                (handle,) = struct.unpack('<H', bytes(pdu[1:3]))
+                self.notifications.put_nowait(Notification(handle, pdu[3:]))
+                if opcode == Att.INDICATION:
+                    await self._send(bytes(bytearray([Att.CONFIRMATION])))
+
+            elif opcode == Att.EXCHANGE_MTU_REQ:
+                await self._send(struct.pack('<BH', Att.EXCHANGE_MTU_RSP, Att.MAX_MTU))
+                (client_mtu,) = struct.unpack('<H', bytes(pdu[1:3]))
+                self.mtu = max(Att.DEFAULT_MTU, min(client_mtu, Att.MAX_MTU))
+
+            elif opcode & 0x01 == 0 and opcode & 0x40 == 0:
+                await self._send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, 0, Att.ERR_REQUEST_NOT_SUPPORTED))
+
+            elif self.response is not None and not self.response.done():
+                self.response.set_result(pdu)
+
+    # --------------------------------------------------------------------------
+    #  ATT allows one outstanding request at a time
+    # --------------------------------------------------------------------------
+    async def _request(self, pdu, timeout=10):
+        async with self.request_lock:
+            self.response = asyncio.get_event_loop().create_future()
+            await self._send(bytes(pdu))
+            try:
+                return await asyncio.wait_for(self.response, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self.response = None
+
+    async def discover(self, uuids=None, timeout=10):
+        chars = []
+        start = 0x0001
+        deadline = time.time() + timeout
+
+        while start <= 0xffff:
+            rsp = await self._request(struct.pack('<BHHH', Att.READ_BY_TYPE_REQ, start, 0xffff, Att.GATT_CHARACTERISTIC),
+                                      deadline - time.time())
+            if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+                break
+
+            length = rsp[1]
+            for i in range(2, len(rsp) - length + 1, length):
+                entry = bytes(rsp[i:i + length])
+                (handle, properties, value_handle) = struct.unpack('<HBH', entry[0:5])
+                chars.append(Characteristic(handle, properties, value_handle, uuid_from_bytes(entry[5:])))
+                start = handle + 1
+
+        return chars
+
+    async def exchange_mtu(self, mtu, timeout=10):
+        rsp = await self._request(struct.pack('<BH', Att.EXCHANGE_MTU_REQ, mtu), timeout)
+        if rsp is None or rsp[0] != Att.EXCHANGE_MTU_RSP:
+            return self.mtu
+
+        (server_mtu,) = struct.unpack('<H', bytes(rsp[1:3]))
+        self.mtu = max(Att.DEFAULT_MTU, min(mtu, server_mtu))
+        return self.mtu
+
+    # --------------------------------------------------------------------------
+    #  Header and value are gathered into one PDU by the socket. A seqpacket
+    #  socket takes a PDU whole or not at all: only when it is full is the
+    #  PDU joined and left to the event loop.
+    # --------------------------------------------------------------------------
+    async def write_cmd(self, handle, data):
+        parts = [struct.pack('<BH', Att.WRITE_CMD, handle), as_buffer(data)]
+
+        try:
+            self.sock.sendmsg(parts)
+        except BlockingIOError:
+            await self._send(b''.join(parts))
+
+    async def write_req(self, handle, data, wait=True, timeout=10):
+        pdu = struct.pack('<BH', Att.WRITE_REQ, handle) + bytes(bytearray(data))
+
+        if not wait:
+            await self._send(pdu)
+            return True
+
+        rsp = await self._request(pdu, timeout)
+        return rsp is not None and rsp[0] == Att.WRITE_RSP
+
+    async def read_by_uuid(self, uuid, timeout=10):
+        rsp = await self._request(struct.pack('<BHH', Att.READ_BY_TYPE_REQ, 0x0001, 0xffff) + uuid_to_bytes(uuid), timeout)
+        if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+            return None
+
+        length = rsp[1]
+        return rsp[4:2 + length]
+
+#------------------------------------------------------------------------------
+# Create an async transport by name
+#------------------------------------------------------------------------------
+ASYNC_TRANSPORTS = {
+    'gatttool'  : AsyncGatttoolTransport,
+    'socket'    : AsyncAttSocketTransport,
+}
+
+def create_async_transport(name, target_mac, adapter=None, **options):
+    if name not in ASYNC_TRANSPORTS:
+        raise Exception("Unknown transport: {}".format(name))
+
+    return ASYNC_TRANSPORTS[name](target_mac, adapter, **options)
+
+#------------------------------------------------------------------------------
+# Run steps (see steps.py) to the end on the event loop, awaiting the
+# operations that return an awaitable
+#------------------------------------------------------------------------------
+async def run_steps_async(steps):
+    (result, error) = (None, None)
+
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+
+        (result, error) = (None, None)
+        try:
+            result = request.function(*request.args, **request.kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+        except BaseException as e:
+            error = e
+
+#------------------------------------------------------------------------------
+# Session plumbing shared by the secure and legacy engines.
+# Mixed in ahead of the blocking controller, whose steps it runs on the
+# event loop. What the steps leave to the engine is done without blocking.
+#------------------------------------------------------------------------------
+class AsyncDfuSession(object):
+
+    # --------------------------------------------------------------------------
+    #  Construction does no I/O, the transport connects in update()
+    # --------------------------------------------------------------------------
+    def __init__(self, target_mac, firmware_path, datfile_path, transport):
+        self.target_mac = target_mac
+        self.device_address = target_mac
+        self.firmware_path = firmware_path
+        self.datfile_path = datfile_path
+        self.transport = transport
+        # The event loop thread runs every session, its CPU time is no one's
+        self.phase_timer = PhaseTimer(cpu=False)
+        self.metrics = Metrics(target_mac)
+        self.task = None
+        self.progress_step = None
+
+    # --------------------------------------------------------------------------
+    #  Run the complete update: connect, switch to DFU mode if needed, transfer.
+    #  Raises asyncio.TimeoutError if timeout (seconds) expires, and
+    #  asyncio.CancelledError if cancel() was called.
+    # --------------------------------------------------------------------------
+    async def run(self, timeout=None):
+        self.task = asyncio.current_task()
+        try:
+            await asyncio.wait_for(self.update(), timeout)
+        finally:
+            self.task = None
+            self._phase_end()
+            await self.transport.disconnect()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def update(self):
+        self.input_setup()
+
+        # Connect to peer device. Assume application mode.
+        if await self.resume_interrupted():
+            pass
+        elif await self.scan_and_connect():
+            if not await self.check_DFU_mode():
+                self.log("Need to switch to DFU mode")
+                if not await self.switch_to_dfu_mode():
+                    raise Exception("Couldn't reconnect")
+        else:
+            self.log("Couldn't connect, will try DFU MAC")
+            # The device might already be in DFU mode (MAC + 1)
+            await self.target_mac_increase(1)
+
+            if not await self.scan_and_connect():
+                raise Exception("Can't connect to device")
+
+        await self.start()
+
+        await self.disconnect()
+
+    # --------------------------------------------------------------------------
+    #  Entry points of the blocking controller, as coroutines
+    # --------------------------------------------------------------------------
+    async def start(self):
+        return await run_steps_async(self._start())
+
+    async def check_DFU_mode(self):
+        return await run_steps_async(self._check_DFU_mode())
+
+    async def switch_to_dfu_mode(self):
+        return await run_steps_async(self._switch_to_dfu_mode())
+
+    async def scan_and_connect(self, timeout=30, scan=True):
+        return await run_steps_async(self._scan_and_connect(timeout, scan))
+
+    async def resume_interrupted(self):
+        return await run_steps_async(self._resume_interrupted())
+
+    async def target_mac_increase(self, inc):
+        return await run_steps_async(self._target_mac_increase(inc))
+
+    async def set_target(self, target_mac):
+        return await run_steps_async(self._set_target(target_mac))
+
+    async def disconnect(self):
+        await self.transport.disconnect()
+
+    # --------------------------------------------------------------------------
+    #  Sessions share the output, so lines name the device, and progress is
+    #  a line every tenth of the image instead of a progress bar
+    # --------------------------------------------------------------------------
+    def log(self, msg):
+        print("[{}] {}".format(self.target_mac, msg))
+
+    def _progress(self, offset):
+        step = offset * 10 // max(1, self.image_size)
+        if step != self.progress_step:
+            self.progress_step = step
+            self.log("Progress: {}% ({} of {} bytes)".format(step * 10, offset, self.image_size))
+
+    def _sleep(self, seconds):
+        return asyncio.sleep(seconds)
+
+    # --------------------------------------------------------------------------
+    #  The scan blocks, run it off the event loop
+    # --------------------------------------------------------------------------
+    def _find_target(self, timeout, since=None):
+        return asyncio.get_event_loop().run_in_executor(
+            None, NrfBleDfuController._find_target, self, timeout, since)
+
+    # --------------------------------------------------------------------------
+    #  The event loop reads notifications while data is sent, no reader
+    #  thread is needed. The inbox keeps their arrival time.
+    # --------------------------------------------------------------------------
+    def _start_notify_reader(self, count=None, until=None):
+        pass
+
+    def _arrival_time(self, notify):
+        if notify is None:
+            return time.time()
+
+        return self.transport.notify_time
+
+#------------------------------------------------------------------------------
+# Secure DFU (SDK >= 12)
+#------------------------------------------------------------------------------
+class AsyncBleDfuControllerSecure(AsyncDfuSession, secure.BleDfuControllerSecure):
+    pass
+
+#------------------------------------------------------------------------------
+# Legacy DFU (SDK <= 11)
+#------------------------------------------------------------------------------
+class AsyncBleDfuControllerLegacy(AsyncDfuSession, legacy.BleDfuControllerLegacy):
+    pass
+
+#------------------------------------------------------------------------------
+# Run several sessions on the current event loop.
+# Returns one entry per session: None on success, otherwise the exception.
+#------------------------------------------------------------------------------
+async def run_sessions(sessions, timeout=None):
+    async def run_one(session):
+        try:
+            await session.run(timeout)
+        except asyncio.CancelledError as e:
+            return e
+        except Exception as e:
+            return e
+        return None
+
+    return await asyncio.gather(*[run_one(session) for session in sessions])
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+#------------------------------------------------------------------------------
+# Throughput benchmark
+#
+# Runs the secure and legacy controllers against the simulated peer of
+# dfu_sim.py over a matrix of image sizes, PRN intervals, ATT MTUs (payload
+# sizes) and link latencies, and reports per case:
+#   * throughput of the image transfer in bytes/s
+#   * time spent in each phase (connect, discovery, init, objects, ...)
+#   * CPU time of the controller thread per KB of image
+#
+# Results can be saved as a baseline and later runs compared against it:
+#
+#   bench.py --save bench_baseline.json
+#   bench.py --compare bench_baseline.json --tolerance 0.15
+#
+# A comparison exits with status 1 if any case lost more throughput, or used
+# more CPU per KB, than the tolerance allows.
+#------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from dfu_sim import SimConfig, SimWorld, SimAttSocketTransport
+from transport import GatttoolTransport
+from ble_secure_dfu_controller import BleDfuControllerSecure
+from ble_legacy_dfu_controller import BleDfuControllerLegacy
+
+BENCH_MAC = 'CD:E3:4A:47:1C:E5'
+INIT_PACKET_SIZE = 141
+
+# Default matrix. Legacy bootloaders only use the default MTU.
+DEFAULT_MATRIX = {
+    'controller'    : ['secure', 'legacy'],
+    'image_size'    : [16 * 1024, 128 * 1024],
+    'prn'           : [4, 10, 32],
+    'mtu'           : [23, 247],
+    'latency'       : [0.0, 0.002],
+    'window'        : [1],
+}
+
+QUICK_MATRIX = {
+    'controller'    : ['secure', 'legacy'],
+    'image_size'    : [16 * 1024],
+    'prn'           : [10],
+    'mtu'           : [23, 247],
+    'latency'       : [0.0],
+    'window'        : [1],
+}
+
+#------------------------------------------------------------------------------
+# One point of the matrix
+#------------------------------------------------------------------------------
+class BenchCase(object):
+
+    def __init__(self, controller, image_size, prn, mtu, latency, window):
+        self.controller = controller
+        self.image_size = image_size
+        self.prn = prn
+        self.mtu = mtu
+        self.latency = latency
+        self.window = window
+
+    def key(self):
+        return '{} size={} prn={} mtu={} latency={} window={}'.format(
+            self.controller, self.image_size, self.prn, self.mtu, self.latency, self.window)
+
+def build_cases(matrix):
+    cases = []
+    seen = set()
+
+    for values in itertools.product(*[matrix[name] for name in
+            ('controller', 'image_size', 'prn', 'mtu', 'latency', 'window')]):
+        case = BenchCase(*values)
+        if case.controller == 'legacy':
+            case.mtu = 23
+
+        if case.key() not in seen:
+            seen.add(case.key())
+            cases.append(case)
+
+    return cases
+
+#------------------------------------------------------------------------------
+# Firmware and init packet of a given size, the same bytes on every run
+#------------------------------------------------------------------------------
+def make_firmware(directory, image_size):
+    rng = random.Random(image_size)
+
+    firmware_path = os.path.join(directory, 'bench_%d.bin' % image_size)
+    datfile_path = os.path.join(directory, 'bench_%d.dat' % image_size)
+
+    with open(firmware_path, 'wb') as f:
+        f.write(bytes(bytearray(rng.getrandbits(8) for _ in range(image_size))))
+    with open(datfile_path, 'wb') as f:
+        f.write(bytes(bytearray(rng.getrandbits(8) for _ in range(INIT_PACKET_SIZE))))
+
+    return (firmware_path, datfile_path)
+
+#------------------------------------------------------------------------------
+# Run one case once. Returns the result dict.
+#------------------------------------------------------------------------------
+def run_case(case, firmware, transport_name='socket', flash_latency=0.0):
+    secure = case.controller == 'secure'
+    config = SimConfig(secure=secure, link_latency=case.latency, flash_latency=flash_latency, seed=1)
+
+    if transport_name == 'gatttool':
+        command = '{} {} {} --link-latency {} --flash-latency {} --seed 1'.format(
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dfu_sim.py'),
+            '--secure' if secure else '--legacy', case.latency, flash_latency)
+        transport = GatttoolTransport(BENCH_MAC, command=command)
+    else:
+        transport = SimAttSocketTransport(BENCH_MAC, world=SimWorld(config))
+
+    (firmware_path, datfile_path) = firmware
+
+    # The controllers report progress on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        if secure:
+            dfu = BleDfuControllerSecure(BENCH_MAC, firmware_path, datfile_path, transport)
+        else:
+            dfu = BleDfuControllerLegacy(BENCH_MAC, firmware_path, datfile_path, transport)
+
+        dfu.pkt_receipt_interval = case.prn
+        dfu.max_att_mtu = case.mtu
+        dfu.pkt_receipt_window = case.window
+
+        dfu.input_setup()
+
+        try:
+            if not dfu.scan_and_connect():
+                raise Exception("Can't connect to the simulated peer")
+            dfu.start()
+        finally:
+            dfu.disconnect()
+
+    phases = dfu.phase_timer.totals()
+
+    # The transfer: the objects (secure) or the image phase (legacy)
+    image = [phase for phase in phases if phase['name'] == 'image' or phase['name'].startswith('object ')]
+    image_wall = sum(phase['wall'] for phase in image)
+
+    return {
+        'bytes_per_s'   : case.image_size / image_wall if image_wall else 0.0,
+        'image_s'       : image_wall,
+        'total_s'       : sum(phase['wall'] for phase in phases),
+        'cpu_ms_per_kb' : 1000.0 * sum(phase['cpu'] for phase in phases) / (case.image_size / 1024.0),
+        'objects'       : sum(phase['count'] for phase in image),
+        'phases'        : dict((phase['name'], round(phase['wall'], 4)) for phase in phases),
+    }
+
+#------------------------------------------------------------------------------
+# Run every case `repeat` times and keep the fastest run of each
+#------------------------------------------------------------------------------
+def run_matrix(cases, repeat=1, transport_name='socket', flash_latency=0.0):
+    results = {}
+    directory = tempfile.mkdtemp(prefix='dfu_bench_')
+
+    try:
+        firmware = {}
+        for case in cases:
+            if case.image_size not in firmware:
+                firmware[case.image_size] = make_firmware(directory, case.image_size)
+
+            runs = [run_case(case, firmware[case.image_size], transport_name, flash_latency) for _ in range(repeat)]
+            results[case.key()] = max(runs, key=lambda run: run['bytes_per_s'])
+
+            print_result(case.key(), results[case.key()])
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def print_result(key, result):
+    phases = [(name, wall) for (name, wall) in result['phases'].items() if not name.startswith('object ')]
+    if len(phases) < len(result['phases']):
+        phases.append(('objects', result['image_s']))
+
+    summary = '  '.join('{}={:.3f}'.format(name, wall) for (name, wall) in phases)
+
+    print('{:60s} {:10.0f} B/s {:7.3f} ms/KB  {}'.format(
+        key, result['bytes_per_s'], result['cpu_ms_per_kb'], summary))
+
+#------------------------------------------------------------------------------
+# Compare results with a baseline. Returns the list of regressed cases.
+#------------------------------------------------------------------------------
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    print('\n{:60s} {:>10s} {:>10s}'.format('Compared to baseline', 'B/s', 'CPU/KB'))
+
+    for (key, result) in sorted(results.items()):
+        base = baseline['cases'].get(key)
+        if base is None:
+            print('{:60s} {:>10s}'.format(key, 'new'))
+            continue
+
+        speed = result['bytes_per_s'] / base['bytes_per_s'] - 1.0 if base['bytes_per_s'] else 0.0
+        cpu = result['cpu_ms_per_kb'] / base['cpu_ms_per_kb'] - 1.0 if base['cpu_ms_per_kb'] else 0.0
+
+        regressed = speed < -tolerance or cpu > tolerance
+        if regressed:
+            regressions.append(key)
+
+        print('{:60s} {:+9.1f}% {:+9.1f}% {}'.format(key, speed * 100, cpu * 100, 'REGRESSION' if regressed else ''))
+
+    return regressions
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='DFU throughput benchmark against the simulated peer')
+
+    parser.add_argument('--quick', action='store_true', help='Run a small matrix')
+    parser.add_argument('--controller', help='Comma separated: secure, legacy')
+    parser.add_argument('--image-size', help='Comma separated image sizes in bytes')
+    parser.add_argument('--prn', help='Comma separated PRN intervals')
+    parser.add_argument('--mtu', help='Comma separated ATT MTUs (secure only)')
+    parser.add_argument('--latency', help='Comma separated link latencies in seconds')
+    parser.add_argument('--window', help='Comma separated receipt windows')
+    parser.add_argument('--flash-latency', type=float, default=0.0, help='Flash write latency of the peer in seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is kept (default 3)')
+    parser.add_argument('-t', '--transport', choices=['socket', 'gatttool'], default='socket',
+                        help='socket: in-process ATT server (default), gatttool: dfu_sim.py subprocess')
+    parser.add_argument('--save', help='Write the results as a baseline to this file')
+    parser.add_argument('--compare', help='Compare the results with this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed relative regression (default 0.15)')
+
+    args = parser.parse_args()
+
+    matrix = dict(QUICK_MATRIX if args.quick else DEFAULT_MATRIX)
+    for (name, convert) in (('controller', str), ('image_size', int), ('prn', int),
+                            ('mtu', int), ('latency', float), ('window', int)):
+        value = getattr(args, name)
+        if value:
+            matrix[name] = parse_list(value, convert)
+
+    results = run_matrix(build_cases(matrix), max(1, args.repeat), args.transport, args.flash_latency)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'date'      : time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python'    : platform.python_version(),
+                'machine'   : platform.machine(),
+                'transport' : args.transport,
+                'cases'     : results,
+            }, f, indent=2, sort_keys=True)
+        print("\nBaseline written to {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n{} case(s) regressed by more than {:.0f}%".format(len(regressions), args.tolerance * 100))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
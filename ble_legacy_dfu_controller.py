@@ -1,11 +1,13 @@
 import math
-import pexpect
+import struct
 import time
+import collections
 
 from array import array
 from util  import *
 
 from nrf_ble_dfu_controller import NrfBleDfuController
+from steps import io
 
 verbose = False
 
@@ -67,163 +69,228 @@ class Responses:
     def from_string(res_str):
         return int(res_str, 16)
 
+# Parsed Control Point notifications
+Response      = collections.namedtuple('Response', 'procedure response')
+PacketReceipt = collections.namedtuple('PacketReceipt', 'procedure response bytes_received')
 
 class BleDfuControllerLegacy(NrfBleDfuController):
     # Class constants
+    PROFILE              = 'legacy'
+
     UUID_CONTROL_POINT   = "00001531-1212-efde-1523-785feabcd123"
     UUID_PACKET          = "00001532-1212-efde-1523-785feabcd123"
     UUID_VERSION         = "00001534-1212-efde-1523-785feabcd123"
 
+    MODE_UUIDS = {
+        'app' : [UUID_CONTROL_POINT],
+        'dfu' : [UUID_CONTROL_POINT, UUID_PACKET],
+    }
+
+    # START_DFU image type of each package image type
+    IMAGE_TYPES = {
+        'softdevice'            : 0x01,
+        'bootloader'            : 0x02,
+        'softdevice_bootloader' : 0x03,
+        'application'           : 0x04,
+    }
+
+    # Legacy bootloaders (SDK <= 11) only handle the default ATT MTU
+    max_att_mtu          = 23
+
+    pkt_receipt_interval = 5
+
     # Constructor inherited from abstract base class
 
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
-    def start(self, verbose=False):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+    def _start(self):
+        self._phase('discovery')
 
-        self.pkt_receipt_interval = 5
+        yield from self._resolve_dfu_handles()
 
         if verbose:
             print('Control Point Handle: 0x%04x, CCCD: 0x%04x' % (self.ctrlpt_handle, self.ctrlpt_cccd_handle))
             print('Packet handle: 0x%04x' % (self.data_handle))
 
-        # Subscribe to notifications from Control Point characteristic
+        yield from self._negotiate_mtu()
+
+        # Subscribe to notifications from Control Point characteristic.
+        # If cached handles fail, discover them and try again.
         if verbose: print("Enabling notifications")
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+        if not (yield from self._enable_notifications(self.ctrlpt_cccd_handle)) and self._drop_cached_handles():
+            yield from self._resolve_dfu_handles()
+            yield from self._enable_notifications(self.ctrlpt_cccd_handle)
 
-        # Send 'START DFU' + Application Command
+        # Send 'START DFU' + image type Command
+        self._phase('init')
         if verbose: print("Sending START_DFU")
-        self._dfu_send_command(Procedures.START_DFU, [0x04])
+        (image_type, sizes) = self._image_start_params()
+        yield from self._dfu_send_command(Procedures.START_DFU, [image_type])
 
-        # Transmit binary image size
-        # Need to pad the byte array with eight zero bytes 
-        # (because that's what the bootloader is expecting...)
-        hex_size_array_lsb = uint32_to_bytes_le(len(self.bin_array))
-        zero_pad_array_le(hex_size_array_lsb, 8)
-        self._dfu_send_data(hex_size_array_lsb)
+        # Transmit the SoftDevice, bootloader and application sizes
+        yield from self._dfu_send_data(sizes)
 
         # Wait for response to Image Size
-        print("Waiting for Image Size notification")
-        self._wait_and_parse_notify()
+        self.log("Waiting for Image Size notification")
+        yield from self._wait_and_parse_notify()
 
         # Send 'INIT DFU' + Init Packet Command
-        self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x00])
+        yield from self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x00])
 
         # Transmit the Init image (DAT).
-        self._dfu_send_init()
+        yield from self._dfu_send_init()
 
         # Send 'INIT DFU' + Init Packet Complete Command
-        self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x01])
+        yield from self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x01])
 
-        print("Waiting for INIT DFU notification")
+        self.log("Waiting for INIT DFU notification")
         # Wait for INIT DFU notification (indicates flash erase completed)
-        self._wait_and_parse_notify()
+        yield from self._wait_and_parse_notify()
 
         # Set the Packet Receipt Notification interval
         if verbose: print("Setting pkt receipt notification interval")
         prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.PRN_REQUEST, prn)
+        yield from self._dfu_send_command(Procedures.PRN_REQUEST, prn)
 
         # Send 'RECEIVE FIRMWARE IMAGE' command to set DFU in firmware receive state. 
-        self._dfu_send_command(Procedures.RECEIVE_FIRMWARE_IMAGE)
+        yield from self._dfu_send_command(Procedures.RECEIVE_FIRMWARE_IMAGE)
 
-        # Send bin_array contents as as series of packets (burst mode).
+        # Send the image as a series of packets (burst mode).
         # Each segment is pkt_payload_size bytes long.
         # For every pkt_receipt_interval sends, wait for notification.
         segment_count = 0
         segment_total = int(math.ceil(self.image_size/float(self.pkt_payload_size)))
         time_start = time.time()
-        last_send_time = time.time()
-        print("Begin DFU")
-        for i in range(0, self.image_size, self.pkt_payload_size):
-            segment = self.bin_array[i:i + self.pkt_payload_size]
-            self._dfu_send_data(segment)
-            segment_count += 1
 
-            # print("segment #{} of {}, dt = {}".format(segment_count, segment_total, time.time() - last_send_time))
-            # last_send_time = time.time()
+        # Receipts in flight: (expected byte count, time the window was sent)
+        pending = collections.deque()
 
-            if (segment_count == segment_total):
-                print_progress(self.image_size, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+        # The stream ends with the response to RECEIVE_FIRMWARE_IMAGE
+        if self.pkt_receipt_window > 1:
+            self._start_notify_reader(until=lambda notify: notify[0] == Procedures.RESPONSE)
 
-                duration = time.time() - time_start
-                print("\nUpload complete in {} minutes and {} seconds".format(int(duration / 60), int(duration % 60)))
-                if verbose: print("segments sent: {}".format(segment_count))
+        self._phase('image')
+        self.log("Begin DFU")
+        # Packets go out a receipt window at a time
+        window_size = self.pkt_receipt_interval * self.pkt_payload_size
 
-                print("Waiting for DFU complete notification")
-                # Wait for DFU complete notification
-                self._wait_and_parse_notify()
+        try:
+            for i in range(0, self.image_size, window_size):
+                window_end = min(i + window_size, self.image_size)
+                yield from self._dfu_send_image_window(i, window_end)
+                segment_count += int(math.ceil((window_end - i) / float(self.pkt_payload_size)))
+
+                if (segment_count == segment_total):
+                    self._progress(self.image_size)
+
+                    duration = time.time() - time_start
+                    self.log("Upload complete in {} minutes and {} seconds".format(int(duration / 60), int(duration % 60)))
+                    if verbose: print("segments sent: {}".format(segment_count))
+
+                    # Receipts still in flight arrive before the completion
+                    while pending:
+                        yield from self._dfu_check_receipt(*pending.popleft())
 
-            elif (segment_count % self.pkt_receipt_interval) == 0:
-                (proc, res, pkts) = self._wait_and_parse_notify()
+                    self.log("Waiting for DFU complete notification")
+                    # Wait for DFU complete notification
+                    yield from self._wait_and_parse_notify()
+                    self.metrics.bytes_acked(self.image_size, self.image_size)
 
-                # TODO: Check pkts == segment_count * pkt_payload_size
+                elif (segment_count % self.pkt_receipt_interval) == 0:
+                    pending.append((segment_count * self.pkt_payload_size, time.time()))
 
-                if res != Responses.SUCCESS:
-                    raise Exception("bad notification status: {}".format(Responses.to_string(res)))
+                    # Only block once the window of outstanding receipts is full
+                    if len(pending) >= self.pkt_receipt_window:
+                        yield from self._dfu_check_receipt(*pending.popleft())
 
-                print_progress(pkts, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+        finally:
+            self._stop_notify_reader()
 
         # Send Validate Command
-        self._dfu_send_command(Procedures.VALIDATE_FIRMWARE)
+        self._phase('validate')
+        yield from self._dfu_send_command(Procedures.VALIDATE_FIRMWARE)
 
-        print("Waiting for Firmware Validation notification")
+        self.log("Waiting for Firmware Validation notification")
         # Wait for Firmware Validation notification
-        self._wait_and_parse_notify()
+        yield from self._wait_and_parse_notify()
 
         # Wait a bit for copy on the peer to be finished
-        time.sleep(1)
+        yield io(self._sleep, 1)
 
         # Send Activate and Reset Command
-        print("Activate and reset")
-        self._dfu_send_command(Procedures.ACTIVATE_IMAGE_AND_RESET)
+        self._phase('activate')
+        self.log("Activate and reset")
+        yield from self._dfu_send_command(Procedures.ACTIVATE_IMAGE_AND_RESET)
+
+        # The bootloader comes back for the next image of the package
+        if (yield from self._next_image()):
+            return (yield from self._start())
+
+        self._phase_end()
+
+    # --------------------------------------------------------------------------
+    #  START_DFU image type and size packet of the current image. The size
+    #  packet holds the SoftDevice, bootloader and application size.
+    # --------------------------------------------------------------------------
+    def _image_start_params(self):
+        image = self.images[self.image_index]
+
+        if image.type == 'softdevice_bootloader':
+            if 'sd_size' not in image.info or 'bl_size' not in image.info:
+                raise Exception("SoftDevice and bootloader image without sd_size and bl_size")
+            sizes = (image.info['sd_size'], image.info['bl_size'], 0)
+        elif image.type == 'softdevice':
+            sizes = (self.image_size, 0, 0)
+        elif image.type == 'bootloader':
+            sizes = (0, self.image_size, 0)
+        else:
+            sizes = (0, 0, self.image_size)
+
+        return (self.IMAGE_TYPES[image.type],
+                uint32_to_bytes_le(sizes[0]) + uint32_to_bytes_le(sizes[1]) + uint32_to_bytes_le(sizes[2]))
 
     # --------------------------------------------------------------------------
     #  Check if the peripheral is running in bootloader (DFU) or application mode
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
-    def check_DFU_mode(self):
+    def _check_DFU_mode(self):
         if verbose: print("Checking DFU State...")
 
-        cmd = 'char-read-uuid %s' % self.UUID_VERSION
+        version = yield io(self.transport.read_by_uuid, self.UUID_VERSION, timeout=10)
+        if version is None:
+            self.log("State timeout")
+            self.peer_mode = 'app'
+            return False
 
-        if verbose: print(cmd)
+        # The application and the bootloader share the address
+        self.peer_mode = 'dfu' if version[0:2] == bytearray([0x08, 0x00]) else 'app'
 
-        self.ble_conn.sendline(cmd)
-
-        # Skip two rows
-        try:
-            res = self.ble_conn.expect('handle:.*', timeout=10)
-            # res = self.ble_conn.expect('handle:', timeout=10)
-        except pexpect.TIMEOUT as e:
-            print("State timeout")
-        except:
-            pass
+        return self.peer_mode == 'dfu'
 
-        return self.ble_conn.after.find("value: 08 00")!=-1
+    def _switch_to_dfu_mode(self):
+        self._phase('switch')
 
-    def switch_to_dfu_mode(self):
-        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
+        (_, bl_value_handle, bl_cccd_handle) = yield from self._get_handles(self.UUID_CONTROL_POINT)
 
         # Enable notifications
-        cmd = 'char-write-req 0x%02x %02x' % (bl_cccd_handle, 1)
-        if verbose: print(cmd)
-        self.ble_conn.sendline(cmd)
+        if not (yield from self._enable_notifications(bl_cccd_handle)) and self._drop_cached_handles():
+            (_, bl_value_handle, bl_cccd_handle) = yield from self._get_handles(self.UUID_CONTROL_POINT)
+            yield from self._enable_notifications(bl_cccd_handle)
 
         # Reset the board in DFU mode. After reset the board will be disconnected
-        cmd = 'char-write-req 0x%02x 0104' % (bl_value_handle)
-        if verbose: print(cmd)
-        self.ble_conn.sendline(cmd)
+        yield io(self.transport.write_req, bl_value_handle, [0x01, 0x04], wait=False)
 
-        time.sleep(0.5)
+        # The bootloader comes back at the same address, so the old link
+        # must be gone before connecting again
+        deadline = time.time() + self.reboot_timeout
+        yield from self._wait_for_link_loss(deadline)
 
         #print("Send 'START DFU' + Application Command")
         #self._dfu_state_set(0x0104)
 
         # Reconnect the board.
-        ret = self.scan_and_connect()
+        ret = yield from self._reconnect_after_reset(deadline)
         if verbose: print("Connected " + str(ret))
 
         return ret
@@ -239,36 +306,42 @@ class BleDfuControllerLegacy(NrfBleDfuController):
 
         if verbose: print(notify)
 
-        dfu_notify_opcode = Procedures.from_string(notify[0])
+        dfu_notify_opcode = notify[0]
 
         if dfu_notify_opcode == Procedures.RESPONSE:
 
-            dfu_procedure = Procedures.from_string(notify[1])
-            dfu_response  = Responses.from_string(notify[2])
+            dfu_procedure = notify[1]
+            dfu_response  = notify[2]
 
             procedure_str = Procedures.to_string(dfu_procedure)
             response_str  = Responses.to_string(dfu_response)
 
             if verbose: print("opcode: 0x%02x, proc: %s, res: %s" % (dfu_notify_opcode, procedure_str, response_str))
 
-            return (dfu_procedure, dfu_response)
+            return Response(dfu_procedure, dfu_response)
 
         if dfu_notify_opcode == Procedures.PACKET_RECEIPT_NOTIFICATION:
-            receipt = bytes_to_uint32_le(notify[1:5])
-            return (dfu_notify_opcode, Responses.SUCCESS, receipt)
+            (receipt,) = struct.unpack_from('<I', notify, 1)
+            return PacketReceipt(dfu_notify_opcode, Responses.SUCCESS, receipt)
 
     # --------------------------------------------------------------------------
     #  Wait for a notification and parse the response
     # --------------------------------------------------------------------------
     def _wait_and_parse_notify(self):
         if verbose: print("Waiting for notification")
-        notify = self._dfu_wait_for_notify()
+        notify = yield from self._dfu_wait_for_notify()
 
         if notify is None:
             raise Exception("No notification received")
 
         if verbose: print("Parsing notification")
 
+        return self._check_notify(notify)
+
+    # --------------------------------------------------------------------------
+    #  Parse a notification, raising on a response other than success
+    # --------------------------------------------------------------------------
+    def _check_notify(self, notify):
         result = self._dfu_parse_notify(notify)
         if result[1] != Responses.SUCCESS:
             raise Exception("Error in {} procedure, reason: {}".format(
@@ -277,6 +350,23 @@ class BleDfuControllerLegacy(NrfBleDfuController):
 
         return result
 
+    # --------------------------------------------------------------------------
+    #  Wait for a Packet Receipt Notification and verify the byte count
+    # --------------------------------------------------------------------------
+    def _dfu_check_receipt(self, expected_pkts, sent_time):
+        (proc, res, pkts) = yield from self._wait_and_parse_notify()
+
+        if res != Responses.SUCCESS:
+            raise Exception("bad notification status: {}".format(Responses.to_string(res)))
+
+        if pkts != expected_pkts:
+            raise Exception("bad packet receipt: {} bytes, expected {}".format(pkts, expected_pkts))
+
+        self.metrics.prn_rtt(self.notify_time - sent_time)
+        self.metrics.bytes_acked(pkts, self.image_size)
+
+        self._progress(pkts)
+
     #--------------------------------------------------------------------------
     # Send the Init info (*.dat file contents) to peripheral device.
     #--------------------------------------------------------------------------
@@ -284,7 +374,7 @@ class BleDfuControllerLegacy(NrfBleDfuController):
         if verbose: print("dfu_send_init")
 
         # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
+        init_bin_array = array('B', self.init_packet)
 
         # Transmit Init info
-        self._dfu_send_data(init_bin_array)
+        yield from self._dfu_send_data(init_bin_array)
@@ -1,12 +1,15 @@
 import math
-import pexpect
+import struct
 import time
-import binascii
+import collections
 
 from array import array
 from util  import *
 
 from nrf_ble_dfu_controller import NrfBleDfuController
+from prn import AdaptivePrn
+from retry import RetryPolicy
+from steps import io
 
 verbose = False
 
@@ -69,70 +72,106 @@ class Results:
     def from_string(res_str):
         return int(res_str, 16)
 
+# Parsed Control Point responses. Packet Receipt notifications are
+# ChecksumResponses too.
+Response         = collections.namedtuple('Response', 'procedure result')
+ChecksumResponse = collections.namedtuple('ChecksumResponse', 'procedure result offset crc32')
+SelectResponse   = collections.namedtuple('SelectResponse', 'procedure result max_size offset crc32')
 
 class BleDfuControllerSecure(NrfBleDfuController):
     # Class constants
+    PROFILE              = 'secure'
+
     UUID_CONTROL_POINT   = '8ec90001-f315-4f60-9fb8-838830daea50'
     UUID_PACKET          = '8ec90002-f315-4f60-9fb8-838830daea50'
     UUID_BUTTONLESS      = '8ec90003-f315-4f60-9fb8-838830daea50'
 
+    MODE_UUIDS = {
+        'app' : [UUID_BUTTONLESS],
+        'dfu' : [UUID_CONTROL_POINT, UUID_PACKET],
+    }
+
     # Constructor inherited from abstract base class
 
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
-    def start(self):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+    def _start(self):
+        self._phase('discovery')
+
+        yield from self._resolve_dfu_handles()
+
         if verbose:
             print('Control Point Handle: 0x%04x, CCCD: 0x%04x' % (self.ctrlpt_handle, self.ctrlpt_cccd_handle))
             print('Packet handle: 0x%04x' % (self.data_handle))
 
-        # Subscribe to notifications from Control Point characteristic
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+        yield from self._negotiate_mtu()
+
+        # Subscribe to notifications from Control Point characteristic.
+        # If cached handles fail, discover them and try again.
+        if not (yield from self._enable_notifications(self.ctrlpt_cccd_handle)) and self._drop_cached_handles():
+            yield from self._resolve_dfu_handles()
+            yield from self._enable_notifications(self.ctrlpt_cccd_handle)
 
         # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
+        yield from self._dfu_set_prn(self.pkt_receipt_interval)
+
+        # Remember where the bootloader is, in case the transfer is interrupted
+        self._journal_update(address=self.target_mac)
+
+        # One retry budget for the init packet and the data objects
+        self.retry = RetryPolicy(self.object_retries, self.session_retries)
+
+        self._phase('init')
+        yield from self._dfu_send_init()
+
+        yield from self._dfu_send_image()
 
-        self._dfu_send_init()
+        # The bootloader comes back for the next image of the package
+        if (yield from self._next_image()):
+            return (yield from self._start())
 
-        self._dfu_send_image()
+        self._phase_end()
 
     # --------------------------------------------------------------------------
     #  Check if the peripheral is running in bootloader (DFU) or application mode
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
-    def check_DFU_mode(self):
-        print("Checking DFU State...")
+    def _check_DFU_mode(self):
+        self.log("Checking DFU State...")
 
-        self.ble_conn.sendline('characteristics')
+        # The bootloader has an address of its own, so a device cached in
+        # one mode only is taken to be in that mode. A wrong guess shows as
+        # a failed write to the cached handles.
+        modes = self.handle_cache.modes(self.target_mac, self.PROFILE) if self.handle_cache is not None else []
+        if len(modes) == 1 and self._use_cached_handles(modes[0]):
+            return modes[0] == 'dfu'
 
-        dfu_mode = False
+        # One pass resolves the handles of either mode
+        handles = yield from self._discover_handles(self.MODE_UUIDS['app'] + self.MODE_UUIDS['dfu'], timeout=5)
+        self._use_handles('app' if self.UUID_BUTTONLESS in handles else 'dfu', handles)
 
-        try:
-            self.ble_conn.expect([self.UUID_BUTTONLESS], timeout=5)
-        except pexpect.TIMEOUT as e:
-            dfu_mode = True
+        return self.peer_mode == 'dfu'
 
-        return dfu_mode
+    def _switch_to_dfu_mode(self):
+        self._phase('switch')
 
-    def switch_to_dfu_mode(self):
-        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_BUTTONLESS)
+        (_, bl_value_handle, bl_cccd_handle) = yield from self._get_handles(self.UUID_BUTTONLESS)
 
-        self._enable_indications(bl_cccd_handle)
+        if not (yield from self._enable_indications(bl_cccd_handle)) and self._drop_cached_handles():
+            (_, bl_value_handle, bl_cccd_handle) = yield from self._get_handles(self.UUID_BUTTONLESS)
+            yield from self._enable_indications(bl_cccd_handle)
 
         # Reset the board in DFU mode. After reset the board will be disconnected
-        cmd = 'char-write-req 0x%04x 01' % (bl_value_handle)
-        self.ble_conn.sendline(cmd)
+        yield io(self.transport.write_req, bl_value_handle, [0x01], wait=False)
 
-        # Wait some time for board to reboot
-        time.sleep(1)
-        print("Switched to DFU mode Successfully")
+        deadline = time.time() + self.reboot_timeout
+        yield from self._wait_for_link_loss(deadline)
+        self.log("Switched to DFU mode Successfully")
 
-        # Increase the mac address by one and reconnect
-        self.target_mac_increase(1)
-        return self.scan_and_connect()
+        # The bootloader advertises at the mac address plus one
+        yield from self._target_mac_increase(1)
+        return (yield from self._reconnect_after_reset(deadline))
 
     # --------------------------------------------------------------------------
     #  Parse notification status results
@@ -144,11 +183,11 @@ class BleDfuControllerSecure(NrfBleDfuController):
 
         if verbose: print(notify)
 
-        dfu_notify_opcode = Procedures.from_string(notify[0])
+        dfu_notify_opcode = notify[0]
         if dfu_notify_opcode == Procedures.RESPONSE:
 
-            dfu_procedure = Procedures.from_string(notify[1])
-            dfu_result  = Results.from_string(notify[2])
+            dfu_procedure = notify[1]
+            dfu_result  = notify[2]
 
             procedure_str = Procedures.to_string(dfu_procedure)
             result_str  = Results.to_string(dfu_result)
@@ -159,85 +198,115 @@ class BleDfuControllerSecure(NrfBleDfuController):
             # Packet Receipt notifications are sent in the exact same format
             # as responses to the CALC_CHECKSUM procedure.
             if(dfu_procedure == Procedures.CALC_CHECKSUM and dfu_result == Results.SUCCESS):
-                offset = bytes_to_uint32_le(notify[3:7])
-                crc32 = bytes_to_uint32_le(notify[7:11])
+                (offset, crc32) = struct.unpack_from('<II', notify, 3)
 
-                return (dfu_procedure, dfu_result, offset, crc32)
+                return ChecksumResponse(dfu_procedure, dfu_result, offset, crc32)
 
             elif(dfu_procedure == Procedures.SELECT and dfu_result == Results.SUCCESS):
-                max_size = bytes_to_uint32_le(notify[3:7])
-                offset = bytes_to_uint32_le(notify[7:11])
-                crc32 = bytes_to_uint32_le(notify[11:15])
+                (max_size, offset, crc32) = struct.unpack_from('<III', notify, 3)
 
-                return (dfu_procedure, dfu_result, max_size, offset, crc32)
+                return SelectResponse(dfu_procedure, dfu_result, max_size, offset, crc32)
 
             else:
-                return (dfu_procedure, dfu_result)
+                return Response(dfu_procedure, dfu_result)
 
     # --------------------------------------------------------------------------
     #  Wait for a notification and parse the response
     # --------------------------------------------------------------------------
-    def _wait_and_parse_notify(self):
+    def _wait_and_parse_notify(self, timeout=30):
         if verbose: print("Waiting for notification")
-        notify = self._dfu_wait_for_notify()
+        notify = yield from self._dfu_wait_for_notify(timeout)
 
         if notify is None:
             raise Exception("No notification received")
 
         if verbose: print("Parsing notification")
 
+        return self._check_notify(notify)
+
+    # --------------------------------------------------------------------------
+    #  Parse a notification, raising on a result other than success
+    # --------------------------------------------------------------------------
+    def _check_notify(self, notify):
         result = self._dfu_parse_notify(notify)
         if result[1] != Results.SUCCESS:
             raise Exception("Error in {} procedure, reason: {}".format(
                 Procedures.to_string(result[0]),
-                Results.to_string(result[1])))       
+                Results.to_string(result[1])))
 
         return result
 
     # --------------------------------------------------------------------------
     #  Send the Init info (*.dat file contents) to peripheral device.
+    #  Failed attempts count against the retry budgets like data objects do.
     # --------------------------------------------------------------------------
     def _dfu_send_init(self):
         if verbose: print("dfu_send_init")
 
         # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
+        init_bin_array = array('B', self.init_packet)
+
+        while not (yield from self._dfu_send_init_attempt(init_bin_array)):
+            self.metrics.retransmit(0, 'init')
+
+            # Back off, then select the init packet again: the peer reports
+            # how much of it it holds
+            yield io(self._sleep, self.retry.failure(0))
+            yield from self._dfu_drop_receipts(self.pkt_receipt_interval)
+
+        self.retry.object_done()
+
+        # Execute command
+        yield from self._dfu_send_command(Procedures.EXECUTE)
+        yield from self._wait_and_parse_notify()
+
+        self.log("Init packet successfully transfered")
+
+    # --------------------------------------------------------------------------
+    #  One attempt at getting the whole init packet onto the peer.
+    #  Returns False if a receipt or the checksum shows data was lost.
+    # --------------------------------------------------------------------------
+    def _dfu_send_init_attempt(self, init_bin_array):
         init_size = len(init_bin_array)
-        init_crc = 0;
+        init_crc = crc32_unsigned(init_bin_array)
 
         # Select command
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND]);
-        (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
+        yield from self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND]);
+        (proc, res, max_size, offset, crc32) = yield from self._wait_and_parse_notify()
 
-        if offset != init_size or crc32 != init_crc:
-            if offset == 0 or offset > init_size:
-                # Create command
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_COMMAND] + uint32_to_bytes_le(init_size))
-                res = self._wait_and_parse_notify()
+        if offset == init_size and crc32 == init_crc:
+            # Left by an interrupted transfer of the same update
+            self.log("Init packet already on the peer")
+            return True
 
-            segment_count = 0
-            segment_total = int(math.ceil(init_size/float(self.pkt_payload_size)))
+        # Complete a partly sent init packet, or send it from the start
+        if offset == 0 or offset > init_size or crc32 != crc32_unsigned(init_bin_array[:offset]):
+            # Create command
+            yield from self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_COMMAND] + uint32_to_bytes_le(init_size))
+            yield from self._wait_and_parse_notify()
+            offset = 0
 
-            for i in range(0, init_size, self.pkt_payload_size):
-                segment = init_bin_array[i:i + self.pkt_payload_size]
-                self._dfu_send_data(segment)
-                segment_count += 1
+        segment_count = 0
 
-                if (segment_count % self.pkt_receipt_interval) == 0:
-                    (proc, res, offset, crc32) = self._wait_and_parse_notify()
+        for i in range(offset, init_size, self.pkt_payload_size):
+            segment = init_bin_array[i:i + self.pkt_payload_size]
+            yield from self._dfu_send_data(segment)
+            segment_count += 1
 
-                    if res != Results.SUCCESS:
-                        raise Exception("bad notification status: {}".format(Results.to_string(res)))
+            if (segment_count % self.pkt_receipt_interval) == 0:
+                notify = yield from self._dfu_wait_for_notify(self.retry.next_receipt_timeout())
+                if notify is None:
+                    return False
 
-            # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            self._wait_and_parse_notify()
+                (proc, res, receipt_offset, crc32) = self._check_notify(notify)
+                if receipt_offset != i + len(segment) or crc32 != crc32_unsigned(init_bin_array[:receipt_offset]):
+                    return False
 
-        # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
-        self._wait_and_parse_notify()
+        # Calculate CRC
+        yield from self._dfu_send_command(Procedures.CALC_CHECKSUM)
+        (proc, res, offset, crc32) = yield from self._wait_and_parse_notify()
 
-        print("Init packet successfully transfered")
+        return offset == init_size and crc32 == init_crc
 
     # --------------------------------------------------------------------------
     #  Send the Firmware image to peripheral device.
@@ -246,79 +315,243 @@ class BleDfuControllerSecure(NrfBleDfuController):
         if verbose: print("dfu_send_image")
 
         # Select Data Object
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_DATA])
-        (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
+        yield from self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_DATA])
+        (proc, res, max_size, offset, crc32) = yield from self._wait_and_parse_notify()
 
         # Split the firmware into multiple objects
+        self.image.prepare_objects(max_size)
         num_objects = int(math.ceil(self.image_size / float(max_size)))
-        print("Max object size: %d, num objects: %d, offset: %d, total size: %d" % (max_size, num_objects, offset, self.image_size))
+        self.log("Max object size: %d, num objects: %d, offset: %d, total size: %d" % (max_size, num_objects, offset, self.image_size))
 
         time_start = time.time()
-        last_send_time = time.time()
 
-        obj_offset = (offset/max_size)*max_size
+        if self.adaptive_prn:
+            self.prn_ctrl = AdaptivePrn(self.pkt_receipt_interval)
+
+        # Resume where the bootloader left off
+        (obj_offset, resume_at, execute) = self._resume_point(max_size, offset, crc32)
+        if obj_offset > 0 or resume_at is not None:
+            self.log("Resuming at offset %d" % (resume_at or obj_offset))
+        if execute:
+            yield from self._dfu_execute_resumed(obj_offset)
+
         while(obj_offset < self.image_size):
-            # print("\nSending object {} of {}".format(obj_offset/max_size+1, num_objects))
-            obj_offset += self._dfu_send_object(obj_offset, max_size)
+            sent = yield from self._dfu_send_object(obj_offset, max_size, resume_at)
+            resume_at = None
+
+            if sent == 0:
+                # Back off, then carry on from what the peer verifiably holds
+                yield io(self._sleep, self.retry.failure(obj_offset))
+                resume_at = yield from self._dfu_resync(obj_offset, min(obj_offset + max_size, self.image_size))
+                continue
+
+            self.retry.object_done()
+            obj_offset += sent
+
+            # Object boundary, re-tune the receipt interval
+            if self.adaptive_prn and obj_offset < self.image_size:
+                interval = self.prn_ctrl.next_interval()
+                if interval != self.pkt_receipt_interval:
+                    if verbose: print("PRN interval: {} (rtt {:.1f} ms)".format(interval, self.prn_ctrl.rtt * 1000))
+                    yield from self._dfu_set_prn(interval)
 
         # Image uploaded successfully, update the progress bar
-        print_progress(self.image_size, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+        self._progress(self.image_size)
 
         duration = time.time() - time_start
-        print("\nUpload complete in {} minutes and {} seconds".format(int(duration / 60), int(duration % 60)))
+        self.log("Upload complete in {} minutes and {} seconds".format(int(duration / 60), int(duration % 60)))
+
+        self._journal_remove()
+
+    # --------------------------------------------------------------------------
+    #  Where to carry on after SELECT reported the peer's offset and crc32:
+    #  (object offset, resume_at, execute).
+    #  If the peer's data up to offset matches the image, the object holding
+    #  offset is completed from resume_at; otherwise that object is sent
+    #  again from its start. Data ending at an object boundary is a complete
+    #  object and the transfer goes on with the next one. Unless the journal
+    #  recorded that object as executed, it is executed first.
+    # --------------------------------------------------------------------------
+    def _resume_point(self, max_size, offset, crc32):
+        if not 0 < offset <= self.image_size:
+            return (0, None, False)
+
+        obj_offset = ((offset - 1) // max_size) * max_size
+        if crc32 != self._image_crc(offset):
+            return (obj_offset, None, False)
+
+        if offset < min(obj_offset + max_size, self.image_size):
+            return (obj_offset, offset, False)
+
+        return (offset, None, self._journal_offset() != offset)
+
+    # --------------------------------------------------------------------------
+    #  Execute the complete object ending at offset, found on resume. The
+    #  link may have dropped before or after the object was executed; a
+    #  bootloader refuses to execute an object twice, which means it was.
+    # --------------------------------------------------------------------------
+    def _dfu_execute_resumed(self, offset):
+        yield from self._dfu_send_command(Procedures.EXECUTE)
+        notify = yield from self._dfu_wait_for_notify(30)
+        if notify is None:
+            raise Exception("No notification received")
+
+        if self._dfu_parse_notify(notify)[1] != Results.OPERATION_NOT_PERMITTED:
+            self._check_notify(notify)
+
+        self.metrics.bytes_acked(offset, self.image_size)
+        self._journal_update(offset=offset)
 
     # --------------------------------------------------------------------------
     #  Send a single data object of given size and offset.
+    #  With resume_at, the object already exists on the peer and holds the
+    #  data up to resume_at: only the rest is sent.
     # --------------------------------------------------------------------------
-    def _dfu_send_object(self, offset, obj_max_size):
-        if offset != self.image_size:
-            if offset == 0 or offset >= obj_max_size or crc32 != crc32_unsigned(self.bin_array[0:offset]):
-                # Create Data Object
-                size = min(obj_max_size, self.image_size - offset)
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_DATA] + uint32_to_bytes_le(int(size)))
-                self._wait_and_parse_notify()
+    def _dfu_send_object(self, offset, obj_max_size, resume_at=None):
+        self._phase('object %d' % (offset // obj_max_size))
+        obj_end = min(offset + obj_max_size, self.image_size)
+
+        if resume_at is None:
+            # Create Data Object
+            yield from self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_DATA] + uint32_to_bytes_le(int(obj_end - offset)))
+            yield from self._wait_and_parse_notify()
+            resume_at = offset
 
-            segment_count = 0
-            segment_total = int(math.ceil(min(obj_max_size, self.image_size-offset)/float(self.pkt_payload_size)))
+        segment_count = 0
+        segment_total = int(math.ceil((obj_end - resume_at)/float(self.pkt_payload_size)))
 
-            segment_begin = int(offset)
-            segment_end = int(min(offset+obj_max_size, self.image_size))
+        segment_begin = int(resume_at)
+        segment_end = int(obj_end)
 
-            for i in range(segment_begin, segment_end, self.pkt_payload_size):
-                num_bytes = min(self.pkt_payload_size, segment_end - i)
-                segment = self.bin_array[i:i + num_bytes]
-                self._dfu_send_data(segment)
-                segment_count += 1
+        # Receipts in flight: (expected offset, time the window was sent)
+        pending = collections.deque()
 
-                # print("j: {} i: {}, end: {}, bytes: {}, size: {} segment #{} of {}".format(
-                #     offset, i, segment_end, num_bytes, self.image_size, segment_count, segment_total))
+        if self.pkt_receipt_window > 1:
+            self._start_notify_reader(count=segment_total // self.pkt_receipt_interval)
+
+        # Packets go out a receipt window at a time
+        window_size = self.pkt_receipt_interval * self.pkt_payload_size
+
+        try:
+            for i in range(segment_begin, segment_end, window_size):
+                window_end = min(i + window_size, segment_end)
+                yield from self._dfu_send_image_window(i, window_end)
+                segment_count += int(math.ceil((window_end - i) / float(self.pkt_payload_size)))
 
                 if (segment_count % self.pkt_receipt_interval) == 0:
-                    try:
-                        (proc, res, offset, crc32) = self._wait_and_parse_notify()
-                    except e:
-                        # Likely no notification received, need to re-transmit object
-                        return 0
-
-                    if res != Results.SUCCESS:
-                        raise Exception("bad notification status: {}".format(Results.to_string(res)))
-                 
-                    if crc32 != crc32_unsigned(self.bin_array[0:offset]):
-                        # Something went wrong, need to re-transmit this object
-                        return 0
-
-                    print_progress(offset, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
-
-            # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            (proc, res, offset, crc32) = self._wait_and_parse_notify()
-            if(crc32 != crc32_unsigned(self.bin_array[0:offset])):
-                # Need to re-transmit object
-                return 0
+                    pending.append((window_end, time.time()))
+
+                    # Only block once the window of outstanding receipts is full
+                    if len(pending) >= self.pkt_receipt_window:
+                        if not (yield from self._dfu_check_receipt(*pending.popleft())):
+                            self.metrics.retransmit(offset, 'receipt')
+                            return 0
+
+            while pending:
+                if not (yield from self._dfu_check_receipt(*pending.popleft())):
+                    self.metrics.retransmit(offset, 'receipt')
+                    return 0
+
+        finally:
+            self._stop_notify_reader()
+
+        # Calculate CRC
+        yield from self._dfu_send_command(Procedures.CALC_CHECKSUM)
+        (proc, res, crc_offset, crc32) = yield from self._wait_and_parse_notify()
+        if(crc_offset != obj_end or crc32 != self._image_crc(crc_offset)):
+            # Need to re-transmit object. A short offset with a matching
+            # CRC means the last packets were lost.
+            if crc32 != self._image_crc(crc_offset):
+                self.metrics.crc_mismatch(crc_offset, self._image_crc(crc_offset), crc32)
+            self.metrics.retransmit(offset, 'checksum')
+            return 0
 
         # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
-        self._wait_and_parse_notify()
+        yield from self._dfu_send_command(Procedures.EXECUTE)
+        yield from self._wait_and_parse_notify()
+        self.metrics.bytes_acked(obj_end, self.image_size)
+        self._journal_update(offset=obj_end)
 
         # If everything executed correctly, return amount of bytes transfered
         return obj_max_size
+
+    # --------------------------------------------------------------------------
+    #  Wait for a Packet Receipt Notification and verify it against the
+    #  expected offset and the image CRC.
+    #  Returns False if the object needs to be re-transmitted.
+    # --------------------------------------------------------------------------
+    def _dfu_check_receipt(self, expected_offset, sent_time):
+        notify = yield from self._dfu_wait_for_notify(self.retry.next_receipt_timeout())
+        if notify is None:
+            # No receipt in time, need to re-transmit object
+            if self.adaptive_prn: self.prn_ctrl.error()
+            return False
+
+        # Error results and malformed receipts are not retried
+        (proc, res, offset, crc32) = self._check_notify(notify)
+
+        if offset != expected_offset or crc32 != self._image_crc(offset):
+            # Something went wrong, need to re-transmit this object
+            if crc32 != self._image_crc(offset):
+                self.metrics.crc_mismatch(offset, self._image_crc(offset), crc32)
+            if self.adaptive_prn: self.prn_ctrl.error()
+            return False
+
+        if self.adaptive_prn: self.prn_ctrl.receipt(sent_time, self.notify_time)
+        self.retry.receipt(self.notify_time - sent_time)
+
+        self.metrics.prn_rtt(self.notify_time - sent_time)
+        self.metrics.bytes_acked(offset, self.image_size)
+
+        self._progress(offset)
+
+        return True
+
+    # --------------------------------------------------------------------------
+    #  Bring the peer and the sender back in step after a failed attempt at
+    #  the object [obj_offset, obj_end). Setting the PRN interval restarts the
+    #  receipt count, and its response follows any receipts still in flight.
+    #  Returns the offset to continue the object from if the peer holds a
+    #  valid part of it (at least up to the last verified receipt), or None
+    #  if the object has to be created again.
+    # --------------------------------------------------------------------------
+    def _dfu_resync(self, obj_offset, obj_end):
+        interval = self.pkt_receipt_interval
+        if self.adaptive_prn:
+            interval = self.prn_ctrl.next_interval()
+
+        yield from self._dfu_drop_receipts(interval)
+
+        yield from self._dfu_send_command(Procedures.CALC_CHECKSUM)
+        (proc, res, offset, crc32) = yield from self._wait_and_parse_notify()
+
+        if obj_offset < offset <= obj_end and crc32 == self._image_crc(offset):
+            if verbose: print("Continuing object at offset {}".format(offset))
+            return offset
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Set the PRN interval after a failed attempt. Its response follows any
+    #  receipts still in flight, which are dropped.
+    # --------------------------------------------------------------------------
+    def _dfu_drop_receipts(self, interval):
+        yield from self._dfu_send_command(Procedures.SET_PRN, uint16_to_bytes_le(interval))
+        while (yield from self._wait_and_parse_notify())[0] != Procedures.SET_PRN:
+            pass
+        self.pkt_receipt_interval = interval
+
+    # --------------------------------------------------------------------------
+    #  Set the Packet Receipt Notification interval
+    # --------------------------------------------------------------------------
+    def _dfu_set_prn(self, interval):
+        yield from self._dfu_send_command(Procedures.SET_PRN, uint16_to_bytes_le(interval))
+        yield from self._wait_and_parse_notify()
+        self.pkt_receipt_interval = interval
+
+    # --------------------------------------------------------------------------
+    #  CRC32 of the image prefix [0:offset]. The prepared image keeps the
+    #  CRCs computed so far, for this session and the ones sharing it.
+    # --------------------------------------------------------------------------
+    def _image_crc(self, offset):
+        return self.image.crc(offset)
@@ -12,10 +12,18 @@ import time
 import math
 import traceback
 
-from unpacker import Unpacker
+from package import Package
 
 from ble_secure_dfu_controller import BleDfuControllerSecure
 from ble_legacy_dfu_controller import BleDfuControllerLegacy
+from transport import create_transport, TRANSPORTS, GatttoolPool
+from fleet import load_device_list, FleetScheduler, print_report
+from adapters import list_adapters
+from metrics import create_sinks
+from journal import DfuJournal, DEFAULT_JOURNAL_PATH
+from handle_cache import HandleCache, DEFAULT_HANDLE_CACHE_PATH
+from image_cache import ImageCache, DEFAULT_IMAGE_CACHE_PATH, DEFAULT_IMAGE_CACHE_SIZE
+from scanner import start_scanner, stop_scanners, registry
 
 def main():
 
@@ -79,6 +87,208 @@ def main():
                   help='Use secure bootloader (Nordic SDK < 12)'
                   )
 
+        parser.add_option('-m', '--mtu',
+                  action='store',
+                  dest="mtu",
+                  type="int",
+                  default=None,
+                  help='Largest ATT MTU to request (secure bootloader only).'
+                  )
+
+        parser.add_option('--adaptive-prn',
+                  action='store_true',
+                  dest='adaptive_prn',
+                  default=False,
+                  help='Adapt the packet receipt interval to the link (secure bootloader only).'
+                  )
+
+        parser.add_option('-w', '--window',
+                  action='store',
+                  dest="window",
+                  type="int",
+                  default=1,
+                  help='Packet receipt windows kept in flight while sending (default 1).'
+                  )
+
+        parser.add_option('--object-retries',
+                  action='store',
+                  dest="object_retries",
+                  type="int",
+                  default=5,
+                  help='Retries of one data object before giving up (secure bootloader only, default 5).'
+                  )
+
+        parser.add_option('--session-retries',
+                  action='store',
+                  dest="session_retries",
+                  type="int",
+                  default=30,
+                  help='Retries of data objects in one update before giving up (secure bootloader only, default 30).'
+                  )
+
+        parser.add_option('--fleet',
+                  action='store',
+                  dest="fleet",
+                  type="string",
+                  default=None,
+                  help='Update every device in a CSV or JSON device list instead of -a.'
+                  )
+
+        parser.add_option('--concurrency',
+                  action='store',
+                  dest="concurrency",
+                  type="int",
+                  default=4,
+                  help='Fleet mode: devices updated at the same time (default 4).'
+                  )
+
+        parser.add_option('--retries',
+                  action='store',
+                  dest="retries",
+                  type="int",
+                  default=2,
+                  help='Fleet mode: retries for a failed device (default 2).'
+                  )
+
+        parser.add_option('--session-timeout',
+                  action='store',
+                  dest="session_timeout",
+                  type="int",
+                  default=600,
+                  help='Fleet mode: seconds allowed for one update attempt (default 600).'
+                  )
+
+        parser.add_option('--report',
+                  action='store',
+                  dest="report",
+                  type="string",
+                  default=None,
+                  help='Fleet mode: write the summary report as JSON to this file.'
+                  )
+
+        parser.add_option('-i', '--adapter',
+                  action='store',
+                  dest="adapter",
+                  type="string",
+                  default=None,
+                  help='Bluetooth adapter to use (hci0, hci1, ...).'
+                  )
+
+        parser.add_option('--adapters',
+                  action='store',
+                  dest="adapters",
+                  type="string",
+                  default=None,
+                  help='Fleet mode: comma separated adapters to spread sessions over, or "all".'
+                  )
+
+        parser.add_option('--adapter-budget',
+                  action='store',
+                  dest="adapter_budget",
+                  type="int",
+                  default=4,
+                  help='Fleet mode: concurrent connections per adapter (default 4).'
+                  )
+
+        parser.add_option('-t', '--transport',
+                  action='store',
+                  dest="transport",
+                  type="choice",
+                  choices=sorted(TRANSPORTS.keys()),
+                  default='gatttool',
+                  help='BLE transport: gatttool or socket (native ATT over L2CAP).'
+                  )
+
+        parser.add_option('--metrics-jsonl',
+                  action='store',
+                  dest="metrics_jsonl",
+                  type="string",
+                  default=None,
+                  help='Append transfer metrics as JSON lines to this file ("-" for stdout).'
+                  )
+
+        parser.add_option('--metrics-prom',
+                  action='store',
+                  dest="metrics_prom",
+                  type="string",
+                  default=None,
+                  help='Keep transfer metrics in this Prometheus text file.'
+                  )
+
+        parser.add_option('--scan-timeout',
+                  action='store',
+                  dest="scan_timeout",
+                  type="int",
+                  default=None,
+                  help='Scan up to this many seconds for the target before each connection (needs hcitool).'
+                  )
+
+        parser.add_option('--reboot-timeout',
+                  action='store',
+                  dest="reboot_timeout",
+                  type="int",
+                  default=15,
+                  help='Seconds a device may take to reboot into its bootloader and accept a connection.'
+                  )
+
+        parser.add_option('--background-scan',
+                  action='store_true',
+                  dest="background_scan",
+                  default=False,
+                  help='Keep the adapters scanning and look targets up in the devices seen, instead of scanning before each connection (needs root). Implies --scan-timeout 10.'
+                  )
+
+        parser.add_option('--gatttool',
+                  action='store',
+                  dest="gatttool",
+                  type="string",
+                  default='gatttool',
+                  help='gatttool command to run, e.g. "python3 dfu_sim.py --secure" to use the simulator.'
+                  )
+
+        parser.add_option('--gatttool-pool',
+                  action='store',
+                  dest="gatttool_pool",
+                  type="int",
+                  default=None,
+                  help='Fleet mode: gatttool processes kept per adapter and reused across sessions, by default as many as its connections (0: one process per session).'
+                  )
+
+        parser.add_option('--journal',
+                  action='store',
+                  dest="journal",
+                  type="string",
+                  default=None,
+                  metavar='FILE',
+                  help='Record transfer progress in FILE, e.g. %s, and resume an interrupted update from it (off by default).' % DEFAULT_JOURNAL_PATH
+                  )
+
+        parser.add_option('--handle-cache',
+                  action='store',
+                  dest="handle_cache",
+                  type="string",
+                  default=None,
+                  metavar='FILE',
+                  help='Keep discovered GATT handles in FILE, e.g. %s, and reuse them (off by default: handles are discovered on every connection).' % DEFAULT_HANDLE_CACHE_PATH
+                  )
+
+        parser.add_option('--image-cache',
+                  action='store',
+                  dest="image_cache",
+                  type="string",
+                  default=None,
+                  metavar='DIR',
+                  help='Keep prepared firmware images (binary, encoded payload, CRCs) in DIR, e.g. %s, and reuse them (off by default: images are kept in memory only).' % DEFAULT_IMAGE_CACHE_PATH
+                  )
+
+        parser.add_option('--image-cache-size',
+                  action='store',
+                  dest="image_cache_size",
+                  type="int",
+                  default=DEFAULT_IMAGE_CACHE_SIZE // (1024 * 1024),
+                  help='Size budget of the image cache in MiB, least recently used images are dropped beyond it (default %default, with --image-cache).'
+                  )
+
         options, args = parser.parse_args()
 
     except Exception as e:
@@ -86,17 +296,25 @@ def main():
         print("For help use --help")
         sys.exit(2)
 
+    sinks  = []
+    images = None
+
     try:
 
         ''' Validate input parameters '''
 
-        if not options.address:
+        if not options.address and not options.fleet:
             parser.print_help()
             exit(2)
 
-        unpacker = None
+        package  = None
         hexfile  = None
         datfile  = None
+        metrics  = None
+        sinks    = create_sinks(options.metrics_jsonl, options.metrics_prom)
+        journal  = DfuJournal(options.journal) if options.journal else None
+        handles  = HandleCache(options.handle_cache) if options.handle_cache else None
+        images   = ImageCache(options.image_cache, options.image_cache_size * 1024 * 1024)
 
         if options.zipfile != None:
 
@@ -104,15 +322,18 @@ def main():
                 print("Conflicting input directives")
                 exit(2)
 
-            unpacker = Unpacker()
             #print(options.zipfile)
             try:
-                hexfile, datfile = unpacker.unpack_zipfile(options.zipfile)	
+                package = Package(options.zipfile)
             except Exception as e:
                 print("ERR")
                 print(e)
                 pass
 
+        elif options.fleet and not options.hexfile and not options.datfile:
+            # Every device in the list brings its own package
+            pass
+
         else:
             if (not options.hexfile) or (not options.datfile):
                 parser.print_help()
@@ -132,54 +353,194 @@ def main():
 
         ''' Start of Device Firmware Update processing '''
 
-        if options.secure_dfu:
-            ble_dfu = BleDfuControllerSecure(options.address.upper(), hexfile, datfile)
+        if options.background_scan:
+            if options.scan_timeout is None:
+                options.scan_timeout = 10
+            for adapter in scan_adapters(options):
+                if start_scanner(adapter) is None:
+                    print("No background scan on {}, scanning per connection".format(adapter))
+
+        if options.fleet:
+            fleet_main(options, hexfile, datfile, sinks, journal, handles, package, images)
         else:
-            ble_dfu = BleDfuControllerLegacy(options.address.upper(), hexfile, datfile)
+            transport = create_transport(options.transport, options.address.upper(), options.adapter,
+                                         **transport_options(options))
+
+            if options.secure_dfu:
+                ble_dfu = BleDfuControllerSecure(options.address.upper(), hexfile, datfile, transport)
+            else:
+                ble_dfu = BleDfuControllerLegacy(options.address.upper(), hexfile, datfile, transport)
+
+            if options.mtu and options.secure_dfu:
+                ble_dfu.max_att_mtu = options.mtu
 
+            ble_dfu.package = package
+            ble_dfu.adaptive_prn = options.adaptive_prn and options.secure_dfu
+            ble_dfu.pkt_receipt_window = max(1, options.window)
+            ble_dfu.object_retries = options.object_retries
+            ble_dfu.session_retries = options.session_retries
+            ble_dfu.journal = journal
+            ble_dfu.handle_cache = handles
+            ble_dfu.image_cache = images
+            ble_dfu.scan_timeout = options.scan_timeout
+            ble_dfu.reboot_timeout = options.reboot_timeout
 
-        # Initialize inputs
-        ble_dfu.input_setup()
+            metrics = ble_dfu.metrics
+            for sink in sinks:
+                metrics.add_sink(sink)
 
-        # Connect to peer device. Assume application mode.
-        if ble_dfu.scan_and_connect():
-            if not ble_dfu.check_DFU_mode():
-                print("Need to switch to DFU mode")
-                success = ble_dfu.switch_to_dfu_mode()
-                if not success:
-                    print("Couldn't reconnect")
+
+            # Initialize inputs
+            ble_dfu.input_setup()
+
+            # Connect to peer device. Assume application mode.
+            success = True
+            if ble_dfu.resume_interrupted():
+                ble_dfu.start()
+            elif ble_dfu.scan_and_connect():
+                if not ble_dfu.check_DFU_mode():
+                    print("Need to switch to DFU mode")
+                    success = ble_dfu.switch_to_dfu_mode()
+                    if not success:
+                        print("Couldn't reconnect")
+                    else:
+                        ble_dfu.start()
                 else:
                     ble_dfu.start()
             else:
-                ble_dfu.start()
-        else:
-            print("Couldn't connect, will try DFU MAC")
-            # The device might already be in DFU mode (MAC + 1)
-            ble_dfu.target_mac_increase(1)
+                print("Couldn't connect, will try DFU MAC")
+                # The device might already be in DFU mode (MAC + 1)
+                ble_dfu.target_mac_increase(1)
 
-            # Try connection with new address
-            if ble_dfu.scan_and_connect():
-                ble_dfu.start()
-            else:
-                raise Exception("Can't connect to device")
+                # Try connection with new address
+                if ble_dfu.scan_and_connect():
+                    ble_dfu.start()
+                else:
+                    raise Exception("Can't connect to device")
 
-        # Disconnect from peer device if not done already and clean up.
-        ble_dfu.disconnect()
+            # Disconnect from peer device if not done already and clean up.
+            ble_dfu.disconnect()
+
+            metrics.result(success, None if success else "Couldn't reconnect")
 
     except Exception as e:
         # print(traceback.format_exc())
         print("Exception at line {}: {}".format(sys.exc_info()[2].tb_lineno, e))
+        if metrics is not None:
+            metrics.result(False, str(e))
         pass
 
     except:
         pass
 
-    # If Unpacker for zipfile used then delete Unpacker
-    if unpacker != None:
-        unpacker.delete()
+    finally:
+        # Whatever happened, keep what the sessions prepared for the next run
+        stop_scanners()
+        if images is not None:
+            images.flush()
+
+        for sink in sinks:
+            sink.close()
 
     print("DFU Server done")
 
+"""
+------------------------------------------------------------------------------
+ Options passed to the transport constructor
+------------------------------------------------------------------------------
+"""
+def transport_options(options):
+    if options.transport == 'gatttool':
+        return {'command': options.gatttool}
+    return {}
+
+"""
+------------------------------------------------------------------------------
+ Adapters the fleet spreads sessions over, None for the default adapter
+------------------------------------------------------------------------------
+"""
+def fleet_adapters(options):
+    if options.adapters == 'all':
+        return list_adapters()
+    elif options.adapters:
+        return [name.strip() for name in options.adapters.split(',')]
+    elif options.adapter:
+        return [options.adapter]
+    return None
+
+"""
+------------------------------------------------------------------------------
+ Adapters to run background scanners on
+------------------------------------------------------------------------------
+"""
+def scan_adapters(options):
+    if options.fleet:
+        return fleet_adapters(options) or ['hci0']
+    return [options.adapter or 'hci0']
+
+"""
+------------------------------------------------------------------------------
+ Fleet mode: update all devices of a device list concurrently
+------------------------------------------------------------------------------
+"""
+def fleet_main(options, hexfile, datfile, metrics_sinks=None, journal=None, handle_cache=None, package=None,
+               image_cache=None):
+    jobs = load_device_list(options.fleet)
+    print("Fleet update of {} devices, {} at a time".format(len(jobs), options.concurrency))
+
+    session_options = {
+        'adaptive_prn'       : options.adaptive_prn and options.secure_dfu,
+        'pkt_receipt_window' : max(1, options.window),
+        'journal'            : journal,
+        'handle_cache'       : handle_cache,
+        'image_cache'        : image_cache,
+        'scan_timeout'       : options.scan_timeout,
+        'reboot_timeout'     : options.reboot_timeout,
+        'object_retries'     : options.object_retries,
+        'session_retries'    : options.session_retries,
+    }
+    if options.mtu and options.secure_dfu:
+        session_options['max_att_mtu'] = options.mtu
+
+    adapters = fleet_adapters(options)
+    if options.adapters == 'all':
+        print("Adapters: {}".format(', '.join(adapters)))
+
+    # Sessions take gatttool processes from a pool and hand them on
+    pool = None
+    fleet_transport_options = transport_options(options)
+    pool_size = options.gatttool_pool
+    if pool_size is None:
+        pool_size = min(options.concurrency, options.adapter_budget) if adapters else options.concurrency
+
+    if options.transport == 'gatttool' and pool_size > 0:
+        pool = GatttoolPool(options.gatttool, pool_size)
+        for adapter in adapters or [None]:
+            pool.fill(adapter)
+        fleet_transport_options['pool'] = pool
+
+    scheduler = FleetScheduler(jobs,
+                               firmware=package or ((hexfile, datfile) if hexfile else None),
+                               secure=options.secure_dfu,
+                               transport=options.transport,
+                               transport_options=fleet_transport_options,
+                               concurrency=options.concurrency,
+                               retries=options.retries,
+                               session_timeout=options.session_timeout,
+                               session_options=session_options,
+                               adapters=adapters,
+                               adapter_budget=options.adapter_budget,
+                               metrics_sinks=metrics_sinks,
+                               registry=registry if options.background_scan else None)
+
+    try:
+        report = scheduler.run()
+    finally:
+        if pool is not None:
+            pool.close()
+
+    print_report(report, options.report)
+
 """
 ------------------------------------------------------------------------------
 
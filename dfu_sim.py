@@ -0,0 +1,869 @@
+#!/usr/bin/env python3
+
+#------------------------------------------------------------------------------
+# Simulated nRF5 DFU peer
+#
+# A local stand-in for a device running the secure (SDK >= 12) or legacy
+# (SDK <= 11) bootloader, for testing and benchmarking without hardware.
+#
+# Two front ends:
+#   * Run as a program it behaves like "gatttool --interactive", so it can be
+#     given to GatttoolTransport as its command, or to dfu.py --gatttool:
+#
+#       dfu.py -f app.bin -d app.dat -a CD:E3:4A:47:1C:E4 \
+#              --gatttool "python3 dfu_sim.py --secure --link-latency 0.005"
+#
+#   * SimAttSocketTransport / SimAsyncAttSocketTransport replace the L2CAP
+#     socket of the ATT socket backends with a socket pair served by a
+#     simulated ATT server thread.
+#
+# Object size, flash write latency, link latency, packet loss and link drops
+# are configurable through SimConfig.
+#------------------------------------------------------------------------------
+
+import argparse
+import binascii
+import heapq
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+from util import *
+from transport import Att, AttSocketTransport, uuid_to_bytes
+
+#------------------------------------------------------------------------------
+# Simulation parameters
+#------------------------------------------------------------------------------
+class SimConfig(object):
+
+    def __init__(self, secure=True, max_object_size=4096, flash_latency=0.0, link_latency=0.0,
+                 loss=0.0, disconnect_after=None, mtu=247, app_mac=None, state_path=None, seed=None,
+                 boot_delay=0.0):
+        self.secure = secure
+        self.max_object_size = max_object_size
+        self.flash_latency = flash_latency          # seconds per flash write (EXECUTE, erase)
+        self.link_latency = link_latency            # seconds until a notification arrives
+        self.loss = loss                            # probability that a data packet is lost
+        self.disconnect_after = disconnect_after    # drop the link once after this many data bytes
+        self.mtu = mtu                              # largest ATT MTU the peer accepts
+        self.app_mac = app_mac                      # address that runs the application
+        self.state_path = state_path                # keep the bootloader state across processes
+        self.seed = seed
+        self.boot_delay = boot_delay                # seconds a reset device takes to advertise again
+
+#------------------------------------------------------------------------------
+# Common GATT plumbing of the simulated peers
+#------------------------------------------------------------------------------
+class SimPeer(object):
+
+    def __init__(self, config, mac):
+        self.config = config
+        self.mac = mac
+        self.random = random.Random(config.seed)
+
+        self.connected = False
+        self.reset = False
+        self.data_bytes = 0
+        self.dropped = False
+
+        # Set by SimWorld.peer()
+        self.world = None
+
+        # Set by the model: (delay, handle, value) notifications to send
+        self.outbox = []
+
+        # Until when the flash is busy
+        self.busy_until = 0.0
+
+    # --------------------------------------------------------------------------
+    #  List of (declaration handle, properties, value handle, uuid)
+    # --------------------------------------------------------------------------
+    def characteristics(self):
+        raise NotImplementedError
+
+    def read_uuid(self, uuid):
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Value and CCCD handles can be written
+    # --------------------------------------------------------------------------
+    def has_handle(self, handle):
+        for (_, _, value_handle, _) in self.characteristics():
+            if handle in (value_handle, value_handle + 1):
+                return True
+        return False
+
+    def notify(self, handle, value, flash=0.0):
+        now = time.time()
+        if flash:
+            self.busy_until = max(self.busy_until, now) + flash
+
+        when = max(now, self.busy_until) + self.config.link_latency
+        self.outbox.append((when, handle, bytes(bytearray(value))))
+
+    # --------------------------------------------------------------------------
+    #  Handle a write. Returns the list of (time, handle, value) to notify.
+    #  After the call, self.connected is False if the peer dropped the link.
+    # --------------------------------------------------------------------------
+    def write(self, handle, value):
+        self.outbox = []
+        value = bytearray(value)
+
+        if handle == self.data_value_handle():
+            if self.random.random() < self.config.loss:
+                return []
+
+            self.data_bytes += len(value)
+            if self.config.disconnect_after is not None and not self.dropped \
+                    and self.data_bytes >= self.config.disconnect_after:
+                self.dropped = True
+                self.disconnect()
+                return []
+
+        self.on_write(handle, value)
+        return self.outbox
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+        self.save()
+
+    # --------------------------------------------------------------------------
+    #  The peer reset itself: the link is gone, and the device advertises
+    #  again once it has booted
+    # --------------------------------------------------------------------------
+    def rebooted(self):
+        self.reset = False
+        if self.world is not None:
+            self.world.rebooted()
+
+    def data_value_handle(self):
+        return None
+
+    def on_write(self, handle, value):
+        raise NotImplementedError
+
+    def save(self):
+        pass
+
+#------------------------------------------------------------------------------
+# Secure DFU bootloader (and its application with the buttonless service)
+#------------------------------------------------------------------------------
+class SecureSimPeer(SimPeer):
+    UUID_CONTROL_POINT   = '8ec90001-f315-4f60-9fb8-838830daea50'
+    UUID_PACKET          = '8ec90002-f315-4f60-9fb8-838830daea50'
+    UUID_BUTTONLESS      = '8ec90003-f315-4f60-9fb8-838830daea50'
+
+    CTRLPT      = 0x0011
+    PACKET      = 0x0014
+    BUTTONLESS  = 0x0017
+
+    CREATE, SET_PRN, CALC_CHECKSUM, EXECUTE, SELECT, RESPONSE = 0x01, 0x02, 0x03, 0x04, 0x06, 0x60
+    SUCCESS, OPCODE_NOT_SUPPORTED, INVALID_PARAMETER, INSUFF_RESOURCES, OPERATION_NOT_PERMITTED = 0x01, 0x02, 0x03, 0x04, 0x08
+    COMMAND, DATA = 0x01, 0x02
+
+    MAX_COMMAND_SIZE = 256
+
+    def __init__(self, config, mac, app_mode=False):
+        SimPeer.__init__(self, config, mac)
+        self.app_mode = app_mode
+
+        self.prn = 0
+        self.prn_count = 0
+        self.current = self.COMMAND
+
+        self.command = bytearray()
+        self.command_size = 0
+
+        # Received image, the part up to data_executed has been executed.
+        # The current data object spans data_object_start..data_object_end.
+        self.data = bytearray()
+        self.data_executed = 0
+        self.data_object_start = 0
+        self.data_object_end = 0
+
+        # Images activated so far, in order
+        self.flashed = []
+
+        self.load()
+
+    def characteristics(self):
+        if self.app_mode:
+            return [(0x0016, 0x28, self.BUTTONLESS, self.UUID_BUTTONLESS)]
+
+        return [(0x0010, 0x18, self.CTRLPT, self.UUID_CONTROL_POINT),
+                (0x0013, 0x04, self.PACKET, self.UUID_PACKET)]
+
+    def data_value_handle(self):
+        return None if self.app_mode else self.PACKET
+
+    def respond(self, opcode, result, payload=b'', flash=0.0):
+        self.notify(self.CTRLPT, bytearray([self.RESPONSE, opcode, result]) + bytearray(payload), flash)
+
+    def crc(self, buf):
+        return crc32_unsigned(bytes(buf))
+
+    def on_write(self, handle, value):
+        if self.app_mode:
+            if handle == self.BUTTONLESS and value[0:1] == bytearray([0x01]):
+                # Enter bootloader: acknowledge, then reset
+                self.notify(self.BUTTONLESS, [0x20, 0x01, 0x01])
+                self.reset = True
+            return
+
+        if handle == self.PACKET:
+            self.on_packet(value)
+        elif handle == self.CTRLPT and value:
+            self.on_command(value[0], value[1:])
+
+    def on_packet(self, value):
+        if self.current == self.COMMAND:
+            self.command += value
+        else:
+            room = self.data_object_end - len(self.data)
+            self.data += value[0:max(room, 0)]
+
+        self.prn_count += 1
+        if self.prn and self.prn_count % self.prn == 0:
+            (offset, crc) = self.checksum()
+            self.respond(self.CALC_CHECKSUM, self.SUCCESS, struct.pack('<II', offset, crc))
+
+    def checksum(self):
+        if self.current == self.COMMAND:
+            return (len(self.command), self.crc(self.command))
+        return (len(self.data), self.crc(self.data))
+
+    def on_command(self, opcode, params):
+        if opcode == self.SELECT:
+            self.current = params[0]
+            if self.current == self.COMMAND:
+                payload = struct.pack('<III', self.MAX_COMMAND_SIZE, len(self.command), self.crc(self.command))
+            else:
+                payload = struct.pack('<III', self.config.max_object_size, len(self.data), self.crc(self.data))
+            self.respond(opcode, self.SUCCESS, payload)
+
+        elif opcode == self.CREATE:
+            (obj_type, size) = struct.unpack('<BI', bytes(params[0:5]))
+            self.current = obj_type
+            self.prn_count = 0
+
+            if obj_type == self.COMMAND:
+                if size > self.MAX_COMMAND_SIZE:
+                    return self.respond(opcode, self.INSUFF_RESOURCES)
+                self.command = bytearray()
+                self.command_size = size
+                self.data = bytearray()
+                self.data_executed = 0
+                self.data_object_start = 0
+                self.data_object_end = 0
+            else:
+                if size > self.config.max_object_size:
+                    return self.respond(opcode, self.INSUFF_RESOURCES)
+                del self.data[self.data_executed:]
+                self.data_object_start = self.data_executed
+                self.data_object_end = self.data_executed + size
+
+            self.respond(opcode, self.SUCCESS)
+
+        elif opcode == self.SET_PRN:
+            (self.prn,) = struct.unpack('<H', bytes(params[0:2]))
+            self.prn_count = 0
+            self.respond(opcode, self.SUCCESS)
+
+        elif opcode == self.CALC_CHECKSUM:
+            self.respond(opcode, self.SUCCESS, struct.pack('<II', *self.checksum()))
+
+        elif opcode == self.EXECUTE:
+            if self.current == self.COMMAND:
+                if not self.command:
+                    return self.respond(opcode, self.OPERATION_NOT_PERMITTED)
+                self.respond(opcode, self.SUCCESS, flash=self.config.flash_latency)
+            else:
+                # Like the SDK, refuse an incomplete object and one that was
+                # executed already
+                if len(self.data) != self.data_object_end or self.data_executed == self.data_object_end:
+                    return self.respond(opcode, self.OPERATION_NOT_PERMITTED)
+
+                last = self.data_object_end - self.data_object_start < self.config.max_object_size
+                self.data_executed = len(self.data)
+                self.respond(opcode, self.SUCCESS, flash=self.config.flash_latency)
+
+                # A short object is the last one: activate the image and reset
+                if last:
+                    self.activated = True
+                    self.flashed.append(bytes(self.data))
+                    self.reset = True
+
+        else:
+            self.respond(opcode, self.OPCODE_NOT_SUPPORTED)
+
+    # --------------------------------------------------------------------------
+    #  Optional persistence, so that a new process (after a link drop or the
+    #  switch to MAC + 1) sees what the previous one received
+    # --------------------------------------------------------------------------
+    def load(self):
+        if not self.config.state_path or self.app_mode or not os.path.isfile(self.config.state_path):
+            return
+
+        with open(self.config.state_path) as f:
+            state = json.load(f)
+
+        self.command = bytearray(binascii.unhexlify(state['command']))
+        self.data = bytearray(binascii.unhexlify(state['data']))
+        self.data_executed = state['data_executed']
+        self.data_object_start = state.get('data_object_start', self.data_executed)
+        self.data_object_end = state['data_object_end']
+
+    def save(self):
+        if not self.config.state_path or self.app_mode:
+            return
+
+        # A killed simulator must not leave a truncated state behind
+        atomic_write(self.config.state_path, json.dumps({
+            'command'           : binascii.hexlify(bytes(self.command)).decode('ascii'),
+            'data'              : binascii.hexlify(bytes(self.data)).decode('ascii'),
+            'data_executed'     : self.data_executed,
+            'data_object_start' : self.data_object_start,
+            'data_object_end'   : self.data_object_end,
+        }).encode('utf-8'))
+
+#------------------------------------------------------------------------------
+# Legacy DFU bootloader (and its application, which shares the address)
+#------------------------------------------------------------------------------
+class LegacySimPeer(SimPeer):
+    UUID_CONTROL_POINT   = "00001531-1212-efde-1523-785feabcd123"
+    UUID_PACKET          = "00001532-1212-efde-1523-785feabcd123"
+    UUID_VERSION         = "00001534-1212-efde-1523-785feabcd123"
+
+    CTRLPT      = 0x0011
+    PACKET      = 0x0014
+    VERSION     = 0x0017
+
+    START_DFU, INITIALIZE_DFU, RECEIVE, VALIDATE, ACTIVATE, RESET, PRN_REQUEST = 1, 2, 3, 4, 5, 6, 8
+    RESPONSE, PACKET_RECEIPT = 16, 17
+    SUCCESS, INVALID_STATE, NOT_SUPPORTED = 1, 2, 3
+
+    def __init__(self, config, mac, app_mode=False):
+        SimPeer.__init__(self, config, mac)
+        self.app_mode = app_mode
+
+        # Images activated so far, in order
+        self.flashed = []
+
+        self.enter_idle()
+
+    def enter_idle(self):
+        self.state = 'idle'
+        self.prn = 0
+        self.image_size = 0
+        self.received = 0
+        self.packets = 0
+        self.init = bytearray()
+        self.data = bytearray()
+
+    def characteristics(self):
+        return [(0x0010, 0x14, self.CTRLPT, self.UUID_CONTROL_POINT),
+                (0x0013, 0x04, self.PACKET, self.UUID_PACKET),
+                (0x0016, 0x02, self.VERSION, self.UUID_VERSION)]
+
+    def read_uuid(self, uuid):
+        if uuid == self.UUID_VERSION:
+            return (self.VERSION, bytearray([0x01, 0x00]) if self.app_mode else bytearray([0x08, 0x00]))
+        return None
+
+    def data_value_handle(self):
+        return self.PACKET
+
+    def respond(self, opcode, result, flash=0.0):
+        self.notify(self.CTRLPT, [self.RESPONSE, opcode, result], flash)
+
+    def on_write(self, handle, value):
+        if self.app_mode:
+            if handle == self.CTRLPT and value[0:1] == bytearray([self.START_DFU]):
+                # Application: reset into the bootloader
+                self.app_mode = False
+                self.reset = True
+            return
+
+        if handle == self.PACKET:
+            self.on_packet(value)
+        elif handle == self.CTRLPT and value:
+            self.on_command(value[0], value[1:])
+
+    def on_packet(self, value):
+        if self.state == 'size':
+            (sd_size, bl_size, app_size) = struct.unpack('<III', bytes(value[0:12]))
+            self.image_size = sd_size + bl_size + app_size
+            self.state = 'started'
+            self.respond(self.START_DFU, self.SUCCESS)
+
+        elif self.state == 'init':
+            self.init += value
+
+        elif self.state == 'receive':
+            self.data += value
+            self.received += len(value)
+            self.packets += 1
+
+            if self.received >= self.image_size:
+                self.state = 'received'
+                self.respond(self.RECEIVE, self.SUCCESS, flash=self.config.flash_latency)
+            elif self.prn and self.packets % self.prn == 0:
+                self.notify(self.CTRLPT, bytearray([self.PACKET_RECEIPT]) + bytearray(struct.pack('<I', self.received)))
+
+    def on_command(self, opcode, params):
+        if opcode == self.START_DFU:
+            self.enter_idle()
+            self.state = 'size'
+
+        elif opcode == self.INITIALIZE_DFU:
+            if params[0:1] == bytearray([0x00]):
+                self.state = 'init'
+            else:
+                # Init packet complete, erase flash
+                self.state = 'initialized'
+                self.respond(opcode, self.SUCCESS, flash=self.config.flash_latency)
+
+        elif opcode == self.PRN_REQUEST:
+            (self.prn,) = struct.unpack('<H', bytes(params[0:2]))
+
+        elif opcode == self.RECEIVE:
+            self.state = 'receive'
+            self.received = 0
+            self.packets = 0
+            self.data = bytearray()
+
+        elif opcode == self.VALIDATE:
+            result = self.SUCCESS if self.state == 'received' else self.INVALID_STATE
+            self.respond(opcode, result)
+
+        elif opcode in (self.ACTIVATE, self.RESET):
+            self.activated = opcode == self.ACTIVATE
+            if self.activated:
+                self.flashed.append(bytes(self.data))
+            self.reset = True
+
+        else:
+            self.respond(opcode, self.NOT_SUPPORTED)
+
+#------------------------------------------------------------------------------
+# The simulated devices, by address. Secure DFU devices run the bootloader at
+# the application address + 1.
+#------------------------------------------------------------------------------
+class SimWorld(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.peers = {}
+        self.lock = threading.Lock()
+
+        # Until when the device is booting and cannot be connected to
+        self.booting_until = 0.0
+
+    def peer(self, mac):
+        mac = mac.upper()
+
+        with self.lock:
+            if mac not in self.peers:
+                app_mode = self.config.app_mac is not None and mac == self.config.app_mac.upper()
+                if self.config.secure:
+                    self.peers[mac] = SecureSimPeer(self.config, mac, app_mode)
+                else:
+                    self.peers[mac] = LegacySimPeer(self.config, mac, app_mode)
+                self.peers[mac].world = self
+
+            return self.peers[mac]
+
+    def rebooted(self):
+        self.booting_until = time.time() + self.config.boot_delay
+
+    # --------------------------------------------------------------------------
+    #  Seconds until the device advertises again
+    # --------------------------------------------------------------------------
+    def boot_remaining(self):
+        return max(0.0, self.booting_until - time.time())
+
+#------------------------------------------------------------------------------
+# Delivers (time, handle, value) items in order once they are due
+#------------------------------------------------------------------------------
+class SimScheduler(threading.Thread):
+
+    def __init__(self, deliver):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.deliver = deliver
+        self.items = []
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.delivering = False
+        self.start()
+
+    def post(self, items):
+        with self.cond:
+            for (when, handle, value) in items:
+                self.seq += 1
+                heapq.heappush(self.items, (when, self.seq, handle, value))
+            self.cond.notify()
+
+    def clear(self):
+        with self.cond:
+            self.items = []
+
+    # --------------------------------------------------------------------------
+    #  Wait until everything posted so far has been delivered
+    # --------------------------------------------------------------------------
+    def drain(self, timeout=5):
+        deadline = time.time() + timeout
+        with self.cond:
+            while (self.items or self.delivering) and time.time() < deadline:
+                self.cond.wait(0.01)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.items or self.items[0][0] > time.time()):
+                    self.cond.wait(None if not self.items else self.items[0][0] - time.time())
+                if self.stopped:
+                    return
+                (_, _, handle, value) = heapq.heappop(self.items)
+                self.delivering = True
+
+            try:
+                self.deliver(handle, value)
+            except Exception:
+                return
+            finally:
+                with self.cond:
+                    self.delivering = False
+                    self.cond.notify_all()
+
+#------------------------------------------------------------------------------
+# gatttool front end
+#------------------------------------------------------------------------------
+class SimGatttool(object):
+
+    def __init__(self, world, mac=None, out=None):
+        self.world = world
+        self.mac = mac.upper() if mac else None
+        self.out = out or sys.stdout
+        self.lock = threading.Lock()
+        self.peer = world.peer(self.mac) if mac else None
+        self.mtu = Att.DEFAULT_MTU
+        self.scheduler = SimScheduler(self._deliver)
+
+    def write(self, text):
+        with self.lock:
+            self.out.write(text)
+            self.out.flush()
+
+    def connected(self):
+        return self.peer is not None and self.peer.connected
+
+    def prompt(self):
+        self.write('[%s][%s][LE]> ' % ('CON' if self.connected() else '   ', self.mac or ' ' * 17))
+
+    def _deliver(self, handle, value):
+        if self.connected():
+            self.write('Notification handle = 0x%04x value: %s\n' %
+                       (handle, ''.join('%02x ' % b for b in bytearray(value))))
+
+    def _after_write(self, items):
+        self.scheduler.post(items)
+
+        # The peer reset itself or dropped the link
+        if self.peer.reset or not self.peer.connected:
+            if self.peer.reset:
+                self.peer.rebooted()
+            self.scheduler.drain()
+            if self.peer.connected:
+                self.peer.disconnect()
+            self.scheduler.clear()
+            self.write('\n')
+            self.prompt()
+
+    def command(self, line):
+        args = line.split()
+        if not args:
+            return self.prompt()
+
+        cmd = args[0]
+
+        if cmd == 'exit':
+            if self.connected():
+                self.peer.disconnect()
+            return False
+
+        if cmd == 'connect':
+            # "connect <address>" retargets the process, like gatttool
+            if len(args) > 1 and args[1].upper() != self.mac:
+                if self.connected():
+                    self.peer.disconnect()
+                self.scheduler.clear()
+                self.mac = args[1].upper()
+                self.peer = self.world.peer(self.mac)
+
+            if self.peer is None:
+                self.write('Remote Bluetooth address required\n')
+            else:
+                self.write('Attempting to connect to %s\n' % self.mac)
+                # Like an LE connection, wait for the device to advertise
+                time.sleep(self.world.boot_remaining())
+                self.peer.connect()
+                self.mtu = Att.DEFAULT_MTU
+                self.write('Connection successful\n')
+
+        elif cmd == 'disconnect':
+            if self.connected():
+                self.peer.disconnect()
+
+        elif not self.connected():
+            self.write('Error: Disconnected\n')
+
+        elif cmd == 'characteristics':
+            for (handle, props, value_handle, uuid) in self.peer.characteristics():
+                self.write('handle: 0x%04x, char properties: 0x%02x, char value handle: 0x%04x, uuid: %s\n' %
+                           (handle, props, value_handle, uuid))
+
+        elif cmd == 'mtu':
+            self.mtu = max(Att.DEFAULT_MTU, min(int(args[1]), self.peer.config.mtu))
+            self.write('MTU was exchanged successfully: %d\n' % self.mtu)
+
+        elif cmd == 'char-read-uuid':
+            res = self.peer.read_uuid(args[1])
+            if res is None:
+                self.write('Error: Read characteristics by UUID failed: Attribute can\'t be found\n')
+            else:
+                self.write('handle: 0x%04x \t value: %s\n' % (res[0], ''.join('%02x ' % b for b in res[1])))
+
+        elif cmd in ('char-write-req', 'char-write-cmd'):
+            handle = int(args[1], 16)
+            value = binascii.unhexlify(args[2]) if len(args) > 2 else b''
+            if not self.peer.has_handle(handle):
+                if cmd == 'char-write-req':
+                    self.write('Error: Characteristic Write Request failed: Invalid handle\n')
+                self.prompt()
+                return True
+            items = self.peer.write(handle, value)
+            if cmd == 'char-write-req' and self.peer.connected:
+                self.write('Characteristic value was written successfully\n')
+            self._after_write(items)
+
+        else:
+            self.write('Error: Unknown command\n')
+
+        self.prompt()
+        return True
+
+    def run(self, inp=None):
+        inp = inp or sys.stdin
+        self.prompt()
+
+        while True:
+            line = inp.readline()
+            if not line:
+                break
+            if self.command(line.strip()) is False:
+                break
+
+        self.scheduler.stop()
+
+#------------------------------------------------------------------------------
+# ATT front end: a server thread on one end of a socket pair
+#------------------------------------------------------------------------------
+class SimAttServer(threading.Thread):
+
+    def __init__(self, peer, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.peer = peer
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.scheduler = SimScheduler(self._deliver)
+        self.peer.connect()
+        self.start()
+
+    def send(self, pdu):
+        with self.lock:
+            self.sock.send(bytes(pdu))
+
+    def _deliver(self, handle, value):
+        if self.peer.connected:
+            self.send(struct.pack('<BH', Att.NOTIFICATION, handle) + value)
+
+    def _close(self):
+        self.scheduler.stop()
+        if self.peer.connected:
+            self.peer.disconnect()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def _read_by_type(self, start, end, uuid):
+        if uuid == Att.GATT_CHARACTERISTIC:
+            entries = [struct.pack('<HBH', h, p, v) + uuid_to_bytes(u)
+                       for (h, p, v, u) in self.peer.characteristics() if start <= h <= end]
+            if entries:
+                return bytes(bytearray([Att.READ_BY_TYPE_RSP, len(entries[0])])) + b''.join(entries)
+        else:
+            for (_, _, _, char_uuid) in self.peer.characteristics():
+                if uuid_to_bytes(char_uuid) == uuid:
+                    res = self.peer.read_uuid(char_uuid)
+                    if res is not None:
+                        (handle, value) = res
+                        return bytes(bytearray([Att.READ_BY_TYPE_RSP, 2 + len(value)])) + struct.pack('<H', handle) + bytes(value)
+
+        return struct.pack('<BBHB', Att.ERROR_RSP, Att.READ_BY_TYPE_REQ, start, Att.ERR_ATTRIBUTE_NOT_FOUND)
+
+    def run(self):
+        while True:
+            try:
+                pdu = bytearray(self.sock.recv(1024))
+            except socket.error:
+                pdu = None
+
+            if not pdu:
+                break
+
+            opcode = pdu[0]
+
+            if opcode == Att.EXCHANGE_MTU_REQ:
+                self.send(struct.pack('<BH', Att.EXCHANGE_MTU_RSP, self.peer.config.mtu))
+
+            elif opcode == Att.READ_BY_TYPE_REQ:
+                (start, end) = struct.unpack('<HH', bytes(pdu[1:5]))
+                uuid = struct.unpack('<H', bytes(pdu[5:7]))[0] if len(pdu) == 7 else bytes(pdu[5:])
+                self.send(self._read_by_type(start, end, uuid))
+
+            elif opcode in (Att.WRITE_REQ, Att.WRITE_CMD):
+                (handle,) = struct.unpack('<H', bytes(pdu[1:3]))
+                if not self.peer.has_handle(handle):
+                    if opcode == Att.WRITE_REQ:
+                        self.send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, handle, Att.ERR_INVALID_HANDLE))
+                    continue
+                items = self.peer.write(handle, pdu[3:])
+                if opcode == Att.WRITE_REQ and self.peer.connected:
+                    self.send(bytearray([Att.WRITE_RSP]))
+                self.scheduler.post(items)
+
+            elif opcode == Att.CONFIRMATION:
+                pass
+
+            else:
+                self.send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, 0, Att.ERR_REQUEST_NOT_SUPPORTED))
+
+            # The peer reset itself or dropped the link
+            if self.peer.reset or not self.peer.connected:
+                if self.peer.reset:
+                    self.peer.rebooted()
+                self.scheduler.drain()
+                break
+
+        self._close()
+
+#------------------------------------------------------------------------------
+# ATT socket transports connected to a SimWorld instead of an L2CAP socket
+#------------------------------------------------------------------------------
+class SimAttSocketTransport(AttSocketTransport):
+
+    def __init__(self, target_mac, adapter=None, world=None):
+        AttSocketTransport.__init__(self, target_mac, adapter)
+        self.world = world
+
+    def connect(self, timeout=30):
+        self._close()
+
+        # Like an LE connection, wait for the device to advertise
+        if self.world.boot_remaining() > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(self.world.boot_remaining())
+
+        (self.sock, server_sock) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        SimAttServer(self.world.peer(self.target_mac), server_sock)
+
+        self.mtu = Att.DEFAULT_MTU
+        self.notifications.clear()
+        return True
+
+def sim_async_transport(world):
+    import asyncio
+    from async_dfu import AsyncAttSocketTransport, NotificationInbox
+
+    class SimAsyncAttSocketTransport(AsyncAttSocketTransport):
+
+        async def connect(self, timeout=30):
+            await self.disconnect()
+
+            if world.boot_remaining() > timeout:
+                await asyncio.sleep(timeout)
+                return False
+            await asyncio.sleep(world.boot_remaining())
+
+            (self.sock, server_sock) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.sock.setblocking(False)
+            SimAttServer(world.peer(self.target_mac), server_sock)
+
+            self.mtu = Att.DEFAULT_MTU
+            self.notifications = NotificationInbox()
+            self.reader = asyncio.ensure_future(self._read_loop())
+            return True
+
+    return SimAsyncAttSocketTransport
+
+#------------------------------------------------------------------------------
+# Command line: behave like "gatttool -b <mac> --interactive"
+#------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Simulated nRF5 DFU peer with a gatttool interface')
+
+    parser.add_argument('--secure', dest='secure', action='store_true', default=True,
+                        help='Simulate the secure bootloader (default)')
+    parser.add_argument('--legacy', dest='secure', action='store_false',
+                        help='Simulate the legacy bootloader')
+    parser.add_argument('--max-object-size', type=int, default=4096)
+    parser.add_argument('--flash-latency', type=float, default=0.0)
+    parser.add_argument('--link-latency', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--disconnect-after', type=int, default=None)
+    parser.add_argument('--mtu', type=int, default=247)
+    parser.add_argument('--app-mac', default=None,
+                        help='Address at which the application (not the bootloader) runs')
+    parser.add_argument('--state', default=None,
+                        help='File keeping the bootloader state across runs')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--boot-delay', type=float, default=0.0,
+                        help='Seconds a device takes to advertise again after a reset')
+
+    # gatttool arguments
+    parser.add_argument('-b', dest='mac', default=None)
+    parser.add_argument('-t', dest='addr_type', default='public')
+    parser.add_argument('-i', dest='adapter', default='hci0')
+    parser.add_argument('-I', '--interactive', action='store_true')
+
+    args = parser.parse_args()
+
+    config = SimConfig(secure=args.secure, max_object_size=args.max_object_size,
+                       flash_latency=args.flash_latency, link_latency=args.link_latency,
+                       loss=args.loss, disconnect_after=args.disconnect_after, mtu=args.mtu,
+                       app_mac=args.app_mac, state_path=args.state, seed=args.seed,
+                       boot_delay=args.boot_delay)
+
+    SimGatttool(SimWorld(config), args.mac).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#------------------------------------------------------------------------------
+# Fleet update: run DFU sessions for a list of devices concurrently
+#
+# Device list formats:
+#   CSV:  one device per row, "address[,package]". A header row is allowed.
+#   JSON: a list of addresses, or of {"address": ..., "package": ...} objects.
+# Devices without a package use the default firmware given on the command line.
+#------------------------------------------------------------------------------
+
+import asyncio
+import csv
+import json
+import os
+import re
+import time
+
+from package import Package
+from adapters import AdapterPool, adapter_present
+from metrics import Metrics
+from scanner import REACHABLE_AGE
+from async_dfu import AsyncBleDfuControllerSecure, AsyncBleDfuControllerLegacy, create_async_transport
+
+MAC_PATTERN = re.compile('^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$')
+
+#------------------------------------------------------------------------------
+# One device of the fleet and the outcome of its update
+#------------------------------------------------------------------------------
+class FleetJob(object):
+
+    def __init__(self, address, package=None):
+        self.address = address.upper()
+        self.package = package
+
+        # Shared by all attempts, so reconnects and retransmits add up
+        self.metrics = Metrics(self.address)
+
+        self.status = 'pending'
+        self.adapter = None
+        self.attempts = 0
+        self.error = None
+        self.duration = 0.0
+
+    def to_dict(self):
+        return {
+            'address'   : self.address,
+            'package'   : self.package,
+            'status'    : self.status,
+            'adapter'   : self.adapter,
+            'attempts'  : self.attempts,
+            'duration'  : round(self.duration, 1),
+            'error'     : self.error,
+        }
+
+#------------------------------------------------------------------------------
+# Read the device list. Returns a list of FleetJob.
+#------------------------------------------------------------------------------
+def load_device_list(path):
+    if not os.path.isfile(path):
+        raise Exception("Error: device list {} not found".format(path))
+
+    jobs = []
+
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path) as f:
+            entries = json.load(f)
+
+        for entry in entries:
+            if isinstance(entry, dict):
+                jobs.append(FleetJob(entry['address'], entry.get('package')))
+            else:
+                jobs.append(FleetJob(entry))
+
+    else:
+        with open(path) as f:
+            for row in csv.reader(f):
+                row = [col.strip() for col in row]
+                if not row or not row[0] or row[0].startswith('#'):
+                    continue
+
+                # Skip a header row
+                if not MAC_PATTERN.match(row[0]):
+                    continue
+
+                jobs.append(FleetJob(row[0], row[1] if len(row) > 1 and row[1] else None))
+
+    for job in jobs:
+        if not MAC_PATTERN.match(job.address):
+            raise Exception("Invalid address in device list: {}".format(job.address))
+
+    return jobs
+
+#------------------------------------------------------------------------------
+# Run the jobs with at most `concurrency` sessions at a time.
+# A failed device is retried up to `retries` more times with a growing delay.
+# With several adapters, each session goes to the least loaded adapter, and
+# the jobs of an adapter that disappears move to the remaining ones.
+#------------------------------------------------------------------------------
+class FleetScheduler(object):
+
+    # --------------------------------------------------------------------------
+    #  firmware:         (firmware path, dat path) or Package for jobs without
+    #                    a package of their own
+    #  session_options:  attributes set on every session (max_att_mtu, ...)
+    #  transport_options: keyword arguments for the transport (command, ...)
+    #  metrics_sinks:    sinks receiving the metrics of every device
+    #  session_timeout:  upper bound in seconds for one update attempt
+    #  adapters:         HCI adapter names to spread sessions over
+    #  adapter_budget:   connections per adapter
+    #  registry:         DeviceRegistry of a background scanner; devices it
+    #                    has seen recently are updated first
+    # --------------------------------------------------------------------------
+    def __init__(self, jobs, firmware=None, secure=True, transport='gatttool',
+                 concurrency=4, retries=2, session_timeout=600, session_options=None, retry_delay=5,
+                 adapters=None, adapter_budget=4, transport_options=None, metrics_sinks=None,
+                 registry=None):
+        self.jobs = jobs
+        self.firmware = firmware
+        self.secure = secure
+        self.transport = transport
+        self.concurrency = max(1, concurrency)
+        self.retries = max(0, retries)
+        self.session_timeout = session_timeout
+        self.session_options = session_options or {}
+        self.transport_options = transport_options or {}
+        self.retry_delay = retry_delay
+        self.adapters = adapters
+        self.adapter_budget = adapter_budget
+        self.registry = registry
+        self.pool = None
+
+        for job in jobs:
+            for sink in metrics_sinks or []:
+                job.metrics.add_sink(sink)
+
+        self.packages = {}
+
+    # --------------------------------------------------------------------------
+    #  (firmware path, dat path) or Package for a job. Each package is read
+    #  only once, and shared by the sessions updating from it.
+    # --------------------------------------------------------------------------
+    def _firmware_for(self, job):
+        if job.package is None:
+            if self.firmware is None:
+                raise Exception("No firmware for {}".format(job.address))
+            return self.firmware
+
+        if job.package not in self.packages:
+            self.packages[job.package] = Package(job.package)
+
+        return self.packages[job.package]
+
+    def _create_session(self, job):
+        firmware = self._firmware_for(job)
+        (firmware_path, datfile_path) = (None, None) if isinstance(firmware, Package) else firmware
+        transport = create_async_transport(self.transport, job.address, job.adapter, **self.transport_options)
+
+        if self.secure:
+            session = AsyncBleDfuControllerSecure(job.address, firmware_path, datfile_path, transport)
+        else:
+            session = AsyncBleDfuControllerLegacy(job.address, firmware_path, datfile_path, transport)
+
+        if isinstance(firmware, Package):
+            session.package = firmware
+
+        for (name, value) in self.session_options.items():
+            setattr(session, name, value)
+
+        session.metrics = job.metrics
+
+        return session
+
+    async def _run_job(self, job, semaphore):
+        time_start = time.time()
+        moved = False
+
+        while job.attempts <= self.retries:
+            if job.attempts and not moved:
+                await asyncio.sleep(self.retry_delay * job.attempts)
+            moved = False
+
+            async with semaphore:
+                job.attempts += 1
+                job.status = 'running'
+
+                try:
+                    if self.pool is not None:
+                        job.adapter = None
+                        job.adapter = await self.pool.acquire()
+
+                    session = self._create_session(job)
+                    await session.run(self.session_timeout)
+                    job.status = 'success'
+                    job.error = None
+                    break
+
+                except asyncio.TimeoutError:
+                    job.error = 'timeout'
+                except Exception as e:
+                    job.error = str(e)
+
+                finally:
+                    if self.pool is not None and job.adapter is not None:
+                        await self.pool.release(job.adapter)
+
+                job.status = 'failed'
+                job.metrics.interrupted()
+                print("[{}] Attempt {} failed: {}".format(job.address, job.attempts, job.error))
+
+                # The adapter went away: not the device's fault, move the job
+                if self.pool is not None and job.adapter is not None and not adapter_present(job.adapter):
+                    if await self.pool.remove(job.adapter):
+                        print("Adapter {} disappeared, {} left".format(job.adapter, len(self.pool.adapters())))
+                    job.attempts -= 1
+                    job.adapter = None
+                    moved = True
+
+        job.duration = time.time() - time_start
+        job.metrics.result(job.status == 'success', job.error)
+
+        # Save the CRCs the session computed now, not only when the fleet is done
+        image_cache = self.session_options.get('image_cache')
+        if image_cache is not None:
+            await asyncio.get_running_loop().run_in_executor(None, image_cache.flush)
+
+    # --------------------------------------------------------------------------
+    #  Jobs in the order to start them: devices the registry has seen
+    #  recently first, strongest signal first, then the rest as listed.
+    #  The report keeps the order of the device list.
+    # --------------------------------------------------------------------------
+    def _ordered_jobs(self):
+        if self.registry is None:
+            return self.jobs
+
+        def rssi(job):
+            device = self.registry.get(job.address, REACHABLE_AGE)
+            return device.rssi if device is not None else None
+
+        seen = [(rssi(job), job) for job in self.jobs]
+        reachable = sorted([(r, job) for (r, job) in seen if r is not None], key=lambda item: -item[0])
+        return [job for (_, job) in reachable] + [job for (r, job) in seen if r is None]
+
+    async def run_async(self):
+        if self.adapters:
+            self.pool = AdapterPool(self.adapters, self.adapter_budget)
+
+        # Tasks queue on the semaphore in the order they are started
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self._run_job(job, semaphore) for job in self._ordered_jobs()])
+
+    # --------------------------------------------------------------------------
+    #  Run all jobs and return the summary report
+    # --------------------------------------------------------------------------
+    def run(self):
+        time_start = time.time()
+
+        asyncio.run(self.run_async())
+
+        return {
+            'duration'  : round(time.time() - time_start, 1),
+            'succeeded' : len([job for job in self.jobs if job.status == 'success']),
+            'failed'    : len([job for job in self.jobs if job.status != 'success']),
+            'devices'   : [job.to_dict() for job in self.jobs],
+        }
+
+#------------------------------------------------------------------------------
+# Print the summary report, and write it as JSON if a path is given
+#------------------------------------------------------------------------------
+def print_report(report, path=None):
+    print("\nFleet update: {} succeeded, {} failed in {} seconds".format(
+        report['succeeded'], report['failed'], report['duration']))
+
+    for device in report['devices']:
+        print("  {address}  {status:8s} {adapter:6s} attempts: {attempts}  {duration:7.1f} s  {error}".format(
+            address=device['address'], status=device['status'], adapter=device['adapter'] or '-',
+            attempts=device['attempts'], duration=device['duration'], error=device['error'] or ''))
+
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
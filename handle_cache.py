@@ -0,0 +1,57 @@
+#------------------------------------------------------------------------------
+# GATT handle cache
+#
+# Discovering the characteristics of a peer takes a full `characteristics`
+# listing, seconds on a real link. The handles a device exposes only change
+# with its firmware, so they are kept on disk per device address, DFU
+# profile ('secure' or 'legacy') and mode ('app' or 'dfu'), and later
+# sessions use them without discovery. A write to a cached handle that
+# fails is the cue to discover again.
+#------------------------------------------------------------------------------
+
+import os
+
+from util import JsonStore
+
+DEFAULT_HANDLE_CACHE_PATH = os.path.join('~', '.ota_dfu_handles.json')
+
+class HandleCache(JsonStore):
+
+    description = 'handle cache'
+
+    def __init__(self, path=DEFAULT_HANDLE_CACHE_PATH):
+        JsonStore.__init__(self, path)
+
+    @staticmethod
+    def key(device, profile, mode):
+        return '{}/{}/{}'.format(device.upper(), profile, mode)
+
+    # --------------------------------------------------------------------------
+    #  Returns {uuid: (char handle, value handle, CCCD handle)} or None
+    # --------------------------------------------------------------------------
+    def get(self, device, profile, mode):
+        with self.lock:
+            entry = self.entries.get(self.key(device, profile, mode))
+            if entry is None:
+                return None
+
+            return dict((uuid, tuple(handles)) for (uuid, handles) in entry.items())
+
+    # --------------------------------------------------------------------------
+    #  Modes cached for the device under the profile
+    # --------------------------------------------------------------------------
+    def modes(self, device, profile):
+        prefix = '{}/{}/'.format(device.upper(), profile)
+
+        with self.lock:
+            return sorted(key[len(prefix):] for key in self.entries if key.startswith(prefix))
+
+    def put(self, device, profile, mode, handles):
+        with self.lock:
+            self.entries[self.key(device, profile, mode)] = dict((uuid, list(h)) for (uuid, h) in handles.items())
+            self._save()
+
+    def remove(self, device, profile, mode):
+        with self.lock:
+            if self.entries.pop(self.key(device, profile, mode), None) is not None:
+                self._save()
@@ -0,0 +1,332 @@
+#------------------------------------------------------------------------------
+# Prepared firmware images, cached by content
+#
+# Getting an image ready for transfer costs CPU every session: parsing an
+# Intel HEX file, encoding the image for the transport (gatttool sends it
+# hex-encoded), and the CRC32 of every image prefix the bootloader reports
+# on. A PreparedImage holds the results, and an ImageCache keeps them by the
+# SHA-256 of the files they were made from: in memory, so concurrent
+# sessions for the same release share one, and on disk, so later runs start
+# sending without preparing again. Both drop the least recently used images
+# beyond a size budget.
+#
+# Images are read-only buffers, memory-mapped when they come from disk.
+# Sessions slice packets and CRC ranges out of them as memoryviews, so no
+# packet or checkpoint copies the image, and all sessions of one process
+# share one mapping of it.
+#------------------------------------------------------------------------------
+
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+
+from journal import image_digest
+from util import atomic_write, crc32_unsigned
+
+DEFAULT_IMAGE_CACHE_PATH = os.path.join('~', '.ota_dfu_images')
+DEFAULT_IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+
+#------------------------------------------------------------------------------
+# SHA-256 of the contents of the files, keying the images made from them
+#------------------------------------------------------------------------------
+def file_digest(*paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+#------------------------------------------------------------------------------
+# Contents of a file as a read-only buffer: mapped, or bytes if it is empty
+#------------------------------------------------------------------------------
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#------------------------------------------------------------------------------
+# An image ready for transfer: firmware and init packet as read-only
+# buffers, the journal digest, the encoded payloads by transport encoding,
+# and the CRC32 of image prefixes by offset. Images are shared between
+# sessions; the payloads and CRCs grow as sessions ask for new ones.
+# object_sizes are the data object sizes whose boundaries have their CRCs.
+#------------------------------------------------------------------------------
+class PreparedImage(object):
+
+    # --------------------------------------------------------------------------
+    #  firmware: bytes or mmap, used without copying. firmware_view is the
+    #  memoryview packets and CRC ranges are sliced from.
+    # --------------------------------------------------------------------------
+    def __init__(self, type, bin_file, firmware, init_packet, info=None, digest=None, crcs=None, payloads=None,
+                 object_sizes=None):
+        if not isinstance(firmware, (bytes, mmap.mmap)):
+            firmware = bytes(bytearray(firmware))
+
+        self.type = type
+        self.bin_file = bin_file
+        self.firmware = firmware
+        self.firmware_view = memoryview(firmware)
+        self.init_packet = bytes(init_packet)
+        self.info = info or {}
+        self.size = len(self.firmware_view)
+        self.digest = digest or image_digest(self.firmware_view, self.init_packet)
+
+        self.lock = threading.Lock()
+        self.payloads = dict(payloads or {})
+        self.crcs = {0: 0}
+        self.crc_offsets = [0]
+        self.object_sizes = set(object_sizes or [])
+        self.dirty = False
+
+        for (offset, crc) in (crcs or {}).items():
+            self._add_crc(int(offset), crc)
+
+    # --------------------------------------------------------------------------
+    #  From a PackageImage
+    # --------------------------------------------------------------------------
+    @classmethod
+    def from_image(cls, image):
+        return cls(image.type, image.bin_file, image.firmware, image.init_packet, image.info)
+
+    def _add_crc(self, offset, crc):
+        if offset not in self.crcs:
+            bisect.insort(self.crc_offsets, offset)
+        self.crcs[offset] = crc
+
+    # --------------------------------------------------------------------------
+    #  CRC32 of the image prefix [0:offset], carried forward from the closest
+    #  offset computed before
+    # --------------------------------------------------------------------------
+    def crc(self, offset):
+        with self.lock:
+            return self._crc(offset)
+
+    def _crc(self, offset):
+        crc = self.crcs.get(offset)
+        if crc is None:
+            start = self.crc_offsets[bisect.bisect_right(self.crc_offsets, offset) - 1]
+            crc = crc32_unsigned(self.firmware_view[start:offset], self.crcs[start])
+            self._add_crc(offset, crc)
+            self.dirty = True
+
+        return crc
+
+    # --------------------------------------------------------------------------
+    #  The CRCs at the boundaries of data objects of max_size, as the
+    #  bootloader's SELECT reports it: the checkpoints every transfer to it
+    #  passes. Computed once per object size.
+    # --------------------------------------------------------------------------
+    def prepare_objects(self, max_size):
+        with self.lock:
+            if max_size in self.object_sizes:
+                return
+
+            for end in range(max_size, self.size + max_size, max_size):
+                self._crc(min(end, self.size))
+
+            self.object_sizes.add(max_size)
+            self.dirty = True
+
+    # --------------------------------------------------------------------------
+    #  The firmware in the transport's wire form, a read-only buffer
+    # --------------------------------------------------------------------------
+    def payload(self, transport):
+        encoding = transport.payload_encoding
+        if encoding == 'raw':
+            return self.firmware_view
+
+        with self.lock:
+            payload = self.payloads.get(encoding)
+            if payload is None:
+                payload = transport.encode_payload(self.firmware)
+                self.payloads[encoding] = payload
+                self.dirty = True
+
+            return payload
+
+    def nbytes(self):
+        return self.size + len(self.init_packet) + sum(len(p) for p in self.payloads.values())
+
+#------------------------------------------------------------------------------
+# PreparedImages by key, in memory and in a directory with one subdirectory
+# per image: firmware.bin, init.dat, payload.<encoding> and meta.json
+#------------------------------------------------------------------------------
+class ImageCache(object):
+
+    # --------------------------------------------------------------------------
+    #  path None: keep images in memory only
+    # --------------------------------------------------------------------------
+    def __init__(self, path=DEFAULT_IMAGE_CACHE_PATH, max_size=DEFAULT_IMAGE_CACHE_SIZE):
+        self.path = os.path.expanduser(path) if path else None
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # Least recently used first
+        self.images = collections.OrderedDict()
+
+        # Keys being prepared, so that concurrent sessions prepare an image once
+        self.preparing = {}
+
+    # --------------------------------------------------------------------------
+    #  The image for key, from memory or disk, or made by load() and kept.
+    #  load returns a PackageImage.
+    # --------------------------------------------------------------------------
+    def prepared(self, key, load):
+        with self.lock:
+            key_lock = self.preparing.setdefault(key, threading.Lock())
+
+        with key_lock:
+            image = self.get(key)
+            if image is None:
+                image = PreparedImage.from_image(load())
+                self.put(key, image)
+
+        with self.lock:
+            self.preparing.pop(key, None)
+
+        return image
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+
+        image = self._load(key)
+        if image is not None:
+            with self.lock:
+                self.images[key] = image
+                self._evict()
+
+        return image
+
+    def put(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            self._evict()
+
+        self._save(key, image)
+
+    # --------------------------------------------------------------------------
+    #  Write the payloads and CRCs sessions added since the images were saved
+    # --------------------------------------------------------------------------
+    def flush(self):
+        with self.lock:
+            images = list(self.images.items())
+
+        for (key, image) in images:
+            if image.dirty:
+                self._save(key, image)
+
+    def _evict(self):
+        size = sum(image.nbytes() for image in self.images.values())
+        while len(self.images) > 1 and size > self.max_size:
+            (key, image) = self.images.popitem(last=False)
+            size -= image.nbytes()
+
+    # --------------------------------------------------------------------------
+    #  Disk side
+    # --------------------------------------------------------------------------
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+
+            firmware = map_file(os.path.join(entry, 'firmware.bin'))
+            with open(os.path.join(entry, 'init.dat'), 'rb') as f:
+                init_packet = f.read()
+
+            payloads = {}
+            for encoding in meta.get('payloads', []):
+                payloads[encoding] = map_file(os.path.join(entry, 'payload.' + encoding))
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        if len(firmware) != meta.get('size'):
+            return None
+
+        # Mark as recently used
+        os.utime(os.path.join(entry, 'meta.json'), None)
+
+        return PreparedImage(meta['type'], meta['bin_file'], firmware, init_packet, meta.get('info'),
+                             meta['digest'], meta.get('crcs'), payloads, meta.get('object_sizes'))
+
+    def _save(self, key, image):
+        if self.path is None:
+            return
+
+        with image.lock:
+            meta = {
+                'type'         : image.type,
+                'bin_file'     : image.bin_file,
+                'info'         : image.info,
+                'size'         : image.size,
+                'digest'       : image.digest,
+                'crcs'         : dict((str(offset), crc) for (offset, crc) in image.crcs.items()),
+                'payloads'     : sorted(image.payloads),
+                'object_sizes' : sorted(image.object_sizes),
+            }
+            payloads = dict(image.payloads)
+            image.dirty = False
+
+        entry = self._entry_path(key)
+        try:
+            if not os.path.isdir(entry):
+                os.makedirs(entry)
+
+            files = [('firmware.bin', image.firmware), ('init.dat', image.init_packet)]
+            files += [('payload.' + encoding, payload) for (encoding, payload) in payloads.items()]
+            for (name, data) in files:
+                if not os.path.isfile(os.path.join(entry, name)):
+                    atomic_write(os.path.join(entry, name), data)
+
+            # meta.json last: an entry without it is incomplete and never read
+            atomic_write(os.path.join(entry, 'meta.json'), json.dumps(meta, sort_keys=True).encode('utf-8'))
+
+        except (IOError, OSError) as e:
+            print("Image cache: {}".format(e))
+            return
+
+        self._evict_disk(key)
+
+    # --------------------------------------------------------------------------
+    #  Remove the least recently used entries beyond max_size, keeping keep
+    # --------------------------------------------------------------------------
+    def _evict_disk(self, keep):
+        entries = []
+        for key in os.listdir(self.path):
+            entry = self._entry_path(key)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                used = os.path.getmtime(os.path.join(entry, 'meta.json'))
+            except (IOError, OSError):
+                # Incomplete, from a crashed run
+                size, used = 0, 0
+            entries.append((used, key, size))
+
+        total = sum(size for (used, key, size) in entries)
+        for (used, key, size) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
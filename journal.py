@@ -0,0 +1,60 @@
+#------------------------------------------------------------------------------
+# Resume journal
+#
+# Records the progress of secure DFU transfers on disk, keyed by device
+# address and image digest, so that an interrupted update can be picked up
+# by a later run: the bootloader address to reconnect to, and the image
+# offset executed so far. The bootloader's SELECT response stays the
+# authority on what it holds; the journal says where to look for it.
+#
+# Entries are removed when a transfer completes.
+#------------------------------------------------------------------------------
+
+import hashlib
+import os
+import time
+
+from util import JsonStore
+
+DEFAULT_JOURNAL_PATH = os.path.join('~', '.ota_dfu_journal.json')
+
+#------------------------------------------------------------------------------
+# Digest identifying an update: the firmware image and its init packet,
+# given as buffers (bytes, array, mmap or memoryview)
+#------------------------------------------------------------------------------
+def image_digest(firmware, init_packet):
+    digest = hashlib.sha256()
+    digest.update(firmware)
+    digest.update(init_packet)
+    return digest.hexdigest()
+
+class DfuJournal(JsonStore):
+
+    description = 'journal'
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        JsonStore.__init__(self, path)
+
+    @staticmethod
+    def key(device, digest):
+        return '{}/{}'.format(device.upper(), digest)
+
+    # --------------------------------------------------------------------------
+    #  Returns the entry (address, offset, updated) or None
+    # --------------------------------------------------------------------------
+    def get(self, device, digest):
+        with self.lock:
+            entry = self.entries.get(self.key(device, digest))
+            return dict(entry) if entry is not None else None
+
+    def update(self, device, digest, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(self.key(device, digest), {})
+            entry.update(fields)
+            entry['updated'] = time.time()
+            self._save()
+
+    def remove(self, device, digest):
+        with self.lock:
+            if self.entries.pop(self.key(device, digest), None) is not None:
+                self._save()
@@ -0,0 +1,251 @@
+#------------------------------------------------------------------------------
+# Structured metrics of a DFU transfer
+#
+# A controller reports what happens through its Metrics object, which turns
+# each report into an event dict and hands it to the attached sinks:
+#
+#   phase_start     phase
+#   phase_end       phase, wall, cpu (seconds; cpu is null for async sessions,
+#                   see phases.py)
+#   bytes_acked     bytes, total
+#   prn_rtt         rtt (seconds from sending a receipt window to its receipt)
+#   retransmit      offset, reason
+#   crc_mismatch    offset, expected, received
+#   connect         address, attempt (the connection count), reconnect (True
+#                   when connecting again after an interrupted attempt)
+#   result          success, error
+#
+# Every event also carries ts (epoch seconds), device and event.
+#------------------------------------------------------------------------------
+
+import json
+import sys
+import threading
+import time
+
+from abc import ABCMeta, abstractmethod
+
+from util import atomic_write
+
+#------------------------------------------------------------------------------
+# Event emitter for one device. Without sinks all reports are dropped.
+#------------------------------------------------------------------------------
+class Metrics(object):
+
+    def __init__(self, device, sinks=None):
+        self.device = device
+        self.sinks = list(sinks or [])
+        self.connects = 0
+
+        # Set when an attempt was interrupted, the next connect is a reconnect
+        self.reconnect_pending = False
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, event, **fields):
+        if not self.sinks:
+            return
+
+        fields['ts'] = time.time()
+        fields['device'] = self.device
+        fields['event'] = event
+
+        for sink in self.sinks:
+            sink.emit(fields)
+
+    def phase_start(self, phase):
+        self.emit('phase_start', phase=phase)
+
+    def phase_end(self, phase, wall, cpu):
+        self.emit('phase_end', phase=phase, wall=round(wall, 6), cpu=round(cpu, 6) if cpu is not None else None)
+
+    def bytes_acked(self, acked, total):
+        self.emit('bytes_acked', bytes=acked, total=total)
+
+    def prn_rtt(self, rtt):
+        self.emit('prn_rtt', rtt=round(rtt, 6))
+
+    def retransmit(self, offset, reason):
+        self.emit('retransmit', offset=offset, reason=reason)
+
+    def crc_mismatch(self, offset, expected, received):
+        self.emit('crc_mismatch', offset=offset, expected=expected, received=received)
+
+    # --------------------------------------------------------------------------
+    #  A connection was made. Planned ones (to the bootloader, for the next
+    #  image of a package) are not reconnects, only the first one after
+    #  interrupted() is.
+    # --------------------------------------------------------------------------
+    def connect(self, address):
+        self.connects += 1
+        self.emit('connect', address=address, attempt=self.connects, reconnect=self.reconnect_pending)
+        self.reconnect_pending = False
+
+    # --------------------------------------------------------------------------
+    #  An attempt at the transfer failed or was cut off, and it is taken up
+    #  again
+    # --------------------------------------------------------------------------
+    def interrupted(self):
+        self.reconnect_pending = True
+
+    def result(self, success, error=None):
+        self.emit('result', success=success, error=error)
+
+#------------------------------------------------------------------------------
+# Sink interface
+#------------------------------------------------------------------------------
+class MetricsSink(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def emit(self, event):
+        pass
+
+    def close(self):
+        pass
+
+#------------------------------------------------------------------------------
+# One JSON object per line, to a file path or an open stream ('-': stdout)
+#------------------------------------------------------------------------------
+class JsonLinesSink(MetricsSink):
+
+    def __init__(self, path):
+        if path == '-':
+            self.stream = sys.stdout
+            self.owned = False
+        elif hasattr(path, 'write'):
+            self.stream = path
+            self.owned = False
+        else:
+            self.stream = open(path, 'a')
+            self.owned = True
+
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, sort_keys=True)
+
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+
+#------------------------------------------------------------------------------
+# Prometheus text file, for the node exporter textfile collector.
+# Keeps the current value of each series per device and rewrites the file
+# (atomically) at most every `interval` seconds, and on every phase end and
+# result. The data objects of a secure transfer are summed into one
+# phase="objects" series, to keep the number of series bounded.
+#------------------------------------------------------------------------------
+class PrometheusSink(MetricsSink):
+
+    METRICS = [
+        ('dfu_image_bytes',                     'gauge',    'Size of the image being transferred'),
+        ('dfu_bytes_acked',                     'gauge',    'Image bytes acknowledged by the device'),
+        ('dfu_throughput_bytes_per_second',     'gauge',    'Acknowledged bytes per second since the transfer started'),
+        ('dfu_phase_seconds',                   'gauge',    'Wall time spent in each phase'),
+        ('dfu_prn_rtt_seconds',                 'summary',  'Packet receipt round-trip time'),
+        ('dfu_retransmits_total',               'counter',  'Objects sent again'),
+        ('dfu_crc_mismatches_total',            'counter',  'Receipts or checksums with an unexpected CRC'),
+        ('dfu_reconnects_total',                'counter',  'Connections made again after an interrupted attempt'),
+        ('dfu_success',                         'gauge',    '1 if the last transfer succeeded, 0 if it failed'),
+        ('dfu_last_event_timestamp_seconds',    'gauge',    'Time of the last event'),
+    ]
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_write = 0.0
+
+        # (metric name, labels) -> value
+        self.values = {}
+
+        # device -> time the first data was acknowledged
+        self.transfer_start = {}
+
+    def _add(self, name, labels, value):
+        self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def _set(self, name, labels, value):
+        self.values[(name, labels)] = value
+
+    def emit(self, event):
+        device = (('device', event['device']),)
+        kind = event['event']
+
+        with self.lock:
+            self._set('dfu_last_event_timestamp_seconds', device, event['ts'])
+
+            if kind == 'phase_end':
+                phase = 'objects' if event['phase'].startswith('object ') else event['phase']
+                self._add('dfu_phase_seconds', device + (('phase', phase),), event['wall'])
+
+            elif kind == 'bytes_acked':
+                start = self.transfer_start.setdefault(event['device'], event['ts'])
+                self._set('dfu_image_bytes', device, event['total'])
+                self._set('dfu_bytes_acked', device, event['bytes'])
+                if event['ts'] > start:
+                    self._set('dfu_throughput_bytes_per_second', device, event['bytes'] / (event['ts'] - start))
+
+            elif kind == 'prn_rtt':
+                self._add('dfu_prn_rtt_seconds_sum', device, event['rtt'])
+                self._add('dfu_prn_rtt_seconds_count', device, 1)
+
+            elif kind == 'retransmit':
+                self._add('dfu_retransmits_total', device, 1)
+
+            elif kind == 'crc_mismatch':
+                self._add('dfu_crc_mismatches_total', device, 1)
+
+            elif kind == 'connect':
+                self._add('dfu_reconnects_total', device, 1 if event['reconnect'] else 0)
+
+            elif kind == 'result':
+                self._set('dfu_success', device, 1 if event['success'] else 0)
+                self.transfer_start.pop(event['device'], None)
+
+            if kind in ('phase_end', 'result') or event['ts'] - self.last_write >= self.interval:
+                self._write()
+                self.last_write = event['ts']
+
+    def close(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        lines = []
+
+        for (name, kind, text) in self.METRICS:
+            # A summary is written as its _sum and _count series
+            names = [name + '_sum', name + '_count'] if kind == 'summary' else [name]
+
+            series = sorted((metric, labels, value) for ((metric, labels), value) in self.values.items() if metric in names)
+            if not series:
+                continue
+
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric, labels, value) in series:
+                label_str = ','.join('{}="{}"'.format(key, val) for (key, val) in labels)
+                lines.append('{}{{{}}} {}'.format(metric, label_str, repr(float(value))))
+
+        # The collector never reads a half-written file
+        atomic_write(self.path, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+#------------------------------------------------------------------------------
+# Sinks for the command line options (either may be None)
+#------------------------------------------------------------------------------
+def create_sinks(jsonl_path=None, prometheus_path=None):
+    sinks = []
+
+    if jsonl_path:
+        sinks.append(JsonLinesSink(jsonl_path))
+    if prometheus_path:
+        sinks.append(PrometheusSink(prometheus_path))
+
+    return sinks
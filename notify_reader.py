@@ -0,0 +1,82 @@
+#------------------------------------------------------------------------------
+# Background reader for Control Point notifications
+#
+# While a window of data packets is streamed, the reader thread consumes the
+# notifications from the transport into a queue, so the sender only has to
+# block when its window of outstanding receipts is full.
+#------------------------------------------------------------------------------
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class NotificationReader(threading.Thread):
+
+    # --------------------------------------------------------------------------
+    #  count:   stop after this many notifications
+    #  until:   stop after a notification for which until(value) is True
+    #  timeout: give up if nothing arrived for this many seconds
+    #  handle:  only read notifications for this handle
+    # --------------------------------------------------------------------------
+    def __init__(self, transport, count=None, until=None, timeout=30, poll=0.5, handle=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.transport = transport
+        self.count = count
+        self.until = until
+        self.timeout = timeout
+        self.poll = poll
+        self.handle = handle
+
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+
+    def run(self):
+        received = 0
+        last_time = time.time()
+
+        try:
+            while not self.stopped.is_set():
+                if self.count is not None and received >= self.count:
+                    break
+
+                notify = self.transport.wait_for_notification(timeout=self.poll, handle=self.handle)
+                if notify is None:
+                    if time.time() - last_time > self.timeout:
+                        self.queue.put((time.time(), None))
+                        break
+                    continue
+
+                last_time = time.time()
+                received += 1
+                self.queue.put((last_time, notify.value))
+
+                if self.until is not None and self.until(notify.value):
+                    break
+
+        except Exception as e:
+            self.queue.put((time.time(), e))
+
+    # --------------------------------------------------------------------------
+    #  Returns (arrival time, notification value). The value is None if the
+    #  reader timed out. Exceptions raised by the transport are re-raised.
+    # --------------------------------------------------------------------------
+    def get(self, timeout=30):
+        try:
+            (arrival, value) = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return (time.time(), None)
+
+        if isinstance(value, Exception):
+            raise value
+
+        return (arrival, value)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
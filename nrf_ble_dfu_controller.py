@@ -1,12 +1,20 @@
 import os
-import pexpect
-import re
+import shutil
+import time
 import zlib
 
 from abc   import ABCMeta, abstractmethod
-from array import array
+from intelhex import IntelHex
 from util  import *
 from scan import Scan
+from scanner import running_scanner
+from transport import GatttoolTransport, Att
+from notify_reader import NotificationReader
+from phases import PhaseTimer
+from metrics import Metrics
+from package import PackageImage
+from image_cache import PreparedImage, file_digest
+from steps import io, run_steps
 
 verbose = False
 
@@ -21,11 +29,69 @@ class NrfBleDfuController(object):
     pkt_receipt_interval = 10
     pkt_payload_size     = 20
 
+    # Tune pkt_receipt_interval to the link during the transfer
+    adaptive_prn         = False
+
+    # Receipt windows kept in flight while streaming data (1: stop and wait)
+    pkt_receipt_window   = 1
+
+    # Background reader, set while a window of data is being streamed
+    notify_reader        = None
+
+    # Largest ATT MTU requested from the peer (SDK bootloaders accept 247)
+    max_att_mtu          = 247
+
+    # Seconds to scan for the target before connecting, None: connect directly
+    scan_timeout         = None
+
+    # Upper bound in seconds for a device told to enter its bootloader to
+    # drop the link, reboot and accept a connection
+    reboot_timeout       = 15
+
+    # Retry budgets for data objects, see retry.py (secure bootloader only)
+    object_retries       = 5
+    session_retries      = 30
+
+    # Package to update from instead of firmware_path and datfile_path,
+    # see package.py
+    package              = None
+
+    # Images to transfer, one after the other, and the current one
+    images               = []
+    image_index          = 0
+    image                = None
+    init_packet          = None
+
+    # ImageCache sharing prepared images between sessions and runs,
+    # see image_cache.py. None: prepare the images for this session only.
+    image_cache          = None
+
+    # DfuJournal recording transfer progress, see journal.py
+    journal              = None
+
+    # GATT handles of the connected peer, {uuid: (char, value, CCCD handle)},
+    # for the mode it runs in ('app' or 'dfu'). See handle_cache.py.
+    handle_cache         = None
+    handles              = None
+    handles_cached       = False
+    peer_mode            = None
+
+    # UUIDs resolved together for each mode
+    MODE_UUIDS           = {}
+
+    # DFU profile, 'secure' or 'legacy', keying cached handles with the mode
+    PROFILE              = None
+
+    # --------------------------------------------------------------------------
+    #  The procedures are steps, see steps.py, so that the asyncio engine
+    #  (async_dfu.py) runs the same ones.
+    # --------------------------------------------------------------------------
+
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
     @abstractmethod
-    def start(self):
+    def _start(self):
         pass
 
     # --------------------------------------------------------------------------
@@ -33,14 +99,14 @@ class NrfBleDfuController(object):
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
     @abstractmethod
-    def check_DFU_mode(self):
+    def _check_DFU_mode(self):
         pass
 
     @abstractmethod
     # --------------------------------------------------------------------------
     #  Switch from application to bootloader (DFU)
     # --------------------------------------------------------------------------
-    def switch_to_dfu_mode(self):
+    def _switch_to_dfu_mode(self):
         pass
 
     # --------------------------------------------------------------------------
@@ -57,200 +123,515 @@ class NrfBleDfuController(object):
     def _wait_and_parse_notify(self):
         pass
 
-    def __init__(self, target_mac, firmware_path, datfile_path):
+    # --------------------------------------------------------------------------
+    #  transport: a BleTransport instance, defaults to gatttool
+    # --------------------------------------------------------------------------
+    def __init__(self, target_mac, firmware_path, datfile_path, transport=None):
         self.target_mac = target_mac
 
+        # Address the device was given by, journal entries are keyed by it
+        self.device_address = target_mac
+
         self.firmware_path = firmware_path
         self.datfile_path = datfile_path
-        self.scan_obj = Scan(None)
-        scan_list = self.scan_obj.scan()
-        self.ble_conn = pexpect.spawn("gatttool -b '%s' -t random --interactive" % target_mac)
-        self.ble_conn.delaybeforesend = 0
+
+        if transport is None:
+            transport = GatttoolTransport(target_mac)
+        self.transport = transport
+        self.phase_timer = PhaseTimer()
+
+        # Attach sinks to report the transfer, see metrics.py
+        self.metrics = Metrics(target_mac)
 
     # --------------------------------------------------------------------------
-    #  Start the firmware update process
+    #  Blocking entry points, each running its steps to the end
     # --------------------------------------------------------------------------
     def start(self):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+        return run_steps(self._start())
+
+    def check_DFU_mode(self):
+        return run_steps(self._check_DFU_mode())
+
+    def switch_to_dfu_mode(self):
+        return run_steps(self._switch_to_dfu_mode())
 
-        if verbose:
-            print('Control Point Handle: 0x%04x, CCCD: 0x%04x' % (self.ctrlpt_handle, self.ctrlpt_cccd_handle))
-            print('Packet handle: 0x%04x' % (self.data_handle))
+    def scan_and_connect(self, timeout=30, scan=True):
+        return run_steps(self._scan_and_connect(timeout, scan))
 
-        # Subscribe to notifications from Control Point characteristic
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+    def resume_interrupted(self):
+        return run_steps(self._resume_interrupted())
 
-        # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
+    def target_mac_increase(self, inc):
+        return run_steps(self._target_mac_increase(inc))
+
+    def set_target(self, target_mac):
+        return run_steps(self._set_target(target_mac))
+
+    # --------------------------------------------------------------------------
+    #  What the steps leave to the engine: output, and waits that are not
+    #  transport operations. The asyncio engine replaces them.
+    # --------------------------------------------------------------------------
+    def log(self, msg):
+        print(msg)
 
-        self._dfu_send_init()
+    def _progress(self, offset):
+        print_progress(offset, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
 
-        self._dfu_send_image()
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    # --------------------------------------------------------------------------
+    #  Arrival time of a notification just returned by the transport
+    # --------------------------------------------------------------------------
+    def _arrival_time(self, notify):
+        return time.time()
 
     # --------------------------------------------------------------------------
     # Initialize: 
-    #    Hex: read and convert hexfile into bin_array 
-    #    Bin: read binfile into bin_array
+    #    Package: take its images, in transfer order
+    #    Hex: read and convert hexfile into the application image
+    #    Bin: read binfile into the application image
     # --------------------------------------------------------------------------
     def input_setup(self):
-        print("Sending file " + os.path.split(self.firmware_path)[1] + " to " + self.target_mac)
+        if self.package is not None:
+            print("Sending package " + os.path.split(self.package.path)[1] + " to " + self.target_mac)
+
+            self.images = [self._prepare_image(lambda image=image: '%s-%s' % (self.package.digest, image.type),
+                                               lambda image=image: image)
+                           for image in self.package.images.values()]
+            self._select_image(0)
+            return
 
         if self.firmware_path == None:
             raise Exception("input invalid")
 
+        print("Sending file " + os.path.split(self.firmware_path)[1] + " to " + self.target_mac)
+
+        name, extent = os.path.splitext(self.firmware_path)
+
+        if extent not in (".bin", ".hex"):
+            raise Exception("input invalid")
+
+        self.images = [self._prepare_image(lambda: file_digest(self.firmware_path, self.datfile_path) + '-application',
+                                           self._read_firmware_files)]
+        self._select_image(0)
+
+    def _read_firmware_files(self):
         name, extent = os.path.splitext(self.firmware_path)
 
         if extent == ".bin":
-            self.bin_array = array('B', open(self.firmware_path, 'rb').read())
+            with open(self.firmware_path, 'rb') as f:
+                firmware = f.read()
+        else:
+            firmware = IntelHex(self.firmware_path).tobinarray().tobytes()
 
-            self.image_size = len(self.bin_array)
-            print("Binary imge size: %d" % self.image_size)
+        with open(self.datfile_path, 'rb') as f:
+            init_packet = f.read()
 
-            return
+        return PackageImage('application', os.path.basename(self.firmware_path), firmware, init_packet, {})
 
-        if extent == ".hex":
-            intelhex = IntelHex(self.firmware_path)
-            self.bin_array = intelhex.tobinarray()
-            self.image_size = len(self.bin_array)
-            print("bin array size: ", self.image_size)
-            return
+    # --------------------------------------------------------------------------
+    #  PreparedImage of the PackageImage load() returns, taken from the
+    #  image cache under the key key() returns if there is one
+    # --------------------------------------------------------------------------
+    def _prepare_image(self, key, load):
+        if self.image_cache is None:
+            return PreparedImage.from_image(load())
+
+        return self.image_cache.prepared(key(), load)
 
-        raise Exception("input invalid")
+    # --------------------------------------------------------------------------
+    #  Make images[index] the image to transfer. Its transport wire form
+    #  (bin_wire) is encoded once per image, so that the data packets can be
+    #  sliced straight out of it.
+    # --------------------------------------------------------------------------
+    def _select_image(self, index):
+        image = self.images[index]
+
+        self.image_index = index
+        self.image = image
+        self.image_size = image.size
+        self.bin_wire = image.payload(self.transport)
+        self.init_packet = image.init_packet
 
+        if len(self.images) > 1:
+            print("Image %d of %d: %s, %d bytes" % (index + 1, len(self.images), image.type, self.image_size))
+        else:
+            print("Binary image size: %d" % self.image_size)
+
+    # --------------------------------------------------------------------------
+    #  After an image other than the last, the bootloader activates it and
+    #  resets. Reconnect for the next image, reusing the handles found so
+    #  far. Returns False if there is no next image.
     # --------------------------------------------------------------------------
-    # Perform a scan and connect via gatttool.
+    def _next_image(self):
+        if self.image_index + 1 >= len(self.images):
+            return False
+
+        (mode, handles) = (self.peer_mode, self.handles)
+
+        deadline = time.time() + self.reboot_timeout
+        yield from self._wait_for_link_loss(deadline)
+
+        self._select_image(self.image_index + 1)
+        if not (yield from self._reconnect_after_reset(deadline)):
+            raise Exception("Couldn't reconnect for the {} image".format(self.images[self.image_index].type))
+
+        self._reuse_handles(mode, handles)
+        return True
+
+    # --------------------------------------------------------------------------
+    # Perform a scan and connect via the transport.
     # Will return True if a connection was established, False otherwise
     # --------------------------------------------------------------------------
-    def scan_and_connect(self, timeout=30):
+    def _scan_and_connect(self, timeout=30, scan=True):
         if verbose: print("scan_and_connect")
 
-        print("Connecting to %s" % (self.target_mac))
+        self._phase('connect')
+        self.log("Connecting to %s" % (self.target_mac))
 
-        try:
-            self.ble_conn.expect('\[LE\]>', timeout=timeout)
-        except pexpect.TIMEOUT as e:
+        # Handles belong to the previous connection
+        self.handles = None
+        self.peer_mode = None
+
+        if scan and self.scan_timeout is not None and not (yield from self._scan_for_target()):
             return False
 
-        self.ble_conn.sendline('connect')
+        connected = yield io(self.transport.connect, timeout=timeout)
+        if connected:
+            self.metrics.connect(self.target_mac)
 
-        try:
-            res = self.ble_conn.expect('.*Connection successful.*', timeout=timeout)
-        except pexpect.TIMEOUT as e:            
+        return connected
+
+    # --------------------------------------------------------------------------
+    #  Scan until the target advertises. Returns False if it was not seen.
+    # --------------------------------------------------------------------------
+    def _scan_for_target(self):
+        name = yield io(self._find_target, self.scan_timeout)
+        if name is None:
+            self.log("%s not seen within %d seconds" % (self.target_mac, self.scan_timeout))
             return False
 
+        if verbose: print("Found %s %s" % (self.target_mac, name))
         return True
 
     # --------------------------------------------------------------------------
-    #  Disconnect from the peripheral and close the gatttool connection
+    #  Wait until the target advertises, after the time since if given.
+    #  Returns its name ('' if unknown), or None if it was not seen.
+    #  With a background scanner on the adapter, its registry answers
+    #  without a scan of our own.
+    # --------------------------------------------------------------------------
+    def _find_target(self, timeout, since=None):
+        adapter = self.transport.adapter or 'hci0'
+        scanner = running_scanner(adapter)
+        if scanner is not None:
+            device = scanner.registry.wait_for(self.target_mac, timeout, since=since)
+            return (device.name or '') if device is not None else None
+
+        # A fresh scan only reports what advertises from now on
+        return Scan(None, adapter).find(self.target_mac, timeout)
+
+    # --------------------------------------------------------------------------
+    #  True if the target's advertising can be watched for: by a background
+    #  scanner, or by hcitool when scanning was asked for
+    # --------------------------------------------------------------------------
+    def _can_watch_advertising(self):
+        if running_scanner(self.transport.adapter or 'hci0') is not None:
+            return True
+
+        return self.scan_timeout is not None and shutil.which('hcitool') is not None
+
+    # --------------------------------------------------------------------------
+    #  After a reset command: wait until the peer drops the link, or until
+    #  deadline. Returns True if the link was lost.
+    # --------------------------------------------------------------------------
+    def _wait_for_link_loss(self, deadline):
+        try:
+            while time.time() < deadline:
+                yield io(self.transport.wait_for_notification, min(0.1, max(0, deadline - time.time())))
+        except Exception:
+            return True
+
+        return False
+
+    # --------------------------------------------------------------------------
+    #  Connect to the target once it has rebooted, at the latest by deadline.
+    #  When its advertising can be watched for, connect as soon as it
+    #  advertises. Otherwise the connection attempt itself waits for it.
+    # --------------------------------------------------------------------------
+    def _reconnect_after_reset(self, deadline):
+        if self._can_watch_advertising():
+            since = time.time()
+            if (yield io(self._find_target, max(0, deadline - time.time()), since)) is None:
+                self.log("%s did not advertise within %d seconds of the reset" % (self.target_mac, self.reboot_timeout))
+                return False
+
+            return (yield from self._scan_and_connect(scan=False))
+
+        return (yield from self._scan_and_connect(timeout=max(1, deadline - time.time())))
+
+    # --------------------------------------------------------------------------
+    #  Disconnect from the peripheral and close the transport
     # --------------------------------------------------------------------------
     def disconnect(self):
-        self.ble_conn.sendline('exit')
-        self.ble_conn.close()
+        self._phase_end()
+        self.transport.disconnect()
 
-    def target_mac_increase(self, inc):
-        self.target_mac = uint_to_mac_string(mac_string_to_uint(self.target_mac) + inc)
+    # --------------------------------------------------------------------------
+    #  Enter the next phase of the update, see PhaseTimer
+    # --------------------------------------------------------------------------
+    def _phase(self, name):
+        self._phase_end()
+        self.phase_timer.begin(name)
+        self.metrics.phase_start(name)
 
-        # Re-start gatttool with the new address
-        self.disconnect()
-        self.ble_conn = pexpect.spawn("gatttool -b '%s' -t random --interactive" % self.target_mac)
-        self.ble_conn.delaybeforesend = 0
+    def _phase_end(self):
+        phase = self.phase_timer.end()
+        if phase is not None:
+            self.metrics.phase_end(phase['name'], phase['wall'], phase['cpu'])
+
+    def _target_mac_increase(self, inc):
+        yield from self._set_target(uint_to_mac_string(mac_string_to_uint(self.target_mac) + inc))
+
+    # --------------------------------------------------------------------------
+    #  Point the controller and its transport at a new address
+    # --------------------------------------------------------------------------
+    def _set_target(self, target_mac):
+        self.target_mac = target_mac
+        yield io(self.transport.set_target, target_mac)
+
+    # --------------------------------------------------------------------------
+    #  Connect to the bootloader of an interrupted transfer of this image,
+    #  as recorded in the journal. Returns True if connected, otherwise the
+    #  controller is pointed back at the device address.
+    # --------------------------------------------------------------------------
+    def _resume_interrupted(self):
+        entry = self.journal_entry()
+        if entry is None or entry.get('address', self.target_mac) == self.target_mac:
+            return False
+
+        self.log("Resuming interrupted update at {}".format(entry['address']))
+        yield from self._set_target(entry['address'])
+        self.metrics.interrupted()
+
+        if (yield from self._scan_and_connect()):
+            return True
+
+        yield from self._set_target(self.device_address)
+        return False
+
+    # --------------------------------------------------------------------------
+    #  Journal entry of an interrupted transfer of this image or a later one,
+    #  or None. The image it belongs to is selected, the ones before it were
+    #  transferred already.
+    # --------------------------------------------------------------------------
+    def journal_entry(self):
+        if self.journal is None:
+            return None
+
+        for index in range(self.image_index, len(self.images)):
+            image = self.images[index]
+            entry = self.journal.get(self.device_address, image.digest)
+            if entry is not None:
+                if index != self.image_index:
+                    self._select_image(index)
+                return entry
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Image offset the journal recorded as executed, or None
+    # --------------------------------------------------------------------------
+    def _journal_offset(self):
+        if self.journal is None:
+            return None
+
+        entry = self.journal.get(self.device_address, self.image.digest)
+        return entry.get('offset') if entry is not None else None
+
+    def _journal_update(self, **fields):
+        if self.journal is not None:
+            self.journal.update(self.device_address, self.image.digest, **fields)
+
+    def _journal_remove(self):
+        if self.journal is not None:
+            self.journal.remove(self.device_address, self.image.digest)
+
+    # --------------------------------------------------------------------------
+    #  Negotiate the ATT MTU and size the data packets to fit in it.
+    #  A write command carries 3 bytes of ATT header on top of the payload.
+    # --------------------------------------------------------------------------
+    def _negotiate_mtu(self):
+        mtu = Att.DEFAULT_MTU
+        if self.max_att_mtu > Att.DEFAULT_MTU:
+            mtu = min((yield io(self.transport.exchange_mtu, self.max_att_mtu)), self.max_att_mtu)
+
+        self.pkt_payload_size = mtu - 3
+        self.log("ATT MTU: %d, packet payload size: %d" % (mtu, self.pkt_payload_size))
 
     # --------------------------------------------------------------------------
     #  Fetch handles for a given UUID.
     #  Will return a three-tuple: (char handle, value handle, CCCD handle)
     #  Will raise an exception if the UUID is not found
+    #  All UUIDs of the peer mode (DFU unless known otherwise) are resolved
+    #  at once, from the handle cache or by one discovery pass.
     # --------------------------------------------------------------------------
     def _get_handles(self, uuid):
-        self.ble_conn.before = ""
-        self.ble_conn.sendline('characteristics')
+        if self.handles is None:
+            mode = self.peer_mode or 'dfu'
+            if not self._use_cached_handles(mode):
+                self._use_handles(mode, (yield from self._discover_handles(self.MODE_UUIDS[mode])))
 
-        try:
-            self.ble_conn.expect([uuid], timeout=10)
-            handles = re.findall('.*handle: (0x....),.*char value handle: (0x....)', self.ble_conn.before.decode('utf-8'))
-            (handle, value_handle) = handles[-1]
-            
-        except pexpect.TIMEOUT as e:
-            raise Exception("UUID not found: {}".format(uuid))
+        if uuid in self.handles:
+            return self.handles[uuid]
+
+        if self._drop_cached_handles():
+            return (yield from self._get_handles(uuid))
+
+        raise Exception("UUID not found: {}".format(uuid))
+
+    # --------------------------------------------------------------------------
+    #  Control Point and Packet handles of the bootloader
+    # --------------------------------------------------------------------------
+    def _resolve_dfu_handles(self):
+        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = yield from self._get_handles(self.UUID_CONTROL_POINT)
+        (_, self.data_handle, _) = yield from self._get_handles(self.UUID_PACKET)
+
+    # --------------------------------------------------------------------------
+    #  One discovery pass. Returns {uuid: handles} for the UUIDs found.
+    # --------------------------------------------------------------------------
+    def _discover_handles(self, uuids, timeout=10):
+        chars = yield io(self.transport.discover, uuids, timeout=timeout)
+        return self._handles_from(chars, uuids)
 
-        return (int(handle, 16), int(value_handle, 16), int(value_handle, 16)+1)
+    def _handles_from(self, chars, uuids):
+        return dict((char.uuid, (char.handle, char.value_handle, char.value_handle+1))
+                    for char in chars if char.uuid in uuids)
+
+    # --------------------------------------------------------------------------
+    #  Take the handles of the peer in mode from the cache. Returns False if
+    #  none are cached, or the entry lacks UUIDs of the mode; such an entry
+    #  is dropped, so that they are discovered.
+    # --------------------------------------------------------------------------
+    def _use_cached_handles(self, mode):
+        if self.handle_cache is None:
+            return False
+
+        handles = self.handle_cache.get(self.target_mac, self.PROFILE, mode)
+        if handles is None:
+            return False
+
+        self.peer_mode = mode
+        self.handles = handles
+        self.handles_cached = True
+
+        if any(uuid not in handles for uuid in self.MODE_UUIDS[mode]):
+            self._drop_cached_handles()
+            return False
+
+        return True
+
+    # --------------------------------------------------------------------------
+    #  Take discovered handles, and cache them if all UUIDs of mode were found
+    # --------------------------------------------------------------------------
+    def _use_handles(self, mode, handles):
+        handles = dict((uuid, h) for (uuid, h) in handles.items() if uuid in self.MODE_UUIDS[mode])
+
+        self.peer_mode = mode
+        self.handles = handles
+        self.handles_cached = False
+
+        if self.handle_cache is not None and len(handles) == len(self.MODE_UUIDS[mode]):
+            self.handle_cache.put(self.target_mac, self.PROFILE, mode, handles)
+
+    # --------------------------------------------------------------------------
+    #  Use handles found before a reset again. Like cached ones, they are
+    #  discovered again if a write to them fails.
+    # --------------------------------------------------------------------------
+    def _reuse_handles(self, mode, handles):
+        self.peer_mode = mode
+        self.handles = handles
+        self.handles_cached = True
+
+    # --------------------------------------------------------------------------
+    #  A write to a handle failed. If the handles came from the cache they
+    #  may be stale: forget them and return True, so the caller discovers
+    #  them again and retries.
+    # --------------------------------------------------------------------------
+    def _drop_cached_handles(self):
+        if not self.handles_cached:
+            return False
+
+        print("Cached handles of {} failed, discovering again".format(self.target_mac))
+        if self.handle_cache is not None:
+            self.handle_cache.remove(self.target_mac, self.PROFILE, self.peer_mode)
+        self.handles = None
+        self.handles_cached = False
+        return True
 
     # --------------------------------------------------------------------------
     #  Wait for notification to arrive.
-    #  Example format: "Notification handle = 0x0019 value: 10 01 01"
-    # --------------------------------------------------------------------------
-    def _dfu_wait_for_notify(self):
-        while True:
-            if verbose: print("dfu_wait_for_notify")
-
-            if not self.ble_conn.isalive():
-                print("connection not alive")
-                return None
-
-            try:
-                index = self.ble_conn.expect('Notification handle = .*? \r\n', timeout=30)
-
-            except pexpect.TIMEOUT:
-                #
-                # The gatttool does not report link-lost directly.
-                # The only way found to detect it is monitoring the prompt '[CON]'
-                # and if it goes to '[   ]' this indicates the connection has
-                # been broken.
-                # In order to get a updated prompt string, issue an empty
-                # sendline('').  If it contains the '[   ]' string, then
-                # raise an exception. Otherwise, if not a link-lost condition,
-                # continue to wait.
-                #
-                self.ble_conn.sendline('')
-                string = self.ble_conn.before.decode('utf-8')
-                if '[   ]' in string:
-                    print('Connection lost! ')
-                    raise Exception('Connection Lost')
-                return None
-
-            if index == 0:
-                after = self.ble_conn.after
-                hxstr = after.split()[3:]
-                handle = int(float.fromhex(hxstr[0].decode('utf-8')))
-                return hxstr[2:]
-
-            else:
-                print("unexpeced index: {0}".format(index))
-                return None
+    #  Returns the notification value as bytes, or None on timeout.
+    #  The arrival time is kept in notify_time.
+    # --------------------------------------------------------------------------
+    def _dfu_wait_for_notify(self, timeout=30):
+        if verbose: print("dfu_wait_for_notify")
+
+        if self.notify_reader is not None:
+            (self.notify_time, value) = yield io(self.notify_reader.get, timeout=timeout)
+            return value
+
+        notify = yield io(self.transport.wait_for_notification, timeout=timeout, handle=self._notify_handle())
+        self.notify_time = self._arrival_time(notify)
+        if notify is None:
+            return None
+
+        return notify.value
 
     # --------------------------------------------------------------------------
-    #  Send a procedure + any parameters required
+    #  Control Point responses are the notifications waited for; None (any
+    #  handle) until its handle is known
     # --------------------------------------------------------------------------
-    def _dfu_send_command(self, procedure, params=[]):
-        if verbose: print('_dfu_send_command')
+    def _notify_handle(self):
+        return self.ctrlpt_handle or None
 
-        cmd  = 'char-write-req 0x%04x %02x' % (self.ctrlpt_handle, procedure)
-        cmd += array_to_hex_string(params)
+    # --------------------------------------------------------------------------
+    #  Hand notifications over to a background reader while data is streamed.
+    #  See NotificationReader for count and until.
+    # --------------------------------------------------------------------------
+    def _start_notify_reader(self, count=None, until=None):
+        self.notify_reader = NotificationReader(self.transport, count=count, until=until,
+                                                handle=self._notify_handle())
+        self.notify_reader.start()
 
-        if verbose: print(cmd)
+    def _stop_notify_reader(self):
+        if self.notify_reader is not None:
+            self.notify_reader.stop()
+            self.notify_reader = None
 
-        self.ble_conn.sendline(cmd)
+    # --------------------------------------------------------------------------
+    #  Send a procedure + any parameters required
+    # --------------------------------------------------------------------------
+    def _dfu_send_command(self, procedure, params=[]):
+        if verbose: print('_dfu_send_command')
 
         # Verify that command was successfully written
-        try:
-            print("send command")
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=10)
-        except pexpect.TIMEOUT as e:
-            
-            print("State timeout")
+        if not (yield io(self.transport.write_req, self.ctrlpt_handle, [procedure] + list(params), timeout=10)):
+            self.log("State timeout")
 
     # --------------------------------------------------------------------------
     #  Send an array of bytes
     # --------------------------------------------------------------------------
     def _dfu_send_data(self, data):
-        cmd  = 'char-write-cmd 0x%04x' % (self.data_handle)
-        cmd += ' '
-        cmd += array_to_hex_string(data)
+        yield io(self.transport.write_cmd, self.data_handle, data)
 
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
+    # --------------------------------------------------------------------------
+    #  Send the firmware image from offset to end as data packets, handed to
+    #  the transport as one batch. The packets are slices of the pre-encoded
+    #  bin_wire.
+    # --------------------------------------------------------------------------
+    def _dfu_send_image_window(self, offset, end):
+        yield io(self.transport.write_cmd_burst, self.data_handle, self.bin_wire, offset, end, self.pkt_payload_size)
 
     # --------------------------------------------------------------------------
     #  Enable notifications from the Control Point Handle
@@ -258,17 +639,12 @@ class NrfBleDfuController(object):
     def _enable_notifications(self, cccd_handle):
         if verbose: print('_enable_notifications')
 
-        cmd  = 'char-write-req 0x%04x %s' % (cccd_handle, '0100')
-
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
-
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=10)
-        except pexpect.TIMEOUT as e:
-            print("State timeout")
+        if not (yield io(self.transport.write_req, cccd_handle, [0x01, 0x00], timeout=10)):
+            self.log("State timeout")
+            return False
+
+        return True
 
     # --------------------------------------------------------------------------
     #  Enable notifications from the Control Point Handle
@@ -276,14 +652,9 @@ class NrfBleDfuController(object):
     def _enable_indications(self, cccd_handle):
         if verbose: print('_enable_notifications')
 
-        cmd  = 'char-write-req 0x%04x %s' % (cccd_handle, '0200')
-
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
-
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=10)
-        except pexpect.TIMEOUT as e:
-            print("State timeout")
+        if not (yield io(self.transport.write_req, cccd_handle, [0x02, 0x00], timeout=10)):
+            self.log("State timeout")
+            return False
+
+        return True
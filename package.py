@@ -0,0 +1,70 @@
+#------------------------------------------------------------------------------
+# DFU zip packages, read into memory
+#
+# A package made by nrfutil holds a manifest.json naming, for each image it
+# carries, the firmware (.bin) and init packet (.dat) file. Package reads
+# the manifest and the files it names straight from the zip; nothing is
+# extracted. The contents are immutable bytes, so one Package can be shared
+# by any number of concurrent sessions.
+#
+# A package may carry a SoftDevice and/or bootloader update besides the
+# application. Its images are listed in the order they must be transferred.
+#------------------------------------------------------------------------------
+
+import collections
+import json
+import os
+import re
+import zipfile
+
+from image_cache import file_digest
+
+# Image types a manifest can name, in the order they are transferred: the
+# application last, as it is built against the SoftDevice
+IMAGE_TYPES = ('softdevice_bootloader', 'softdevice', 'bootloader', 'application')
+
+# One image of a package: firmware and init packet as bytes, and the
+# manifest's info_read_only_metadata (sd_size and bl_size of a combined
+# SoftDevice and bootloader image)
+PackageImage = collections.namedtuple('PackageImage', 'type bin_file firmware init_packet info')
+
+class Package(object):
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception("Error: file, not found!")
+
+        self.path = path
+        self.images = collections.OrderedDict()
+
+        # Content digest, keying the package's images in an ImageCache
+        self.digest = file_digest(path)
+
+        with zipfile.ZipFile(path, 'r') as archive:
+            names = archive.namelist()
+
+            if 'manifest.json' in names:
+                manifest = json.loads(archive.read('manifest.json').decode('utf-8')).get('manifest', {})
+            else:
+                # Without a manifest, take the .bin and .dat there are
+                manifest = {'application': {
+                    'bin_file': [name for name in names if re.search(r'\.bin$', name)].pop(),
+                    'dat_file': [name for name in names if re.search(r'\.dat$', name)].pop(),
+                }}
+
+            for image_type in IMAGE_TYPES:
+                entry = manifest.get(image_type)
+                if entry is None:
+                    continue
+
+                for name in (entry['bin_file'], entry['dat_file']):
+                    if name not in names:
+                        raise Exception("{} names {}, which is not in the package".format(image_type, name))
+
+                self.images[image_type] = PackageImage(image_type, entry['bin_file'],
+                                                       archive.read(entry['bin_file']),
+                                                       archive.read(entry['dat_file']),
+                                                       entry.get('info_read_only_metadata', {}))
+
+        if not self.images:
+            raise Exception("No firmware image in {}".format(path))
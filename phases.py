@@ -0,0 +1,72 @@
+#------------------------------------------------------------------------------
+# Per-phase timing of a DFU transfer
+#
+# A controller calls begin() as it enters each phase (connect, discovery,
+# init, object N, ...). Beginning a phase ends the previous one. Wall time
+# and the CPU time of the calling thread are recorded for each phase.
+#
+# The CPU time is per thread, so it is only the session's own when the
+# thread runs nothing else: a session of the sync engine. Sessions of the
+# async engine share the event loop thread and record no CPU time.
+#------------------------------------------------------------------------------
+
+import time
+
+class PhaseTimer(object):
+
+    # --------------------------------------------------------------------------
+    #  cpu: record the CPU time of the calling thread, otherwise cpu is None
+    # --------------------------------------------------------------------------
+    def __init__(self, cpu=True):
+        # Finished phases: dicts with name, start, wall and cpu (seconds)
+        self.phases = []
+        self.current = None
+        self.cpu = cpu
+
+    def begin(self, name):
+        self.end()
+        self.current = (name, time.time(), time.thread_time() if self.cpu else None)
+
+    # --------------------------------------------------------------------------
+    #  End the current phase. Returns the finished phase, or None.
+    # --------------------------------------------------------------------------
+    def end(self):
+        if self.current is None:
+            return None
+
+        (name, wall_start, cpu_start) = self.current
+        self.current = None
+        self.phases.append({
+            'name'  : name,
+            'start' : wall_start,
+            'wall'  : time.time() - wall_start,
+            'cpu'   : time.thread_time() - cpu_start if self.cpu else None,
+        })
+
+        return self.phases[-1]
+
+    def reset(self):
+        self.phases = []
+        self.current = None
+
+    # --------------------------------------------------------------------------
+    #  Total wall and cpu time per phase name, in the order first seen.
+    #  A phase entered several times (reconnect, retransmitted object) is
+    #  summed, and its count kept. cpu is None if it was not recorded.
+    # --------------------------------------------------------------------------
+    def totals(self):
+        totals = []
+        index = {}
+
+        for phase in self.phases:
+            if phase['name'] not in index:
+                index[phase['name']] = len(totals)
+                totals.append({'name': phase['name'], 'wall': 0.0, 'cpu': 0.0 if self.cpu else None, 'count': 0})
+
+            total = totals[index[phase['name']]]
+            total['wall'] += phase['wall']
+            if self.cpu:
+                total['cpu'] += phase['cpu']
+            total['count'] += 1
+
+        return totals
@@ -0,0 +1,85 @@
+#------------------------------------------------------------------------------
+# Adaptive Packet Receipt Notification (PRN) interval
+#
+# The sender reports every receipt window to this controller: when the last
+# packet of the window was written, and whether the receipt came back good,
+# late, corrupted or not at all. At each object boundary next_interval()
+# raises the interval on a clean link and lowers it on a noisy one.
+#------------------------------------------------------------------------------
+
+import time
+
+class AdaptivePrn(object):
+
+    def __init__(self, interval, min_interval=1, max_interval=64, late_factor=3.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.late_factor = late_factor
+
+        # Round trip time of the receipt, smoothed and best seen
+        self.rtt = None
+        self.min_rtt = None
+
+        self.window_start = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.receipts = 0
+        self.late = 0
+        self.errors = 0
+
+    # --------------------------------------------------------------------------
+    #  The last packet of a receipt window has been written.
+    #  Returns the time stamp to pass back to receipt().
+    # --------------------------------------------------------------------------
+    def window_sent(self):
+        self.window_start = time.time()
+        return self.window_start
+
+    # --------------------------------------------------------------------------
+    #  A receipt arrived and its offset/CRC matched.
+    #  sent/received default to the last window_sent() and now.
+    # --------------------------------------------------------------------------
+    def receipt(self, sent=None, received=None):
+        if sent is None:
+            sent = self.window_start
+        if received is None:
+            received = time.time()
+
+        rtt = received - sent
+        self.receipts += 1
+
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) / 8.0
+
+        if rtt > self.late_factor * self.min_rtt:
+            self.late += 1
+
+        return rtt
+
+    # --------------------------------------------------------------------------
+    #  A receipt did not arrive, or reported a bad offset/CRC
+    # --------------------------------------------------------------------------
+    def error(self):
+        self.errors += 1
+
+    # --------------------------------------------------------------------------
+    #  Called at an object boundary. Returns the interval for the next object.
+    #    errors:        halve the interval
+    #    late receipts: keep it
+    #    clean object:  double it
+    # --------------------------------------------------------------------------
+    def next_interval(self):
+        if self.errors:
+            self.interval = max(self.min_interval, self.interval // 2)
+        elif self.receipts and not self.late:
+            self.interval = min(self.max_interval, self.interval * 2)
+
+        self._reset_counters()
+        return self.interval
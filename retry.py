@@ -0,0 +1,67 @@
+#------------------------------------------------------------------------------
+# Retry policy for the data objects of a secure DFU transfer
+#
+# Every failed attempt at an object (a bad or missing receipt, or a checksum
+# that does not match) is reported to failure(), which enforces two budgets:
+# retries of one object, and retries over the whole session. Within budget
+# it returns how long to back off before the next attempt; the delay doubles
+# with every retry of the same object.
+#
+# It also bounds the wait for a receipt: once round trip times have been
+# seen, a receipt that takes much longer than the slowest of them is taken
+# as lost instead of waiting out the full timeout.
+#------------------------------------------------------------------------------
+
+class RetryPolicy(object):
+
+    def __init__(self, object_retries=5, session_retries=30, backoff=0.1, max_backoff=5.0,
+                 receipt_timeout=30.0, min_receipt_timeout=3.0, rtt_factor=8.0):
+        self.object_retries = object_retries
+        self.session_retries = session_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.receipt_timeout = receipt_timeout
+        self.min_receipt_timeout = min_receipt_timeout
+        self.rtt_factor = rtt_factor
+
+        self.object_failures = 0
+        self.session_failures = 0
+        self.max_rtt = None
+
+    # --------------------------------------------------------------------------
+    #  An object was executed, the next one starts with a fresh object budget
+    # --------------------------------------------------------------------------
+    def object_done(self):
+        self.object_failures = 0
+
+    # --------------------------------------------------------------------------
+    #  An attempt at the object at offset failed. Returns the delay in
+    #  seconds before the next attempt, raises if a budget is exhausted.
+    # --------------------------------------------------------------------------
+    def failure(self, offset):
+        self.object_failures += 1
+        self.session_failures += 1
+
+        if self.object_failures > self.object_retries:
+            raise Exception("Object at offset {} failed {} times, giving up".format(offset, self.object_failures))
+
+        if self.session_failures > self.session_retries:
+            raise Exception("{} retransmits in this session, giving up".format(self.session_failures))
+
+        return min(self.max_backoff, self.backoff * 2 ** (self.object_failures - 1))
+
+    # --------------------------------------------------------------------------
+    #  A receipt arrived after rtt seconds
+    # --------------------------------------------------------------------------
+    def receipt(self, rtt):
+        if self.max_rtt is None or rtt > self.max_rtt:
+            self.max_rtt = rtt
+
+    # --------------------------------------------------------------------------
+    #  Seconds to wait for the next receipt
+    # --------------------------------------------------------------------------
+    def next_receipt_timeout(self):
+        if self.max_rtt is None:
+            return self.receipt_timeout
+
+        return min(self.receipt_timeout, max(self.min_receipt_timeout, self.rtt_factor * self.max_rtt))
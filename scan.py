@@ -7,6 +7,7 @@
 from subprocess import call
 
 import pexpect
+import re
 import signal
 import sys
 import time
@@ -16,16 +17,17 @@ import time
 #------------------------------------------------------------------------------
 class HciTool:
 
-    def __init__( self, advert_name ):
+    def __init__( self, advert_name, adapter='hci0' ):
         self.advert_name = advert_name
+        self.adapter = adapter
         return
 
     def scan( self ):
 
         try:
-            self.hcitool = pexpect.spawn('hciconfig hci0 down')
-            self.hcitool = pexpect.spawn('hciconfig hci0 up')
-            self.hcitool = pexpect.spawn('hcitool lescan')            
+            self.hcitool = pexpect.spawn('hciconfig %s down' % self.adapter)
+            self.hcitool = pexpect.spawn('hciconfig %s up' % self.adapter)
+            self.hcitool = pexpect.spawn('hcitool -i %s lescan' % self.adapter)
             #self.hcitool.logfile = sys.stdout
             index = self.hcitool.expect(['LE Scan ...'])
             time.sleep(2)
@@ -77,13 +79,42 @@ class HciTool:
 
         return list
 
+    # --------------------------------------------------------------------------
+    #  Scan until the device with address mac advertises, or timeout expires.
+    #  Returns its advertised name ('(unknown)' if it has none), or None if
+    #  it was not seen. The adapter is not reset, so other connections on
+    #  it are left alone.
+    # --------------------------------------------------------------------------
+    def find( self, mac, timeout=10 ):
+        self.hcitool = None
+
+        try:
+            # --duplicates: report a device already seen by an earlier scan
+            self.hcitool = pexpect.spawn('hcitool -i %s lescan --duplicates' % self.adapter)
+            self.hcitool.expect('LE Scan ...', timeout=5)
+            self.hcitool.expect('%s ([^\r\n]*)' % re.escape(mac.upper()), timeout=timeout)
+            return self.hcitool.match.group(1).decode('utf-8', 'replace').strip()
+
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            return None
+        except Exception as err:
+            print("scan: exception: {0}".format(sys.exc_info()[0]))
+            return None
+
+        finally:
+            if self.hcitool is not None:
+                # SIGINT lets hcitool disable scanning on the adapter
+                self.hcitool.kill(signal.SIGINT)
+                self.hcitool.terminate(force=True)
+
 #------------------------------------------------------------------------------
 #
 #------------------------------------------------------------------------------
 class Scan:
 
-    def __init__( self, advert_name ):
+    def __init__( self, advert_name, adapter='hci0' ):
         self.advert_name = advert_name
+        self.adapter = adapter
         return    
 
     def scan(self):
@@ -91,7 +122,7 @@ class Scan:
         scan_list = []
 
         try:
-            hcitool = HciTool(self.advert_name)
+            hcitool = HciTool(self.advert_name, self.adapter)
             scan_list = hcitool.scan()
 
         except KeyboardInterrupt:
@@ -108,6 +139,16 @@ class Scan:
 
         return scan_list
 
+    # --------------------------------------------------------------------------
+    #  Targeted scan, see HciTool.find()
+    # --------------------------------------------------------------------------
+    def find(self, mac, timeout=10):
+        try:
+            return HciTool(self.advert_name, self.adapter).find(mac, timeout)
+
+        except KeyboardInterrupt:
+            return None
+
 #------------------------------------------------------------------------------
 #
 #------------------------------------------------------------------------------
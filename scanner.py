@@ -0,0 +1,329 @@
+#------------------------------------------------------------------------------
+# Background BLE scanner and device registry
+#
+# A BackgroundScanner thread keeps an adapter scanning over a raw HCI socket
+# and records every advertising report in a DeviceRegistry: name, RSSI, time
+# last seen, advertised service UUIDs and a guess whether the device runs
+# its application or a DFU bootloader. Controllers and the fleet scheduler
+# query the registry instead of running scans of their own.
+#
+# Scanning needs the same privileges as hcitool lescan (root or
+# CAP_NET_RAW), and an adapter no other process is scanning with.
+#------------------------------------------------------------------------------
+
+import collections
+import select
+import socket
+import struct
+import threading
+import time
+
+from transport import AF_BLUETOOTH, BLUETOOTH_BASE_UUID, uuid_from_bytes
+
+verbose = False
+
+BTPROTO_HCI         = getattr(socket, 'BTPROTO_HCI', 1)
+SOL_HCI             = getattr(socket, 'SOL_HCI', 0)
+HCI_FILTER          = getattr(socket, 'HCI_FILTER', 2)
+
+HCI_COMMAND_PKT     = 0x01
+HCI_EVENT_PKT       = 0x04
+EVT_LE_META_EVENT   = 0x3E
+EVT_LE_ADVERTISING_REPORT = 0x02
+
+OGF_LE_CTL          = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000B
+OCF_LE_SET_SCAN_ENABLE     = 0x000C
+
+# Advertising data types
+AD_UUID16           = (0x02, 0x03)
+AD_UUID32           = (0x04, 0x05)
+AD_UUID128          = (0x06, 0x07)
+AD_NAME             = (0x08, 0x09)
+
+# Bootloaders advertise under this name unless configured otherwise
+DFU_ADVERT_NAME     = 'DfuTarg'
+UUID_LEGACY_DFU_SERVICE = '00001530-1212-efde-1523-785feabcd123'
+
+# A device seen within this many seconds is taken to be reachable
+REACHABLE_AGE       = 10
+
+# One device as last seen by the scanner. mode: 'app', 'dfu' or None
+Device = collections.namedtuple('Device', 'address name rssi last_seen mode uuids')
+
+#------------------------------------------------------------------------------
+# Guess the mode of an advertising device. The secure DFU service (FE59) is
+# advertised by bootloaders and by applications with buttonless DFU alike,
+# so it decides nothing on its own.
+#------------------------------------------------------------------------------
+def guess_mode(name, uuids):
+    if name and name.startswith(DFU_ADVERT_NAME):
+        return 'dfu'
+    if UUID_LEGACY_DFU_SERVICE in uuids:
+        return 'dfu'
+    if name or uuids:
+        return 'app'
+    return None
+
+#------------------------------------------------------------------------------
+# Name and service UUIDs from advertising data
+#------------------------------------------------------------------------------
+def parse_advertising_data(data):
+    name = None
+    uuids = []
+
+    i = 0
+    while i + 1 < len(data):
+        length = data[i]
+        if length == 0:
+            break
+
+        ad_type = data[i + 1]
+        value = bytes(data[i + 2:i + 1 + length])
+        i += 1 + length
+
+        if ad_type in AD_NAME:
+            name = value.decode('utf-8', 'replace')
+        elif ad_type in AD_UUID16:
+            uuids += [BLUETOOTH_BASE_UUID % u for u in struct.unpack('<%dH' % (len(value) // 2), value[:len(value) // 2 * 2])]
+        elif ad_type in AD_UUID32:
+            uuids += ['%08x-0000-1000-8000-00805f9b34fb' % u for u in struct.unpack('<%dI' % (len(value) // 4), value[:len(value) // 4 * 4])]
+        elif ad_type in AD_UUID128:
+            uuids += [uuid_from_bytes(value[j:j + 16]) for j in range(0, len(value) - 15, 16)]
+
+    return (name, uuids)
+
+#------------------------------------------------------------------------------
+# Reports of an HCI LE Advertising Report event (packet type stripped).
+# Returns a list of (address, advertising data, rssi).
+#------------------------------------------------------------------------------
+def parse_advertising_report(event):
+    event = bytearray(event)
+    if len(event) < 4 or event[0] != EVT_LE_META_EVENT or event[2] != EVT_LE_ADVERTISING_REPORT:
+        return []
+
+    reports = []
+    num_reports = event[3]
+    i = 4
+
+    # Reports follow one another: type, address type, address, data, rssi
+    for _ in range(num_reports):
+        if i + 9 > len(event):
+            break
+
+        address = ':'.join('%02X' % b for b in reversed(event[i + 2:i + 8]))
+        length = event[i + 8]
+        data = event[i + 9:i + 9 + length]
+        if i + 9 + length >= len(event):
+            break
+
+        rssi = struct.unpack('b', bytes(event[i + 9 + length:i + 10 + length]))[0]
+        reports.append((address, data, rssi))
+        i += 10 + length
+
+    return reports
+
+#------------------------------------------------------------------------------
+# Devices seen by the scanners, by address
+#------------------------------------------------------------------------------
+class DeviceRegistry(object):
+
+    def __init__(self):
+        self.devices = {}
+        self.changed = threading.Condition()
+
+    # --------------------------------------------------------------------------
+    #  Record an advertising report. Scan responses carry the name apart
+    #  from the advertisement, so name and UUIDs add to what is known.
+    # --------------------------------------------------------------------------
+    def update(self, address, rssi, name=None, uuids=(), seen=None):
+        address = address.upper()
+
+        with self.changed:
+            old = self.devices.get(address)
+            if old is not None:
+                name = name or old.name
+                uuids = list(old.uuids) + [uuid for uuid in uuids if uuid not in old.uuids]
+
+            device = Device(address, name, rssi, seen or time.time(), guess_mode(name, uuids), tuple(uuids))
+            self.devices[address] = device
+            self.changed.notify_all()
+
+        return device
+
+    # --------------------------------------------------------------------------
+    #  The device, if it was seen within max_age seconds (None: ever)
+    # --------------------------------------------------------------------------
+    def get(self, address, max_age=None):
+        with self.changed:
+            device = self.devices.get(address.upper())
+
+        if device is None or (max_age is not None and time.time() - device.last_seen > max_age):
+            return None
+
+        return device
+
+    # --------------------------------------------------------------------------
+    #  Devices seen within max_age seconds, strongest signal first.
+    #  mode, min_rssi and name narrow the selection.
+    # --------------------------------------------------------------------------
+    def query(self, max_age=REACHABLE_AGE, mode=None, min_rssi=None, name=None):
+        now = time.time()
+
+        with self.changed:
+            devices = list(self.devices.values())
+
+        devices = [device for device in devices
+                   if (max_age is None or now - device.last_seen <= max_age)
+                   and (mode is None or device.mode == mode)
+                   and (min_rssi is None or device.rssi >= min_rssi)
+                   and (name is None or device.name == name)]
+
+        return sorted(devices, key=lambda device: -device.rssi)
+
+    # --------------------------------------------------------------------------
+    #  Wait until the device has been seen within max_age seconds, and
+    #  after the time since if given. Returns the Device, or None on timeout.
+    # --------------------------------------------------------------------------
+    def wait_for(self, address, timeout, max_age=REACHABLE_AGE, since=None):
+        deadline = time.time() + timeout
+
+        with self.changed:
+            while True:
+                device = self.devices.get(address.upper())
+                if device is not None and time.time() - device.last_seen <= max_age \
+                        and (since is None or device.last_seen >= since):
+                    return device
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+
+                self.changed.wait(remaining)
+
+#------------------------------------------------------------------------------
+# Scanner thread for one adapter
+#------------------------------------------------------------------------------
+class BackgroundScanner(threading.Thread):
+
+    # --------------------------------------------------------------------------
+    #  active: request scan responses, which carry most device names
+    # --------------------------------------------------------------------------
+    def __init__(self, registry, adapter='hci0', active=True, poll=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.registry = registry
+        self.adapter = adapter
+        self.active = active
+        self.poll = poll
+
+        self.sock = None
+        self.error = None
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+
+    def _send_command(self, ocf, params):
+        opcode = (OGF_LE_CTL << 10) | ocf
+        self.sock.send(struct.pack('<BHB', HCI_COMMAND_PKT, opcode, len(params)) + params)
+
+    def _open(self):
+        self.sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+        self.sock.bind((int(self.adapter[3:]),))
+
+        # Only LE meta events: type mask, event mask (64 bits), opcode
+        event_mask = 1 << EVT_LE_META_EVENT
+        self.sock.setsockopt(SOL_HCI, HCI_FILTER, struct.pack('<IIIH', 1 << HCI_EVENT_PKT,
+                                                              event_mask & 0xffffffff, event_mask >> 32, 0))
+
+        # Scan continuously (interval = window = 10 ms), reporting duplicates
+        # so that RSSI and last seen stay current
+        self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+        self._send_command(OCF_LE_SET_SCAN_PARAMETERS, struct.pack('<BHHBB', 1 if self.active else 0, 0x0010, 0x0010, 0, 0))
+        self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 1, 0))
+
+    def run(self):
+        try:
+            self._open()
+        except (socket.error, ValueError) as e:
+            self.error = e
+            print("scanner: {} on {}".format(e, self.adapter))
+            self.ready.set()
+            return
+
+        self.ready.set()
+
+        try:
+            while not self.stopped.is_set():
+                (readable, _, _) = select.select([self.sock], [], [], self.poll)
+                if not readable:
+                    continue
+
+                packet = self.sock.recv(260)
+                if not packet or bytearray(packet)[0] != HCI_EVENT_PKT:
+                    continue
+
+                self.handle_event(packet[1:])
+
+        except socket.error as e:
+            self.error = e
+            print("scanner: {} on {}".format(e, self.adapter))
+
+        finally:
+            try:
+                self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+            except socket.error:
+                pass
+            self.sock.close()
+
+    # --------------------------------------------------------------------------
+    #  Record the reports of one HCI event
+    # --------------------------------------------------------------------------
+    def handle_event(self, event):
+        for (address, data, rssi) in parse_advertising_report(event):
+            (name, uuids) = parse_advertising_data(data)
+            device = self.registry.update(address, rssi, name, uuids)
+            if verbose: print(device)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+#------------------------------------------------------------------------------
+# Scanners of this process, one per adapter, all feeding one registry
+#------------------------------------------------------------------------------
+registry = DeviceRegistry()
+scanners = {}
+scanners_lock = threading.Lock()
+
+# ------------------------------------------------------------------------------
+#  Start scanning on the adapter, unless a scanner already runs there.
+#  Returns the scanner, or None if the adapter could not be opened.
+# ------------------------------------------------------------------------------
+def start_scanner(adapter='hci0'):
+    with scanners_lock:
+        scanner = scanners.get(adapter)
+        if scanner is None:
+            scanner = BackgroundScanner(registry, adapter)
+            scanner.start()
+            scanner.ready.wait()
+            if scanner.error is not None:
+                return None
+            scanners[adapter] = scanner
+
+        return scanner
+
+def running_scanner(adapter='hci0'):
+    with scanners_lock:
+        scanner = scanners.get(adapter)
+
+    if scanner is None or not scanner.is_alive():
+        return None
+
+    return scanner
+
+def stop_scanners():
+    with scanners_lock:
+        for scanner in scanners.values():
+            scanner.stop()
+        scanners.clear()
@@ -0,0 +1,38 @@
+#------------------------------------------------------------------------------
+# Protocol steps shared by the blocking and the asyncio engine
+#
+# The DFU procedures are written once, as generators. A step yields io()
+# for every transport operation or wait, and is sent back its result, or
+# has the exception it raised thrown in at the yield. Sub-steps are run with
+# "yield from". run_steps() performs the operations as plain calls, for the
+# blocking controllers; async_dfu.run_steps_async() awaits the ones that
+# return an awaitable, for the asyncio engine, whose transports are
+# coroutines.
+#------------------------------------------------------------------------------
+
+import collections
+
+# An operation for the engine to perform: function(*args, **kwargs)
+Io = collections.namedtuple('Io', 'function args kwargs')
+
+def io(function, *args, **kwargs):
+    return Io(function, args, kwargs)
+
+#------------------------------------------------------------------------------
+# Run steps to the end, blocking on every operation. Returns what the steps
+# return.
+#------------------------------------------------------------------------------
+def run_steps(steps):
+    (result, error) = (None, None)
+
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+
+        (result, error) = (None, None)
+        try:
+            result = request.function(*request.args, **request.kwargs)
+        except BaseException as e:
+            error = e
@@ -0,0 +1,129 @@
+#------------------------------------------------------------------------------
+# Fixtures driving DFU sessions against the simulated peer
+#
+# Sessions run the secure or legacy controller on the sync engine
+# (ble_*_dfu_controller.py) or the async one (async_dfu.py), talking to a
+# SimWorld through the simulator's ATT socket transports. No adapter or
+# gatttool is needed.
+#------------------------------------------------------------------------------
+
+import asyncio
+import json
+import os
+import random
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dfu_sim import SimConfig, SimWorld, SimAttSocketTransport, sim_async_transport
+from ble_secure_dfu_controller import BleDfuControllerSecure
+from ble_legacy_dfu_controller import BleDfuControllerLegacy
+from async_dfu import AsyncBleDfuControllerSecure, AsyncBleDfuControllerLegacy
+
+# Application address; a secure bootloader advertises at the next one
+APP_MAC = 'CD:E3:4A:47:1C:E4'
+DFU_MAC = 'CD:E3:4A:47:1C:E5'
+
+ENGINES = ('sync', 'async')
+PROFILES = ('secure', 'legacy')
+
+CONTROLLERS = {
+    ('sync', 'secure')  : BleDfuControllerSecure,
+    ('sync', 'legacy')  : BleDfuControllerLegacy,
+    ('async', 'secure') : AsyncBleDfuControllerSecure,
+    ('async', 'legacy') : AsyncBleDfuControllerLegacy,
+}
+
+# ------------------------------------------------------------------------------
+#  Nothing a session writes ends up in the real home directory
+# ------------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+def random_bytes(size, seed):
+    rng = random.Random(seed)
+    return bytes(bytearray(rng.randrange(256) for _ in range(size)))
+
+# ------------------------------------------------------------------------------
+#  An application image: (firmware path, init packet path, firmware)
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def firmware(tmp_path):
+    firmware = random_bytes(20000, 1)
+    bin_path = tmp_path / 'app.bin'
+    dat_path = tmp_path / 'app.dat'
+    bin_path.write_bytes(firmware)
+    dat_path.write_bytes(random_bytes(141, 2))
+    return (str(bin_path), str(dat_path), firmware)
+
+# ------------------------------------------------------------------------------
+#  A package with a SoftDevice and bootloader image and an application:
+#  (path, [firmware in transfer order])
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def package_zip(tmp_path):
+    sd_bl = random_bytes(14000, 3)
+    app = random_bytes(20000, 4)
+    manifest = {'manifest': {
+        'softdevice_bootloader': {'bin_file': 'sd_bl.bin', 'dat_file': 'sd_bl.dat',
+                                  'info_read_only_metadata': {'sd_size': 9000, 'bl_size': 5000}},
+        'application': {'bin_file': 'app.bin', 'dat_file': 'app.dat'},
+    }}
+
+    path = tmp_path / 'package.zip'
+    with zipfile.ZipFile(str(path), 'w') as archive:
+        archive.writestr('manifest.json', json.dumps(manifest))
+        archive.writestr('sd_bl.bin', sd_bl)
+        archive.writestr('sd_bl.dat', random_bytes(141, 5))
+        archive.writestr('app.bin', app)
+        archive.writestr('app.dat', random_bytes(141, 6))
+
+    return (str(path), [sd_bl, app])
+
+def make_world(profile, **config):
+    return SimWorld(SimConfig(secure=(profile == 'secure'), **config))
+
+# ------------------------------------------------------------------------------
+#  A controller of the engine and profile, connected to world through its
+#  simulated transport. attrs are set on the controller.
+# ------------------------------------------------------------------------------
+def make_session(engine, profile, world, firmware_path=None, datfile_path=None, mac=APP_MAC, **attrs):
+    if engine == 'sync':
+        transport = SimAttSocketTransport(mac, world=world)
+    else:
+        transport = sim_async_transport(world)(mac)
+
+    controller = CONTROLLERS[(engine, profile)](mac, firmware_path, datfile_path, transport)
+    for (name, value) in attrs.items():
+        setattr(controller, name, value)
+
+    return controller
+
+# ------------------------------------------------------------------------------
+#  Run a whole update, the way dfu.py does for the sync engine
+# ------------------------------------------------------------------------------
+def run_update(controller, timeout=60):
+    if hasattr(controller, 'update'):
+        asyncio.run(controller.run(timeout))
+        return
+
+    controller.input_setup()
+
+    try:
+        if controller.resume_interrupted():
+            pass
+        elif controller.scan_and_connect():
+            if not controller.check_DFU_mode():
+                assert controller.switch_to_dfu_mode()
+        else:
+            controller.target_mac_increase(1)
+            assert controller.scan_and_connect()
+
+        controller.start()
+    finally:
+        controller.disconnect()
@@ -0,0 +1,193 @@
+#------------------------------------------------------------------------------
+# gatttool backend: output parsing, data packet writes and process pooling
+#------------------------------------------------------------------------------
+
+import errno
+import io
+import os
+import sys
+import time
+
+import pytest
+
+import transport
+from transport import GatttoolPool, GatttoolReader, GatttoolTransport, Notification, advance_parts, parse_notification
+
+MAC = 'CD:E3:4A:47:1C:E5'
+
+# A "gatttool" that echoes its input and, when told "done", notifies the
+# number of lines it read before
+ECHO_SCRIPT = """
+import sys
+count = 0
+for line in iter(sys.stdin.readline, ''):
+    if line.startswith('exit'):
+        break
+    if line.startswith('done'):
+        print('Notification handle = 0x0001 value: %02x %02x ' % (count >> 8, count & 0xff))
+    count += 1
+    sys.stdout.write(line)
+    sys.stdout.flush()
+"""
+
+@pytest.fixture
+def echo_command(tmp_path):
+    path = tmp_path / 'gatttool.py'
+    path.write_text(ECHO_SCRIPT)
+    return '%s %s' % (sys.executable, path)
+
+class FakeConn(object):
+    logfile_read = None
+
+def test_parse_notification():
+    assert parse_notification(b'Notification handle = 0x0019 value: 10 01 01 \r') == Notification(0x19, b'\x10\x01\x01')
+    assert parse_notification(b'[CON][CD:E3:4A:47:1C:E5][LE]> Notification handle = 0x000f value: 60 ') == Notification(0x0f, b'\x60')
+    assert parse_notification(b'Characteristic value was written successfully') is None
+    assert parse_notification(b'Notification handle = 0x0019') is None
+
+    # An echo written into the middle of the value
+    assert parse_notification(b'Notification handle = 0x0019 value: 10 0char-write-cmd 0x000e 00') is None
+
+def test_reader_splits_lines():
+    reader = GatttoolReader(FakeConn())
+
+    # A notification split over two reads, between echoes and prompts
+    reader.feed(b'char-write-cmd 0x000e 0102\n[CON][CD:E3:4A:47:1C:E5][LE]> Notification handle = 0x0019 val')
+    assert reader.pop_notification() is None
+
+    reader.feed(b'ue: 10 01 01 \nNotification handle = 0x000f value: 60 \nMTU was exchanged successfully: 247\n'
+                b'[CON][CD:E3:4A:47:1C:E5][LE]> ')
+
+    # Notifications for other handles stay queued
+    assert reader.pop_notification(0x0f) == Notification(0x0f, b'\x60')
+    assert reader.pop_notification(0x0f) is None
+    assert reader.pop_notification() == Notification(0x19, b'\x10\x01\x01')
+
+    # Only the command response is left for pexpect, the prompt waits for
+    # the rest of its line
+    assert list(reader.lines) == [b'MTU was exchanged successfully: 247\n']
+    assert reader.partial == b'[CON][CD:E3:4A:47:1C:E5][LE]> '
+    assert not reader.lost
+
+    reader.feed(b'\n[   ][CD:E3:4A:47:1C:E5][LE]> ')
+    assert reader.lost
+
+def test_reader_keeps_recent_lines():
+    conn = FakeConn()
+    conn.logfile_read = io.BytesIO()
+    reader = GatttoolReader(conn)
+
+    output = b''.join(b'line %d\n' % n for n in range(GatttoolReader.MAX_LINES + 10))
+    reader.feed(output)
+
+    assert conn.logfile_read.getvalue() == output
+    assert reader.lines[0] == b'line 10\n'
+    assert len(reader.lines) == GatttoolReader.MAX_LINES
+
+def test_advance_parts():
+    parts = [b'abc', b'de', b'\n']
+
+    assert advance_parts(parts, 0) == parts
+    assert [bytes(p) for p in advance_parts(parts, 1)] == [b'bc', b'de', b'\n']
+    assert advance_parts(parts, 3) == [b'de', b'\n']
+    assert [bytes(p) for p in advance_parts(parts, 4)] == [b'e', b'\n']
+    assert advance_parts(parts, 6) == []
+
+def test_dead_process_is_a_lost_link():
+    # A "gatttool" that exits at once
+    transport = GatttoolTransport(MAC, command='%s -c pass' % sys.executable)
+    while transport.ble_conn.isalive():
+        time.sleep(0.01)
+
+    start = time.time()
+    with pytest.raises(Exception, match='Connection Lost'):
+        transport.wait_for_notification(timeout=10)
+    assert time.time() - start < 5
+
+def test_partial_writes(echo_command, monkeypatch):
+    gatttool = GatttoolTransport(MAC, command=echo_command)
+    written = []
+    calls = []
+
+    # Every other call finds the pty full, the others take 7 bytes at most
+    def writev(fd, buffers):
+        calls.append(len(buffers))
+        if len(calls) % 2:
+            raise BlockingIOError(errno.EAGAIN, 'full')
+        data = b''.join(bytes(b) for b in buffers)[:7]
+        written.append(data)
+        return len(data)
+
+    monkeypatch.setattr(transport, 'IOV_MAX', 4)
+    monkeypatch.setattr(transport.os, 'writev', writev)
+
+    payload = gatttool.encode_payload(bytes(range(50)))
+    gatttool.write_cmd_burst(0x0e, payload, 0, 50, 20)
+    monkeypatch.undo()
+    gatttool.disconnect()
+
+    lines = [b'char-write-cmd 0x000e %s\n' % payload[2*i:2*min(i + 20, 50)] for i in range(0, 50, 20)]
+    assert b''.join(written) == b''.join(lines)
+    assert max(calls) == 4
+
+def test_burst_larger_than_the_pty(echo_command):
+    gatttool = GatttoolTransport(MAC, command=echo_command)
+
+    # The echo fills the pty's output long before the burst is written:
+    # it has to be drained for the process to read on
+    payload = gatttool.encode_payload(os.urandom(20000))
+    gatttool.write_cmd_burst(0x0e, payload, 0, 20000, 20)
+    gatttool.ble_conn.sendline('done')
+
+    notify = gatttool.wait_for_notification(timeout=10, handle=1)
+    gatttool.disconnect()
+
+    assert notify.value == b'\x03\xe8'
+
+def test_pool_reuses_processes(echo_command):
+    pool = GatttoolPool(command=echo_command, size=1)
+    pool.fill()
+    (first, fresh) = pool.acquire()
+    assert fresh
+
+    # The slot is taken: no process is started ahead
+    assert pool.idle[None] == []
+
+    pool.release(first)
+    assert pool.acquire() == (first, False)
+
+    pool.release(first)
+    pool.close()
+    assert not first.isalive()
+
+def test_pool_evicts_processes(echo_command):
+    pool = GatttoolPool(command=echo_command, size=1)
+    (first, _) = pool.acquire()
+    (second, fresh) = pool.acquire()
+    assert fresh and second is not first
+
+    # One process too many: the first given back is closed
+    pool.release(first)
+    assert not first.isalive()
+    pool.release(second)
+    assert pool.idle[None] == [(second, False)]
+
+    # A process that died while idle is replaced
+    second.terminate(force=True)
+    (third, fresh) = pool.acquire()
+    assert fresh and third is not second
+
+    pool.release(third)
+    pool.close()
+
+def test_transports_share_the_pool(echo_command):
+    pool = GatttoolPool(command=echo_command, size=1)
+
+    gatttool = GatttoolTransport(MAC, pool=pool)
+    conn = gatttool.ble_conn
+    gatttool.disconnect()
+
+    gatttool = GatttoolTransport(MAC, pool=pool)
+    assert gatttool.ble_conn is conn and gatttool.started
+    gatttool.disconnect()
+    pool.close()
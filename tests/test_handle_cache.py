@@ -0,0 +1,42 @@
+#------------------------------------------------------------------------------
+# Cached GATT handles across sessions
+#------------------------------------------------------------------------------
+
+import pytest
+
+from conftest import DFU_MAC, ENGINES, make_world, make_session, run_update
+from ble_legacy_dfu_controller import BleDfuControllerLegacy
+from handle_cache import HandleCache
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_secure_then_legacy_on_one_address(engine, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+    cache_path = str(tmp_path / 'handles.json')
+
+    # Same address, first running a secure bootloader, then a legacy one
+    for profile in ('secure', 'legacy'):
+        world = make_world(profile)
+        run_update(make_session(engine, profile, world, bin_path, dat_path, mac=DFU_MAC,
+                                handle_cache=HandleCache(cache_path)))
+        assert world.peer(DFU_MAC).flashed == [image]
+
+    cache = HandleCache(cache_path)
+    assert cache.modes(DFU_MAC, 'secure') == ['dfu']
+    assert cache.modes(DFU_MAC, 'legacy') == ['dfu']
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_incomplete_entry_is_discovered_again(engine, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+    cache_path = str(tmp_path / 'handles.json')
+
+    # An entry without the Packet characteristic
+    uuid = BleDfuControllerLegacy.UUID_CONTROL_POINT
+    HandleCache(cache_path).put(DFU_MAC, 'legacy', 'dfu', {uuid: (0x10, 0x11, 0x12)})
+
+    world = make_world('legacy')
+    run_update(make_session(engine, 'legacy', world, bin_path, dat_path, mac=DFU_MAC,
+                            handle_cache=HandleCache(cache_path)))
+
+    assert world.peer(DFU_MAC).flashed == [image]
+    assert sorted(HandleCache(cache_path).get(DFU_MAC, 'legacy', 'dfu')) == \
+        sorted(BleDfuControllerLegacy.MODE_UUIDS['dfu'])
@@ -0,0 +1,78 @@
+#------------------------------------------------------------------------------
+# Prepared images in memory and on disk
+#------------------------------------------------------------------------------
+
+import os
+
+import pytest
+
+from conftest import DFU_MAC, make_world, make_session, random_bytes, run_update
+from image_cache import ImageCache, PreparedImage
+from package import PackageImage
+from util import crc32_unsigned
+
+def package_image(size, seed):
+    return PackageImage('application', 'app.bin', random_bytes(size, seed), random_bytes(141, seed), {})
+
+def test_crc_of_any_prefix():
+    firmware = random_bytes(10000, 1)
+    image = PreparedImage.from_image(PackageImage('application', 'app.bin', firmware, b'', {}))
+
+    for offset in (5000, 244, 9999, 10000, 0, 4096):
+        assert image.crc(offset) == crc32_unsigned(firmware[:offset])
+
+def test_object_boundaries_of_the_selected_size():
+    image = PreparedImage.from_image(package_image(10000, 1))
+    image.prepare_objects(1024)
+
+    assert image.object_sizes == set([1024])
+    assert image.crc_offsets == [0] + list(range(1024, 10000, 1024)) + [10000]
+
+def test_memory_lru():
+    # Room for two images of 10000 bytes and their init packets
+    cache = ImageCache(None, 2 * 10141)
+    for n in range(3):
+        cache.prepared('image-%d' % n, lambda n=n: package_image(10000, n))
+
+        # Using the first image keeps it over the second
+        cache.get('image-0')
+
+    assert list(cache.images) == ['image-2', 'image-0']
+
+def test_disk_eviction_and_reload(tmp_path):
+    # Room for two entries: image, init packet and meta.json
+    path = str(tmp_path / 'images')
+    cache = ImageCache(path, 25000)
+
+    for n in range(3):
+        image = cache.prepared('image-%d' % n, lambda n=n: package_image(10000, n))
+        image.prepare_objects(4096)
+        cache.flush()
+
+        # Least recently used by modification time of the entry's meta.json
+        os.utime(os.path.join(path, 'image-%d' % n, 'meta.json'), (n, n))
+
+    assert sorted(os.listdir(path)) == ['image-1', 'image-2']
+
+    # A new cache, as in a later run, maps the entry and knows its CRCs
+    loaded = ImageCache(path).get('image-2')
+    assert bytes(loaded.firmware) == random_bytes(10000, 2)
+    assert loaded.object_sizes == set([4096])
+    assert 8192 in loaded.crcs
+    assert not loaded.dirty
+
+@pytest.mark.parametrize('engine', ('sync', 'async'))
+def test_session_keeps_object_crcs(engine, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+    cache = ImageCache(str(tmp_path / 'images'))
+
+    world = make_world('secure', max_object_size=2048)
+    run_update(make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC, image_cache=cache))
+    cache.flush()
+
+    assert world.peer(DFU_MAC).flashed == [image]
+
+    (key,) = os.listdir(str(tmp_path / 'images'))
+    loaded = ImageCache(str(tmp_path / 'images')).get(key)
+    assert loaded.object_sizes == set([2048])
+    assert all(offset in loaded.crcs for offset in range(2048, len(image), 2048))
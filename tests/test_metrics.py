@@ -0,0 +1,74 @@
+#------------------------------------------------------------------------------
+# Metrics of whole sessions
+#------------------------------------------------------------------------------
+
+import pytest
+
+from conftest import APP_MAC, DFU_MAC, ENGINES, make_world, make_session, run_update
+from journal import DfuJournal
+from metrics import MetricsSink, PrometheusSink
+from package import Package
+
+# ------------------------------------------------------------------------------
+#  Keeps the events of a session
+# ------------------------------------------------------------------------------
+class EventLog(MetricsSink):
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+def reconnects(sink, device):
+    return sink.values.get(('dfu_reconnects_total', (('device', device),)))
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_planned_connections_are_not_reconnects(engine, package_zip, tmp_path):
+    (path, images) = package_zip
+    world = make_world('secure', app_mac=APP_MAC)
+    sink = PrometheusSink(str(tmp_path / 'dfu.prom'))
+
+    # The switch to the bootloader and the connection for the second image
+    controller = make_session(engine, 'secure', world, package=Package(path))
+    controller.metrics.add_sink(sink)
+    run_update(controller)
+
+    assert world.peer(DFU_MAC).flashed == images
+    assert controller.metrics.connects == 3
+    assert reconnects(sink, APP_MAC) == 0
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_is_a_reconnect(engine, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+    world = make_world('secure', app_mac=APP_MAC, disconnect_after=9000)
+    journal = DfuJournal(str(tmp_path / 'journal.json'))
+    sink = PrometheusSink(str(tmp_path / 'dfu.prom'))
+
+    with pytest.raises(Exception):
+        run_update(make_session(engine, 'secure', world, bin_path, dat_path, journal=journal))
+
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, journal=journal)
+    controller.metrics.add_sink(sink)
+    run_update(controller)
+
+    assert world.peer(DFU_MAC).flashed == [image]
+    assert reconnects(sink, APP_MAC) == 1
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_phase_cpu_time_of_sync_sessions_only(engine, firmware):
+    (bin_path, dat_path, image) = firmware
+    world = make_world('secure')
+    log = EventLog()
+
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC)
+    controller.metrics.add_sink(log)
+    run_update(controller)
+
+    # Async sessions share the event loop thread, its CPU time is no one's
+    cpu = [event['cpu'] for event in log.events if event['event'] == 'phase_end']
+    assert cpu
+    if engine == 'sync':
+        assert all(value >= 0 for value in cpu)
+    else:
+        assert all(value is None for value in cpu)
@@ -0,0 +1,50 @@
+#------------------------------------------------------------------------------
+# Reading DFU zip packages
+#------------------------------------------------------------------------------
+
+import json
+import zipfile
+
+import pytest
+
+from package import Package
+
+def write_zip(path, files):
+    with zipfile.ZipFile(str(path), 'w') as archive:
+        for (name, data) in files.items():
+            archive.writestr(name, data)
+    return str(path)
+
+def test_images_in_transfer_order(package_zip):
+    (path, images) = package_zip
+    package = Package(path)
+
+    assert list(package.images) == ['softdevice_bootloader', 'application']
+    assert [image.firmware for image in package.images.values()] == images
+    assert package.images['softdevice_bootloader'].info == {'sd_size': 9000, 'bl_size': 5000}
+    assert package.images['application'].bin_file == 'app.bin'
+
+def test_digest_follows_the_contents(package_zip, tmp_path):
+    (path, images) = package_zip
+    other = write_zip(tmp_path / 'other.zip', {'app.bin': b'\x01' * 16, 'app.dat': b'\x02' * 8})
+
+    assert Package(path).digest == Package(path).digest
+    assert Package(path).digest != Package(other).digest
+
+def test_without_manifest(tmp_path):
+    path = write_zip(tmp_path / 'legacy.zip', {'app.bin': b'\x01' * 16, 'app.dat': b'\x02' * 8})
+    package = Package(path)
+
+    (image,) = package.images.values()
+    assert (image.type, image.firmware, image.init_packet) == ('application', b'\x01' * 16, b'\x02' * 8)
+
+def test_manifest_names_a_missing_file(tmp_path):
+    manifest = {'manifest': {'application': {'bin_file': 'app.bin', 'dat_file': 'app.dat'}}}
+    path = write_zip(tmp_path / 'broken.zip', {'manifest.json': json.dumps(manifest), 'app.bin': b'\x01'})
+
+    with pytest.raises(Exception, match='app.dat'):
+        Package(path)
+
+def test_missing_file(tmp_path):
+    with pytest.raises(Exception):
+        Package(str(tmp_path / 'missing.zip'))
@@ -0,0 +1,85 @@
+#------------------------------------------------------------------------------
+# The sync and the async engine drive the bootloader the same way
+#
+# Each scenario runs on both engines against its own simulated world. The
+# writes the peers receive, other than data packets, must be the same
+# requests in the same order, and so must the data bytes each peer received.
+#------------------------------------------------------------------------------
+
+import pytest
+
+from conftest import APP_MAC, DFU_MAC, PROFILES, make_world, make_session, run_update
+from dfu_sim import SimPeer
+from journal import DfuJournal
+from package import Package
+
+# ------------------------------------------------------------------------------
+#  Records what the simulated peers are sent, across sessions
+# ------------------------------------------------------------------------------
+class WriteLog(object):
+
+    def __init__(self, monkeypatch):
+        self.requests = []
+        self.data_bytes = {}
+
+        write = SimPeer.write
+        log = self
+
+        def record(peer, handle, value):
+            if handle == peer.data_value_handle():
+                log.data_bytes[peer.mac] = log.data_bytes.get(peer.mac, 0) + len(value)
+            else:
+                log.requests.append((peer.mac, handle, bytes(bytearray(value))))
+            return write(peer, handle, value)
+
+        monkeypatch.setattr(SimPeer, 'write', record)
+
+def run_on_both_engines(monkeypatch, scenario):
+    logs = []
+    for engine in ('sync', 'async'):
+        with monkeypatch.context() as patch:
+            log = WriteLog(patch)
+            scenario(engine)
+            logs.append(log)
+
+    (sync, asynchronous) = logs
+    assert sync.requests == asynchronous.requests
+    assert sync.data_bytes == asynchronous.data_bytes
+
+@pytest.mark.parametrize('profile', PROFILES)
+def test_switch_and_transfer(profile, firmware, monkeypatch):
+    (bin_path, dat_path, image) = firmware
+
+    def scenario(engine):
+        world = make_world(profile, app_mac=APP_MAC)
+        run_update(make_session(engine, profile, world, bin_path, dat_path, pkt_receipt_interval=6))
+        assert [image] in [peer.flashed for peer in world.peers.values()]
+
+    run_on_both_engines(monkeypatch, scenario)
+
+@pytest.mark.parametrize('profile', PROFILES)
+def test_multi_image_package(profile, package_zip, monkeypatch):
+    (path, images) = package_zip
+
+    def scenario(engine):
+        world = make_world(profile)
+        run_update(make_session(engine, profile, world, mac=DFU_MAC, package=Package(path)))
+        assert world.peer(DFU_MAC).flashed == images
+
+    run_on_both_engines(monkeypatch, scenario)
+
+@pytest.mark.parametrize('disconnect_after', (9000, 141 + 2 * 4096 + 1))
+def test_journal_resume(disconnect_after, firmware, tmp_path, monkeypatch):
+    (bin_path, dat_path, image) = firmware
+
+    def scenario(engine):
+        world = make_world('secure', app_mac=APP_MAC, disconnect_after=disconnect_after)
+        journal = DfuJournal(str(tmp_path / ('%s.json' % engine)))
+
+        with pytest.raises(Exception):
+            run_update(make_session(engine, 'secure', world, bin_path, dat_path, journal=journal))
+        run_update(make_session(engine, 'secure', world, bin_path, dat_path, journal=journal))
+
+        assert world.peer(DFU_MAC).flashed == [image]
+
+    run_on_both_engines(monkeypatch, scenario)
@@ -0,0 +1,240 @@
+#------------------------------------------------------------------------------
+# Whole DFU sessions against the simulated peer, on both engines
+#------------------------------------------------------------------------------
+
+import functools
+import struct
+
+import pytest
+
+import ble_secure_dfu_controller
+from conftest import APP_MAC, DFU_MAC, ENGINES, PROFILES, make_world, make_session, run_update
+from dfu_sim import SimPeer
+from journal import DfuJournal
+from metrics import MetricsSink
+from package import Package
+from prn import AdaptivePrn
+from retry import RetryPolicy
+
+# ------------------------------------------------------------------------------
+#  Records the reasons of the retransmit events of a session
+# ------------------------------------------------------------------------------
+class RetransmitCounter(MetricsSink):
+
+    def __init__(self):
+        self.reasons = []
+
+    def emit(self, event):
+        if event['event'] == 'retransmit':
+            self.reasons.append(event['reason'])
+
+# ------------------------------------------------------------------------------
+#  The simulator answers at once: a receipt missing for a second is lost
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def fast_retry(monkeypatch):
+    policy = functools.partial(RetryPolicy, receipt_timeout=1.0, min_receipt_timeout=0.2)
+    monkeypatch.setattr(ble_secure_dfu_controller, 'RetryPolicy', policy)
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('profile', PROFILES)
+def test_full_transfer(engine, profile, firmware):
+    (bin_path, dat_path, image) = firmware
+    world = make_world(profile)
+
+    run_update(make_session(engine, profile, world, bin_path, dat_path, mac=DFU_MAC))
+
+    assert world.peer(DFU_MAC).flashed == [image]
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('profile', PROFILES)
+def test_switch_from_application(engine, profile, firmware):
+    (bin_path, dat_path, image) = firmware
+    world = make_world(profile, app_mac=APP_MAC)
+
+    controller = make_session(engine, profile, world, bin_path, dat_path)
+    run_update(controller)
+
+    # Secure bootloaders advertise at the next address, legacy ones at the
+    # application's
+    mac = DFU_MAC if profile == 'secure' else APP_MAC
+    assert controller.target_mac == mac
+    assert world.peer(mac).flashed == [image]
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_retransmit_lost_packets(engine, firmware, fast_retry):
+    (bin_path, dat_path, image) = firmware
+
+    world = make_world('secure', loss=0.05, seed=7)
+
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC,
+                              pkt_receipt_interval=8, object_retries=20)
+    counter = RetransmitCounter()
+    controller.metrics.add_sink(counter)
+    run_update(controller)
+
+    assert counter.reasons
+    assert world.peer(DFU_MAC).flashed == [image]
+
+# ------------------------------------------------------------------------------
+#  Up to three receipts in flight. The interval does not divide the object:
+#  the last window of each object is short and has no receipt.
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('profile', PROFILES)
+def test_receipt_window(engine, profile, firmware):
+    (bin_path, dat_path, image) = firmware
+    world = make_world(profile)
+
+    run_update(make_session(engine, profile, world, bin_path, dat_path, mac=DFU_MAC,
+                            pkt_receipt_interval=5, pkt_receipt_window=3))
+
+    assert world.peer(DFU_MAC).flashed == [image]
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_receipt_window_with_loss(engine, firmware, fast_retry):
+    (bin_path, dat_path, image) = firmware
+    world = make_world('secure', loss=0.05, seed=7)
+
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC,
+                              pkt_receipt_interval=4, pkt_receipt_window=3, object_retries=20)
+    counter = RetransmitCounter()
+    controller.metrics.add_sink(counter)
+    run_update(controller)
+
+    assert 'receipt' in counter.reasons
+    assert world.peer(DFU_MAC).flashed == [image]
+
+# ------------------------------------------------------------------------------
+#  The adaptive interval is set at object boundaries, before the next
+#  object is created; a failed object has it set in the resync, before
+#  CALC_CHECKSUM.
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize('engine', ENGINES)
+def test_adaptive_prn_with_loss(engine, firmware, fast_retry, monkeypatch):
+    (bin_path, dat_path, image) = firmware
+
+    # Control point writes: (opcode, parameters, executed data)
+    commands = []
+    write = SimPeer.write
+    def record(peer, handle, value):
+        if handle == peer.CTRLPT:
+            commands.append((value[0], bytes(value[1:]), peer.data_executed))
+        return write(peer, handle, value)
+    monkeypatch.setattr(SimPeer, 'write', record)
+
+    # Receipt times in the simulator are scheduling noise: none is late, and
+    # an object without errors doubles the interval
+    monkeypatch.setattr(ble_secure_dfu_controller, 'AdaptivePrn', functools.partial(AdaptivePrn, late_factor=float('inf')))
+
+    world = make_world('secure', loss=0.05, seed=7)
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC,
+                              pkt_receipt_interval=4, adaptive_prn=True, object_retries=20)
+    counter = RetransmitCounter()
+    controller.metrics.add_sink(counter)
+    run_update(controller)
+
+    peer = world.peer(DFU_MAC)
+    retuned = [(executed, struct.unpack('<H', params)[0])
+               for ((opcode, params, executed), (next_opcode, next_params, _)) in zip(commands, commands[1:])
+               if opcode == peer.SET_PRN and next_opcode == peer.CREATE and next_params[0] == peer.DATA]
+
+    assert counter.reasons
+    assert retuned
+    assert all(0 < executed < len(image) and executed % 4096 == 0 for (executed, _) in retuned)
+    assert all(1 <= interval <= 64 for (_, interval) in retuned)
+    assert max(interval for (_, interval) in retuned) > 4
+    assert peer.flashed == [image]
+
+# ------------------------------------------------------------------------------
+#  One segment of the 141 byte init packet is lost, at the default ATT MTU
+#  the eighth segment is its last byte. A lost middle segment leaves data
+#  the peer has to drop, a lost last one is sent on its own.
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize(('lost', 'interval'), ((3, 10), (7, 10), (2, 3)))
+def test_lost_init_segment(engine, lost, interval, firmware, fast_retry, monkeypatch):
+    (bin_path, dat_path, image) = firmware
+
+    write = SimPeer.write
+    segments = []
+    def lossy(peer, handle, value):
+        if handle == peer.data_value_handle() and peer.current == peer.COMMAND:
+            segments.append(bytes(value))
+            if len(segments) == lost + 1:
+                return []
+        return write(peer, handle, value)
+    monkeypatch.setattr(SimPeer, 'write', lossy)
+
+    world = make_world('secure', mtu=23)
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC,
+                              max_att_mtu=23, pkt_receipt_interval=interval)
+    counter = RetransmitCounter()
+    controller.metrics.add_sink(counter)
+    run_update(controller)
+
+    assert counter.reasons == ['init']
+    assert world.peer(DFU_MAC).flashed == [image]
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_from_journal(engine, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+    world = make_world('secure', app_mac=APP_MAC, disconnect_after=9000)
+    journal_path = str(tmp_path / 'journal.json')
+
+    with pytest.raises(Exception):
+        run_update(make_session(engine, 'secure', world, bin_path, dat_path, journal=DfuJournal(journal_path)))
+
+    journal = DfuJournal(journal_path)
+    assert [entry['address'] for entry in journal.entries.values()] == [DFU_MAC]
+
+    # The device is in its bootloader now, only the journal knows where
+    controller = make_session(engine, 'secure', world, bin_path, dat_path, journal=journal)
+    run_update(controller)
+
+    assert controller.target_mac == DFU_MAC
+    assert world.peer(DFU_MAC).flashed == [image]
+    assert DfuJournal(journal_path).entries == {}
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('journaled', (True, False))
+def test_resume_at_object_boundary(engine, journaled, firmware, tmp_path):
+    (bin_path, dat_path, image) = firmware
+
+    # The link drops with the first packet after the second object was
+    # executed (the init packet goes over the data characteristic too)
+    world = make_world('secure', disconnect_after=141 + 2 * 4096 + 1)
+    journal = DfuJournal(str(tmp_path / 'journal.json')) if journaled else None
+
+    with pytest.raises(Exception):
+        run_update(make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC, journal=journal))
+
+    # Record the bootloader's answers to EXECUTE on resume
+    peer = world.peer(DFU_MAC)
+    results = []
+    respond = peer.respond
+    def record(opcode, result, *args, **kwargs):
+        if opcode == peer.EXECUTE:
+            results.append(result)
+        return respond(opcode, result, *args, **kwargs)
+    peer.respond = record
+
+    run_update(make_session(engine, 'secure', world, bin_path, dat_path, mac=DFU_MAC, journal=journal))
+
+    assert peer.flashed == [image]
+    if journaled:
+        # Nothing is executed twice: init packet and the three objects left
+        assert results == [peer.SUCCESS] * 4
+    else:
+        # Without a journal, the bootloader tells the object was executed
+        assert results.count(peer.OPERATION_NOT_PERMITTED) == 1
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('profile', PROFILES)
+def test_multi_image_package(engine, profile, package_zip):
+    (path, images) = package_zip
+    world = make_world(profile)
+
+    run_update(make_session(engine, profile, world, mac=DFU_MAC, package=Package(path)))
+
+    assert world.peer(DFU_MAC).flashed == images
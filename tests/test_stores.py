@@ -0,0 +1,46 @@
+#------------------------------------------------------------------------------
+# Files written whole: atomic_write and the JSON stores built on it
+#------------------------------------------------------------------------------
+
+import json
+import os
+import threading
+
+from handle_cache import HandleCache
+from journal import DfuJournal
+from util import atomic_write
+
+def test_concurrent_writers_leave_one_whole_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    contents = [json.dumps({'writer': n, 'pad': 'x' * 65536}).encode('utf-8') for n in range(8)]
+
+    def write(data):
+        for _ in range(20):
+            atomic_write(path, data)
+
+    threads = [threading.Thread(target=write, args=(data,)) for data in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path, 'rb') as f:
+        assert f.read() in contents
+    assert os.listdir(str(tmp_path)) == ['state.json']
+
+def test_stores_round_trip(tmp_path):
+    journal = DfuJournal(str(tmp_path / 'journal' / 'dfu.json'))
+    journal.update('aa:bb:cc:dd:ee:ff', 'digest', offset=4096)
+    assert DfuJournal(journal.path).get('AA:BB:CC:DD:EE:FF', 'digest')['offset'] == 4096
+
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    cache.put('AA:BB:CC:DD:EE:FF', 'secure', 'dfu', {'uuid': (1, 2, 3)})
+    assert HandleCache(cache.path).get('AA:BB:CC:DD:EE:FF', 'secure', 'dfu') == {'uuid': (1, 2, 3)}
+
+def test_corrupt_store_is_ignored(tmp_path, capsys):
+    path = tmp_path / 'journal.json'
+    path.write_text(u'{"truncated": ')
+
+    journal = DfuJournal(str(path))
+    assert journal.entries == {}
+    assert 'Ignoring corrupt journal' in capsys.readouterr().out
@@ -0,0 +1,942 @@
+#------------------------------------------------------------------------------
+# BLE transports used by the DFU controllers
+#
+#   GatttoolTransport:  drives "gatttool --interactive" through pexpect
+#   GatttoolPool:       warm gatttool processes shared by transports
+#   AttSocketTransport: speaks ATT directly over an L2CAP LE socket (CID 4)
+#------------------------------------------------------------------------------
+
+import binascii
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import re
+import select
+import socket
+import struct
+import threading
+import time
+
+import pexpect
+
+from abc import ABCMeta, abstractmethod
+from adapters import adapter_address
+
+verbose = False
+
+# A GATT characteristic declaration
+Characteristic = collections.namedtuple('Characteristic', 'handle properties value_handle uuid')
+
+# A notification (or indication) received from the peer
+Notification = collections.namedtuple('Notification', 'handle value')
+
+BLUETOOTH_BASE_UUID = '0000%04x-0000-1000-8000-00805f9b34fb'
+
+#------------------------------------------------------------------------------
+# Data to write as a buffer: a view of it if it is one already (bytes,
+# array, mmap, memoryview), otherwise a copy
+#------------------------------------------------------------------------------
+def as_buffer(data):
+    try:
+        return memoryview(data)
+    except TypeError:
+        return bytearray(data)
+
+# Buffers one writev() takes at most
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 16
+
+#------------------------------------------------------------------------------
+# The buffers of parts left after written bytes of them were written
+#------------------------------------------------------------------------------
+def advance_parts(parts, written):
+    i = 0
+    while i < len(parts) and written >= len(parts[i]):
+        written -= len(parts[i])
+        i += 1
+
+    if i < len(parts) and written:
+        return [memoryview(parts[i])[written:]] + list(parts[i + 1:])
+
+    return list(parts[i:])
+
+#------------------------------------------------------------------------------
+# Transport interface
+#------------------------------------------------------------------------------
+class BleTransport(object):
+    __metaclass__ = ABCMeta
+
+    # --------------------------------------------------------------------------
+    #  adapter: local HCI adapter name (hci0, hci1, ...), None for the default
+    # --------------------------------------------------------------------------
+    def __init__(self, target_mac, adapter=None):
+        self.target_mac = target_mac
+        self.adapter = adapter
+
+    # --------------------------------------------------------------------------
+    #  Connect to the target. Returns True if a connection was established.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def connect(self, timeout=30):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Disconnect from the target and release the transport
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def disconnect(self):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Change the address used by the next connect()
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def set_target(self, target_mac):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Discover characteristics. Returns a list of Characteristic.
+    #  If uuids is given, discovery may stop as soon as all of them are found.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def discover(self, uuids=None, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Exchange the ATT MTU. Returns the MTU in effect for the connection.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def exchange_mtu(self, mtu, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Write without response
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_cmd(self, handle, data):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Write with response. Returns True if the write was acknowledged.
+    #  With wait=False the request is sent without waiting for the response.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_req(self, handle, data, wait=True, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Read a characteristic value by UUID. Returns the value or None.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def read_by_uuid(self, uuid, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Wait for the next notification, for handle if given; those for other
+    #  handles stay queued. Returns a Notification, or None on timeout.
+    #  Raises an exception if the link was lost.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def wait_for_notification(self, timeout=30, handle=None):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Convert a payload once into the form consumed by write_cmd_slice().
+    #  payload_encoding names the form, encoded payloads are cached by it.
+    # --------------------------------------------------------------------------
+    payload_encoding = 'raw'
+
+    def encode_payload(self, data):
+        return as_buffer(data)
+
+    # --------------------------------------------------------------------------
+    #  Write num_bytes of an encoded payload, starting at offset. The packet
+    #  is a view into the payload, not a copy.
+    # --------------------------------------------------------------------------
+    def write_cmd_slice(self, handle, payload, offset, num_bytes):
+        self.write_cmd(handle, memoryview(payload)[offset:offset + num_bytes])
+
+    # --------------------------------------------------------------------------
+    #  Write the bytes from offset to end of an encoded payload as packets of
+    #  packet_size bytes, e.g. a window of packets between two receipts
+    # --------------------------------------------------------------------------
+    def write_cmd_burst(self, handle, payload, offset, end, packet_size):
+        for i in range(offset, end, packet_size):
+            self.write_cmd_slice(handle, payload, i, min(packet_size, end - i))
+
+#------------------------------------------------------------------------------
+# Pool of idle "gatttool --interactive" processes, per adapter
+#
+# Starting gatttool costs a process and its adapter setup on every
+# connection. An interactive gatttool connects to whatever address its
+# "connect <address>" command names, so one process can serve any number of
+# devices: transports take a process from the pool and give it back when
+# they disconnect. The pool keeps up to size processes per adapter, busy or
+# idle, and starts them ahead of demand.
+#------------------------------------------------------------------------------
+class GatttoolPool(object):
+
+    def __init__(self, command='gatttool', size=4):
+        self.command = command
+        self.size = size
+        self.idle = {}
+        self.busy = {}
+        self.lock = threading.Lock()
+
+    def _spawn(self, adapter):
+        cmd = "%s -t random --interactive" % self.command
+        if adapter:
+            cmd += " -i %s" % adapter
+
+        return pexpect.spawn(cmd)
+
+    # --------------------------------------------------------------------------
+    #  Start processes until the adapter has size of them
+    # --------------------------------------------------------------------------
+    def fill(self, adapter=None):
+        with self.lock:
+            missing = self.size - len(self.idle.setdefault(adapter, [])) - self.busy.get(adapter, 0)
+
+        for _ in range(missing):
+            conn = self._spawn(adapter)
+            with self.lock:
+                self.idle[adapter].append((conn, True))
+
+    # --------------------------------------------------------------------------
+    #  Take a process for the adapter. Returns (process, fresh): a fresh
+    #  process has not been seen to print its first prompt yet. Output a
+    #  reused process printed while idle is discarded.
+    # --------------------------------------------------------------------------
+    def acquire(self, adapter=None):
+        conn = None
+
+        with self.lock:
+            self.busy[adapter] = self.busy.get(adapter, 0) + 1
+            idle = self.idle.setdefault(adapter, [])
+            while idle and conn is None:
+                (conn, fresh) = idle.pop(0)
+                if not conn.isalive():
+                    conn.close(force=True)
+                    conn = None
+
+        if conn is None:
+            (conn, fresh) = (self._spawn(adapter), True)
+
+        if not fresh:
+            try:
+                while True:
+                    conn.read_nonblocking(65536, timeout=0)
+            except (pexpect.TIMEOUT, pexpect.EOF):
+                pass
+
+        # Have the next one started while this one is in use
+        self.fill(adapter)
+        return (conn, fresh)
+
+    # --------------------------------------------------------------------------
+    #  Give a process back, disconnecting whatever it is connected to
+    # --------------------------------------------------------------------------
+    def release(self, conn, adapter=None):
+        with self.lock:
+            self.busy[adapter] -= 1
+
+        if not conn.isalive():
+            conn.close(force=True)
+            return
+
+        conn.sendline('disconnect')
+
+        with self.lock:
+            idle = self.idle.setdefault(adapter, [])
+            if len(idle) + self.busy[adapter] < self.size:
+                idle.append((conn, False))
+                return
+
+        conn.sendline('exit')
+        conn.close(force=True)
+
+    def close(self):
+        with self.lock:
+            idle = [conn for conns in self.idle.values() for (conn, _) in conns]
+            self.idle = {}
+
+        for conn in idle:
+            if conn.isalive():
+                conn.sendline('exit')
+            conn.close(force=True)
+
+#------------------------------------------------------------------------------
+# gatttool backend
+#------------------------------------------------------------------------------
+
+# Echo of data packet commands and the prompts of a connected gatttool: the
+# bulk of its output while an image is streamed, and of no use
+GATTTOOL_ECHO = re.compile(br'char-write-cmd 0x[0-9a-f]{4} [0-9a-f]*\r?\n?|\[CON\]\[[0-9A-Fa-f:]{17}\]\[LE\]> ')
+
+NOTIFICATION_PREFIX = b'Notification handle = '
+NOTIFICATION_VALUE = b'value: '
+
+#------------------------------------------------------------------------------
+# The Notification of a line of gatttool output, or None if the line is not
+# one. Example: "Notification handle = 0x0019 value: 10 01 01 "
+#------------------------------------------------------------------------------
+def parse_notification(line):
+    start = line.find(NOTIFICATION_PREFIX)
+    if start < 0:
+        return None
+
+    start += len(NOTIFICATION_PREFIX)
+    value = line.find(NOTIFICATION_VALUE, start)
+    if value < 0:
+        return None
+
+    try:
+        handle = int(line[start:value], 16)
+        return Notification(handle, bytes.fromhex(line[value + len(NOTIFICATION_VALUE):].decode('ascii')))
+    except ValueError:
+        # Garbled, e.g. by an echo written into the middle of it
+        return None
+
+#------------------------------------------------------------------------------
+# Line reader for the output of a gatttool process
+#
+# Reads what gatttool printed without blocking and splits it into lines.
+# Notification lines are decoded into Notifications and queued, the echo of
+# data packets and the prompts are dropped, and the remaining lines are kept
+# for pexpect, which matches command responses in them. Each chunk of output
+# is looked at once, so a notification costs the same however much output
+# came before it.
+#------------------------------------------------------------------------------
+class GatttoolReader(object):
+
+    # Lines kept for pexpect at most, the most recent ones
+    MAX_LINES = 256
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.reset()
+
+    # --------------------------------------------------------------------------
+    #  Forget all output, e.g. that of a previous connection
+    # --------------------------------------------------------------------------
+    def reset(self):
+        self.partial = b''
+        self.lines = collections.deque(maxlen=self.MAX_LINES)
+        self.notifications = collections.deque()
+        self.lost = False
+
+    def feed(self, data):
+        if self.conn.logfile_read is not None:
+            self.conn.logfile_read.write(data)
+
+        data = self.partial + data
+        lines = data.split(b'\n')
+
+        # Prompts are not newline terminated: the last piece waits for the
+        # rest of its line
+        self.partial = lines.pop()
+
+        for line in lines:
+            notify = parse_notification(line)
+            if notify is not None:
+                self.notifications.append(notify)
+                continue
+
+            line = GATTTOOL_ECHO.sub(b'', line)
+            if line.strip():
+                self.lines.append(line + b'\n')
+
+        # gatttool does not report link loss, its prompt goes from '[CON]'
+        # to '[   ]'
+        if b'[   ]' in data:
+            self.lost = True
+
+    # --------------------------------------------------------------------------
+    #  Read the output waiting in the pty, up to timeout for some to arrive.
+    #  Returns False if there was none.
+    # --------------------------------------------------------------------------
+    def read(self, timeout=0):
+        # Output pexpect read ahead of a command response comes first
+        if self.conn.buffer:
+            (data, self.conn.buffer) = (self.conn.buffer, b'')
+            self.feed(data)
+            timeout = 0
+
+        (readable, _, _) = select.select([self.conn.child_fd], [], [], timeout)
+        if not readable:
+            return False
+
+        try:
+            data = os.read(self.conn.child_fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            data = b''
+
+        if not data:
+            # gatttool exited
+            self.lost = True
+            return True
+
+        self.feed(data)
+        return True
+
+    # --------------------------------------------------------------------------
+    #  The first queued notification for handle (None: any handle), or None.
+    #  Notifications for other handles stay queued.
+    # --------------------------------------------------------------------------
+    def pop_notification(self, handle=None):
+        if handle is None:
+            return self.notifications.popleft() if self.notifications else None
+
+        for notify in self.notifications:
+            if notify.handle == handle:
+                self.notifications.remove(notify)
+                return notify
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Hand the lines kept and the unfinished one back to pexpect, before it
+    #  looks for a command response
+    # --------------------------------------------------------------------------
+    def release(self):
+        self.conn.buffer = b''.join(self.lines) + self.partial + self.conn.buffer
+        self.lines.clear()
+        self.partial = b''
+
+class GatttoolTransport(BleTransport):
+
+    # --------------------------------------------------------------------------
+    #  command: the gatttool executable, or a stand-in such as dfu_sim.py
+    #  pool:    GatttoolPool to take the gatttool process from
+    # --------------------------------------------------------------------------
+    def __init__(self, target_mac, adapter=None, command='gatttool', pool=None):
+        BleTransport.__init__(self, target_mac, adapter)
+        self.command = command
+        self.pool = pool
+        self.cmd_prefix = {}
+
+        # Held while reading gatttool's output: by a wait for a
+        # notification, a write draining the output, or expect()
+        self.read_lock = threading.Lock()
+
+        self._spawn()
+
+    def _spawn(self):
+        if self.pool is not None:
+            (self.ble_conn, fresh) = self.pool.acquire(self.adapter)
+        else:
+            cmd = "%s -b '%s' -t random --interactive" % (self.command, self.target_mac)
+            if self.adapter:
+                cmd += " -i %s" % self.adapter
+
+            (self.ble_conn, fresh) = (pexpect.spawn(cmd), True)
+
+        self.ble_conn.delaybeforesend = 0
+        self.reader = GatttoolReader(self.ble_conn)
+        self.started = not fresh
+
+    # --------------------------------------------------------------------------
+    #  expect() on the output the reader has not consumed
+    # --------------------------------------------------------------------------
+    def _expect(self, pattern, timeout):
+        with self.read_lock:
+            self.reader.release()
+            return self.ble_conn.expect(pattern, timeout=timeout)
+
+    def connect(self, timeout=30):
+        if self.ble_conn is None:
+            self._spawn()
+
+        # gatttool accepts commands once it shows its first prompt
+        if not self.started:
+            try:
+                self._expect(r'\[LE\]>', timeout=timeout)
+            except pexpect.TIMEOUT:
+                return False
+            self.started = True
+
+        self.ble_conn.sendline('connect %s' % self.target_mac)
+
+        try:
+            self._expect('Connection successful', timeout=timeout)
+        except pexpect.TIMEOUT:
+            return False
+
+        self.reader.reset()
+        return True
+
+    def disconnect(self):
+        if self.ble_conn is None:
+            return
+
+        if self.pool is not None:
+            self.pool.release(self.ble_conn, self.adapter)
+        else:
+            self.ble_conn.sendline('exit')
+            self.ble_conn.close()
+        self.ble_conn = None
+
+    def set_target(self, target_mac):
+        self.target_mac = target_mac
+
+        # The process stays, the next connect names the new address
+        if self.ble_conn is not None:
+            self.ble_conn.sendline('disconnect')
+
+    def discover(self, uuids=None, timeout=10):
+        self.ble_conn.sendline('characteristics')
+
+        pattern = 'handle: (0x[0-9a-f]{4}), char properties: (0x[0-9a-f]{2}), char value handle: (0x[0-9a-f]{4}), uuid: ([0-9a-f-]{36})'
+        pending = set(uuids or [])
+        chars = []
+        deadline = time.time() + timeout
+
+        # gatttool does not mark the end of the listing, so stop when all
+        # requested UUIDs were seen or the output has been quiet for a while.
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                self._expect(pattern, timeout=min(remaining, 0.5) if chars else remaining)
+            except pexpect.TIMEOUT:
+                break
+
+            (handle, properties, value_handle, uuid) = [m.decode('utf-8') for m in self.ble_conn.match.groups()]
+            chars.append(Characteristic(int(handle, 16), int(properties, 16), int(value_handle, 16), uuid))
+
+            pending.discard(uuid)
+            if uuids and not pending:
+                break
+
+        return chars
+
+    def exchange_mtu(self, mtu, timeout=10):
+        self.ble_conn.sendline('mtu %d' % mtu)
+
+        try:
+            index = self._expect(['MTU was exchanged successfully: ([0-9]+)', 'Error: '], timeout=timeout)
+        except pexpect.TIMEOUT:
+            return Att.DEFAULT_MTU
+
+        if index != 0:
+            return Att.DEFAULT_MTU
+
+        return int(self.ble_conn.match.group(1))
+
+    def write_cmd(self, handle, data):
+        cmd = 'char-write-cmd 0x%04x %s' % (handle, binascii.hexlify(bytearray(data)).decode('ascii'))
+
+        if verbose: print(cmd)
+
+        self.ble_conn.sendline(cmd)
+
+    def write_req(self, handle, data, wait=True, timeout=10):
+        cmd = 'char-write-req 0x%04x %s' % (handle, binascii.hexlify(bytearray(data)).decode('ascii'))
+
+        if verbose: print(cmd)
+
+        self.ble_conn.sendline(cmd)
+
+        if not wait:
+            return True
+
+        # Verify that command was successfully written
+        try:
+            index = self._expect(['Characteristic value was written successfully', 'Error: '], timeout=timeout)
+        except pexpect.TIMEOUT:
+            return False
+
+        return index == 0
+
+    def read_by_uuid(self, uuid, timeout=10):
+        cmd = 'char-read-uuid %s' % uuid
+
+        if verbose: print(cmd)
+
+        self.ble_conn.sendline(cmd)
+
+        try:
+            index = self._expect([r'handle: 0x[0-9a-f]{4}\s+value: ([0-9a-f ]+)', 'Error: '], timeout=timeout)
+        except pexpect.TIMEOUT:
+            return None
+
+        if index != 0:
+            return None
+
+        return bytearray(binascii.unhexlify(self.ble_conn.match.group(1).replace(b' ', b'')))
+
+    def wait_for_notification(self, timeout=30, handle=None):
+        if self.ble_conn is None:
+            raise Exception('Connection Lost')
+
+        deadline = time.time() + timeout
+
+        with self.read_lock:
+            while True:
+                notify = self.reader.pop_notification(handle)
+                if notify is not None:
+                    return notify
+
+                # Checked after the queue, so notifications sent just before
+                # the link (or the gatttool process) went are not lost
+                if self.reader.lost or not self.ble_conn.isalive():
+                    print('Connection lost! ')
+                    raise Exception('Connection Lost')
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                self.reader.read(remaining)
+
+            # gatttool shows a lost link only in a fresh prompt: have it
+            # print one, for the next wait to see
+            self.ble_conn.sendline('')
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  The payload is hex encoded once, so that each data packet is a slice of
+    #  it behind a cached "char-write-cmd <handle> " prefix.
+    # --------------------------------------------------------------------------
+    payload_encoding = 'hex'
+
+    def encode_payload(self, data):
+        return binascii.hexlify(as_buffer(data))
+
+    def write_cmd_slice(self, handle, payload, offset, num_bytes):
+        self.write_cmd_burst(handle, payload, offset, offset + num_bytes, num_bytes)
+
+    # --------------------------------------------------------------------------
+    #  The command lines of all packets are written in one go, straight from
+    #  their parts: no line is copied together, and there is one system call
+    #  per IOV_MAX buffers rather than one per packet.
+    # --------------------------------------------------------------------------
+    def write_cmd_burst(self, handle, payload, offset, end, packet_size):
+        if handle not in self.cmd_prefix:
+            self.cmd_prefix[handle] = ('char-write-cmd 0x%04x ' % handle).encode('ascii')
+
+        prefix = self.cmd_prefix[handle]
+        view = memoryview(payload)
+
+        parts = []
+        for i in range(offset, end, packet_size):
+            parts += (prefix, view[2*i:2*min(i + packet_size, end)], b'\n')
+
+        if verbose: print('char-write-cmd 0x%04x: %d bytes at %d' % (handle, end - offset, offset))
+
+        self._write_parts(parts)
+
+    # --------------------------------------------------------------------------
+    #  Write without blocking. gatttool echoes every line and prompts after
+    #  it; once it blocks on that output it stops reading its input, so
+    #  whenever the pty takes no more input, its output is drained.
+    # --------------------------------------------------------------------------
+    def _write_parts(self, parts, timeout=30):
+        fd = self.ble_conn.child_fd
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        try:
+            deadline = time.time() + timeout
+            while parts:
+                try:
+                    parts = advance_parts(parts, os.writev(fd, parts[:IOV_MAX]))
+                    deadline = time.time() + timeout
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    if time.time() > deadline:
+                        raise Exception('gatttool does not take commands')
+                    self._drain_output()
+        finally:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+    # --------------------------------------------------------------------------
+    #  Have the reader take the output waiting in the pty. If the
+    #  notification reader is reading already, just wait for room to write.
+    # --------------------------------------------------------------------------
+    def _drain_output(self, timeout=0.1):
+        fd = self.ble_conn.child_fd
+
+        if not self.read_lock.acquire(False):
+            select.select([], [fd], [], timeout)
+            return
+
+        try:
+            (readable, writable, _) = select.select([fd], [fd], [], timeout)
+            if readable:
+                self.reader.read()
+        finally:
+            self.read_lock.release()
+
+#------------------------------------------------------------------------------
+# Native ATT over an L2CAP LE socket
+#------------------------------------------------------------------------------
+class Att:
+    ERROR_RSP           = 0x01
+    EXCHANGE_MTU_REQ    = 0x02
+    EXCHANGE_MTU_RSP    = 0x03
+    READ_BY_TYPE_REQ    = 0x08
+    READ_BY_TYPE_RSP    = 0x09
+    WRITE_REQ           = 0x12
+    WRITE_RSP           = 0x13
+    NOTIFICATION        = 0x1B
+    INDICATION          = 0x1D
+    CONFIRMATION        = 0x1E
+    WRITE_CMD           = 0x52
+
+    ERR_INVALID_HANDLE          = 0x01
+    ERR_ATTRIBUTE_NOT_FOUND     = 0x0A
+    ERR_REQUEST_NOT_SUPPORTED   = 0x06
+
+    CID                 = 4
+    DEFAULT_MTU         = 23
+    MAX_MTU             = 517
+
+    GATT_CHARACTERISTIC = 0x2803
+
+AF_BLUETOOTH        = getattr(socket, 'AF_BLUETOOTH', 31)
+BTPROTO_L2CAP       = getattr(socket, 'BTPROTO_L2CAP', 0)
+BDADDR_LE_PUBLIC    = 0x01
+BDADDR_LE_RANDOM    = 0x02
+
+# --------------------------------------------------------------------------
+#  Build a struct sockaddr_l2 for an LE address and CID.
+#  Python's socket module only understands (bdaddr, psm) for L2CAP, so the
+#  address is packed by hand and passed to libc.
+# --------------------------------------------------------------------------
+def sockaddr_l2(mac, cid, addr_type):
+    bdaddr = binascii.unhexlify(mac.replace(':', ''))[::-1]
+    return struct.pack('<HH6sHBx', AF_BLUETOOTH, 0, bdaddr, cid, addr_type)
+
+# --------------------------------------------------------------------------
+#  Call bind() or connect() from libc with a raw sockaddr.
+#  Returns 0 or the errno value.
+# --------------------------------------------------------------------------
+_libc = None
+
+def sockaddr_call(name, sock, addr):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    buf = ctypes.create_string_buffer(addr, len(addr))
+    if getattr(_libc, name)(sock.fileno(), buf, len(addr)) != 0:
+        return ctypes.get_errno()
+    return 0
+
+def uuid_from_bytes(data):
+    if len(data) == 2:
+        return BLUETOOTH_BASE_UUID % struct.unpack('<H', data)
+    h = binascii.hexlify(bytes(bytearray(data))[::-1]).decode('ascii')
+    return '%s-%s-%s-%s-%s' % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+def uuid_to_bytes(uuid):
+    return binascii.unhexlify(uuid.replace('-', ''))[::-1]
+
+class AttSocketTransport(BleTransport):
+
+    def __init__(self, target_mac, adapter=None, addr_type=BDADDR_LE_RANDOM):
+        BleTransport.__init__(self, target_mac, adapter)
+        self.addr_type = addr_type
+        self.sock = None
+        self.mtu = Att.DEFAULT_MTU
+        self.notifications = collections.deque()
+
+    def connect(self, timeout=30):
+        self._close()
+        self.sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+
+        err = sockaddr_call('bind', self.sock, sockaddr_l2(self.local_address(), Att.CID, BDADDR_LE_PUBLIC))
+        if err:
+            raise Exception("bind failed: {}".format(os.strerror(err)))
+
+        self.sock.setblocking(False)
+        err = sockaddr_call('connect', self.sock, sockaddr_l2(self.target_mac, Att.CID, self.addr_type))
+        if err not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            self._close()
+            return False
+
+        (_, writable, _) = select.select([], [self.sock], [], timeout)
+        if not writable or self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self._close()
+            return False
+
+        self.sock.setblocking(True)
+        self.mtu = Att.DEFAULT_MTU
+        self.notifications.clear()
+        return True
+
+    # --------------------------------------------------------------------------
+    #  Address to bind to: the adapter's, or any adapter
+    # --------------------------------------------------------------------------
+    def local_address(self):
+        if self.adapter:
+            return adapter_address(self.adapter)
+        return '00:00:00:00:00:00'
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def disconnect(self):
+        self._close()
+
+    def set_target(self, target_mac):
+        self._close()
+        self.target_mac = target_mac
+
+    # --------------------------------------------------------------------------
+    #  Receive one PDU. Returns None on timeout, raises if the link was lost.
+    # --------------------------------------------------------------------------
+    def _recv_pdu(self, timeout):
+        if self.sock is None:
+            raise Exception('Connection Lost')
+
+        (readable, _, _) = select.select([self.sock], [], [], max(timeout, 0))
+        if not readable:
+            return None
+
+        try:
+            pdu = bytearray(self.sock.recv(1024))
+        except socket.error:
+            pdu = None
+
+        if not pdu:
+            print('Connection lost! ')
+            self._close()
+            raise Exception('Connection Lost')
+
+        return pdu
+
+    # --------------------------------------------------------------------------
+    #  Handle PDUs the peer sends on its own: notifications are queued,
+    #  indications confirmed and requests answered.
+    #  Returns True if the PDU was consumed.
+    # --------------------------------------------------------------------------
+    def _handle_unsolicited(self, pdu):
+        opcode = pdu[0]
+
+        if opcode in (Att.NOTIFICATION, Att.INDICATION):
+            (handle,) = struct.unpack('<H', bytes(pdu[1:3]))
+            self.notifications.append(Notification(handle, pdu[3:]))
+            if opcode == Att.INDICATION:
+                self.sock.send(bytes(bytearray([Att.CONFIRMATION])))
+            return True
+
+        if opcode == Att.EXCHANGE_MTU_REQ:
+            self.sock.send(struct.pack('<BH', Att.EXCHANGE_MTU_RSP, Att.MAX_MTU))
+            (client_mtu,) = struct.unpack('<H', bytes(pdu[1:3]))
+            self.mtu = max(Att.DEFAULT_MTU, min(client_mtu, Att.MAX_MTU))
+            return True
+
+        # Any other request (even opcode, not a command) is not supported
+        if opcode & 0x01 == 0 and opcode & 0x40 == 0 and opcode != Att.CONFIRMATION:
+            self.sock.send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, 0, Att.ERR_REQUEST_NOT_SUPPORTED))
+            return True
+
+        return False
+
+    # --------------------------------------------------------------------------
+    #  Send a request and wait for its response (or an error response).
+    #  Returns the response PDU or None on timeout.
+    # --------------------------------------------------------------------------
+    def _request(self, pdu, timeout=10):
+        self.sock.send(bytes(pdu))
+        deadline = time.time() + timeout
+
+        while True:
+            rsp = self._recv_pdu(deadline - time.time())
+            if rsp is None:
+                return None
+            if not self._handle_unsolicited(rsp):
+                return rsp
+
+    def discover(self, uuids=None, timeout=10):
+        chars = []
+        start = 0x0001
+        deadline = time.time() + timeout
+
+        while start <= 0xffff:
+            rsp = self._request(struct.pack('<BHHH', Att.READ_BY_TYPE_REQ, start, 0xffff, Att.GATT_CHARACTERISTIC),
+                                deadline - time.time())
+            if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+                break
+
+            length = rsp[1]
+            for i in range(2, len(rsp) - length + 1, length):
+                entry = bytes(rsp[i:i + length])
+                (handle, properties, value_handle) = struct.unpack('<HBH', entry[0:5])
+                chars.append(Characteristic(handle, properties, value_handle, uuid_from_bytes(entry[5:])))
+                start = handle + 1
+
+        return chars
+
+    def exchange_mtu(self, mtu, timeout=10):
+        rsp = self._request(struct.pack('<BH', Att.EXCHANGE_MTU_REQ, mtu), timeout)
+        if rsp is None or rsp[0] != Att.EXCHANGE_MTU_RSP:
+            return self.mtu
+
+        (server_mtu,) = struct.unpack('<H', bytes(rsp[1:3]))
+        self.mtu = max(Att.DEFAULT_MTU, min(mtu, server_mtu))
+        return self.mtu
+
+    # --------------------------------------------------------------------------
+    #  Header and value are gathered into one PDU by the socket
+    # --------------------------------------------------------------------------
+    def write_cmd(self, handle, data):
+        self.sock.sendmsg([struct.pack('<BH', Att.WRITE_CMD, handle), as_buffer(data)])
+
+    def write_req(self, handle, data, wait=True, timeout=10):
+        pdu = struct.pack('<BH', Att.WRITE_REQ, handle) + bytes(bytearray(data))
+
+        if not wait:
+            self.sock.send(pdu)
+            return True
+
+        rsp = self._request(pdu, timeout)
+        return rsp is not None and rsp[0] == Att.WRITE_RSP
+
+    def read_by_uuid(self, uuid, timeout=10):
+        rsp = self._request(struct.pack('<BHH', Att.READ_BY_TYPE_REQ, 0x0001, 0xffff) + uuid_to_bytes(uuid), timeout)
+        if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+            return None
+
+        length = rsp[1]
+        return rsp[4:2 + length]
+
+    def wait_for_notification(self, timeout=30, handle=None):
+        deadline = time.time() + timeout
+
+        while True:
+            for notify in self.notifications:
+                if handle is None or notify.handle == handle:
+                    self.notifications.remove(notify)
+                    return notify
+
+            pdu = self._recv_pdu(deadline - time.time())
+            if pdu is None:
+                return None
+            self._handle_unsolicited(pdu)
+
+#------------------------------------------------------------------------------
+# Create a transport by name
+#------------------------------------------------------------------------------
+TRANSPORTS = {
+    'gatttool'  : GatttoolTransport,
+    'socket'    : AttSocketTransport,
+}
+
+def create_transport(name, target_mac, adapter=None, **options):
+    if name not in TRANSPORTS:
+        raise Exception("Unknown transport: {}".format(name))
+
+    return TRANSPORTS[name](target_mac, adapter, **options)
@@ -1,9 +1,17 @@
 import sys
 import binascii
+import json
+import os
 import re
+import tempfile
+import threading
+
+# Files written by atomic_write get the permissions open() would give them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 def bytes_to_uint32_le(bytes):
-    return  (int(bytes[3], 16) << 24) | (int(bytes[2], 16) << 16) | (int(bytes[1], 16) <<  8) | (int(bytes[0], 16) <<  0)
+    return  (bytes[3] << 24) | (bytes[2] << 16) | (bytes[1] <<  8) | (bytes[0] <<  0)
 
 def uint32_to_bytes_le(uint32):
     return [(uint32 >> 0)  & 0xff, 
@@ -20,16 +28,13 @@ def zero_pad_array_le(data, padsize):
         data.insert(0, 0)
 
 def array_to_hex_string(arr):
-    hex_str = ""
-    for val in arr:
-        if val > 255:
-            raise Exception("Value is greater than it is possible to represent with one byte")
-        hex_str += "%02x" % val
-
-    return hex_str
+    try:
+        return binascii.hexlify(bytearray(arr)).decode('ascii')
+    except ValueError:
+        raise Exception("Value is greater than it is possible to represent with one byte")
 
-def crc32_unsigned(bytestring):
-    return binascii.crc32(bytestring) % (1 << 32)     
+def crc32_unsigned(bytestring, crc=0):
+    return binascii.crc32(bytestring, crc) % (1 << 32)
 
 def mac_string_to_uint(mac):
     parts = list(re.match('(..):(..):(..):(..):(..):(..)', mac).groups())
@@ -47,6 +52,51 @@ def uint_to_mac_string(mac):
 
     return ':'.join(map(lambda x: '{:02x}'.format(x).upper(), ints))
 
+#------------------------------------------------------------------------------
+# Write data (bytes or a buffer) to path through a temporary file in the same
+# directory and a rename, so that a crash never leaves a half-written file
+# and readers see the old or the new contents. The temporary name is unique,
+# concurrent writers of one path don't share it.
+#------------------------------------------------------------------------------
+def atomic_write(path, data):
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+#------------------------------------------------------------------------------
+# A dict of entries kept in a JSON file, loaded when created. Subclasses add
+# the accessors, take lock around them and call _save() after changes.
+#------------------------------------------------------------------------------
+class JsonStore(object):
+
+    # What the file is, for messages
+    description = 'file'
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print("Ignoring corrupt {} {}".format(self.description, self.path))
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        atomic_write(self.path, json.dumps(self.entries, indent=2, sort_keys=True).encode('utf-8'))
+
 # Print a nice console progress bar
 def print_progress(iteration, total, prefix = '', suffix = '', decimals = 1, barLength = 100):
     """